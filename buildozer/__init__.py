@@ -8,25 +8,50 @@ Generic Python packager for Android / iOS. Desktop later.
 
 __version__ = '1.5.1.dev0'
 
-from fnmatch import fnmatch
+from contextlib import contextmanager
 import os
-from os import environ, walk, sep, listdir
-from os.path import join, exists, dirname, realpath, splitext, expanduser
+from os import environ, walk, listdir
+from os.path import join, exists, dirname, realpath, expanduser
 import re
 from re import search
+import shlex
 import sys
 from sys import exit
 import textwrap
 import warnings
 import venv
 
+import buildozer.assets as assets
 import buildozer.buildops as buildops
-from buildozer.jsonstore import JsonStore
+from buildozer.applibs import AppLibs
+from buildozer.bytecode import precompile
+from buildozer.downloadcache import DownloadCache, parse_size, format_size
+from buildozer.exceptions import BuildozerCommandException
+from buildozer.gitcache import GitCache
+from buildozer.jsonstore import JsonStore, SqliteBackend
 from buildozer.logger import Logger
+from buildozer.sourcefilter import SourceFilter
 from buildozer.specparser import SpecParser
 
 SIMPLE_HTTP_SERVER_PORT = 8000
 
+# Number of spilled command logs kept in the logs directory.
+LOGS_KEEP = 40
+
+# Default budget of the global download cache.
+DOWNLOAD_CACHE_SIZE = '20G'
+
+# Default budget of the global git cache.
+GIT_CACHE_SIZE = '10G'
+
+# Stages of a build. A command can be run before and after each of them, see
+# Buildozer.hook().
+BUILD_STAGES = ('check_requirements', 'install_platform',
+                'check_application_requirements', 'compile_platform',
+                'build_application', 'build_package')
+HOOKS = tuple('{}_{}'.format(when, stage)
+              for stage in BUILD_STAGES for when in ('pre', 'post'))
+
 
 class Buildozer:
 
@@ -38,7 +63,13 @@ class Buildozer:
         self.specfilename = filename
         self.state = None
         self.build_id = None
+        # rebuild the platform even if its inputs didn't change
+        self.force_compile = False
+        # the application was byte-compiled by buildozer
+        self.precompiled = False
         self.config = SpecParser()
+        self._download_cache = None
+        self._git_cache = None
         self._venv_created = False
         self._build_prepared = False
         self._build_done = False
@@ -85,18 +116,21 @@ class Buildozer:
         self.logger.info('Preparing build')
 
         self.logger.info('Check requirements for {0}'.format(self.targetname))
-        self.target.check_requirements()
+        with self.stage('check_requirements'):
+            self.target.check_requirements()
 
         self.logger.info('Install platform')
-        self.target.install_platform()
+        with self.stage('install_platform'):
+            self.target.install_platform()
 
         self.logger.info('Check application requirements')
-        self.check_application_requirements()
-
-        self.check_garden_requirements()
+        with self.stage('check_application_requirements'):
+            self.check_application_requirements()
+            self.check_garden_requirements()
 
         self.logger.info('Compile platform')
-        self.target.compile_platform()
+        with self.stage('compile_platform'):
+            self.target.compile_platform()
 
         # flag to prevent multiple build
         self._build_prepared = True
@@ -115,19 +149,54 @@ class Buildozer:
         if self._build_done:
             return
 
-        # increment the build number
-        self.build_id = int(self.state.get('cache.build_id', '0')) + 1
-        self.state['cache.build_id'] = str(self.build_id)
+        # increment the build number, atomically as builds of the same
+        # project may run in parallel
+        self.build_id = self.state.increment('cache.build_id', default='0')
 
         self.logger.info('Build the application #{}'.format(self.build_id))
-        self.build_application()
+        with self.stage('build_application'):
+            self.build_application()
 
         self.logger.info('Package the application')
-        self.target.build_package()
+        with self.stage('build_package'):
+            self.target.build_package()
 
         # flag to prevent multiple build
         self._build_done = True
 
+    @contextmanager
+    def stage(self, name):
+        '''Run the pre_ and post_ hooks around a stage of the build (one of
+        BUILD_STAGES). The post_ hook is not run if the stage fails.
+        '''
+        self.hook('pre_{}'.format(name))
+        yield
+        self.hook('post_{}'.format(name))
+
+    def hook(self, name):
+        '''Run the command configured for the hook point name in the [hooks]
+        section of the spec, if any.
+
+        The command runs in the directory of the spec file, with the
+        BUILDOZER_HOOK, BUILDOZER_TARGET, BUILDOZER_BUILD_MODE,
+        BUILDOZER_APP_DIR and BUILDOZER_BIN_DIR environment variables set.
+        A failing command aborts the build.
+        '''
+        command = self.config.getdefault('hooks', name, '').strip()
+        if not command:
+            return
+        self.logger.info('Run the {} hook'.format(name))
+        env = self.environ.copy()
+        env.update({
+            'BUILDOZER_HOOK': name,
+            'BUILDOZER_TARGET': self.targetname or '',
+            'BUILDOZER_BUILD_MODE': self.target.build_mode if self.target else '',
+            'BUILDOZER_APP_DIR': self.app_dir,
+            'BUILDOZER_BIN_DIR': self.bin_dir,
+        })
+        buildops.cmd(
+            shlex.split(command), env=env, cwd=self.root_dir)
+
     def check_configuration_tokens(self):
         '''Ensure the spec file is 'correct'.
         '''
@@ -158,6 +227,22 @@ class Buildozer:
             adderror('[app] "version.filename" is missing'
                      ', required by "version.regex"')
 
+        if get('buildozer', 'state_backend', 'json') not in ('json', 'sqlite'):
+            adderror('[buildozer] "state_backend" must be json or sqlite')
+        if get('buildozer', 'venv', 'local') not in ('local', 'shared', 'none'):
+            adderror('[buildozer] "venv" must be local, shared or none')
+
+        copy_mode = get('app', 'copy_mode', 'copy')
+        if copy_mode not in buildops.COPY_MODES:
+            adderror('[app] "copy_mode" must be one of {}'.format(
+                ', '.join(buildops.COPY_MODES)))
+
+        if self.config.has_section('hooks'):
+            for name in self.config.options('hooks'):
+                if name not in HOOKS:
+                    adderror('[hooks] "{}" is not a hook point, use one of '
+                             '{}'.format(name, ', '.join(HOOKS)))
+
         orientation = self.config.getlist("app", "orientation", ["landscape"])
         for o in orientation:
             if o not in ("landscape", "portrait", "landscape-reverse", "portrait-reverse"):
@@ -209,8 +294,12 @@ class Buildozer:
         # create local bin/ dir
         buildops.mkdir(self.bin_dir)
 
+        # create local logs/ dir, for the command outputs
+        buildops.mkdir(self.logs_dir)
+        self._prune_logs()
+
         buildops.mkdir(self.applibs_dir)
-        self.state = JsonStore(join(self.buildozer_dir, 'state.db'))
+        self.state = self._open_state()
 
         target = self.targetname
         if target:
@@ -218,6 +307,17 @@ class Buildozer:
             buildops.mkdir(join(self.buildozer_dir, target, 'platform'))
             buildops.mkdir(join(self.buildozer_dir, target, 'app'))
 
+    def _open_state(self):
+        '''Open the state of the builds, stored in state.db, or in
+        state.sqlite with the sqlite state_backend (migrated from state.db).
+        '''
+        state_db = join(self.buildozer_dir, 'state.db')
+        backend = None
+        if self.config.getdefault('buildozer', 'state_backend', 'json') == 'sqlite':
+            backend = SqliteBackend(
+                join(self.buildozer_dir, 'state.sqlite'), migrate_from=state_db)
+        return JsonStore(state_db, backend=backend)
+
     def check_application_requirements(self):
         '''Ensure the application requirements are all available and ready to be
         packaged as well.
@@ -240,42 +340,156 @@ class Buildozer:
         # See: https://docs.python.org/3/library/venv.html#how-venvs-work
         currently_in_venv = sys.prefix != sys.base_prefix
 
-        if requirements and currently_in_venv:
+        if (
+            requirements and currently_in_venv and
+            self.config.getdefault('buildozer', 'venv', 'local') != 'none'
+        ):
             e = self.logger.error
             e('virtualenv is needed to install pure-Python modules, but')
             e('virtualenv does not support nesting, and you are running')
             e('buildozer in one. Please run buildozer outside of a')
-            e('virtualenv instead.')
+            e('virtualenv instead, or set venv = none in the [buildozer]')
+            e('section.')
             exit(1)
 
-        # did we already install the libs ?
-        if (
-            exists(self.applibs_dir) and
-            self.state.get('cache.applibs', '') == requirements
-        ):
-            self.logger.debug('Application requirements already installed, pass')
-            return
-
-        # recreate applibs
-        buildops.rmdir(self.applibs_dir)
-        buildops.mkdir(self.applibs_dir)
+        applibs = self._open_applibs()
+        lockfile = self.requirements_lockfile
+        # applibs is only replaced once the reinstallation succeeded
+        reinstall = False
+        if lockfile and not exists(lockfile) and requirements:
+            # the lock file is generated from a complete installation
+            reinstall = True
+        elif not applibs.distributions and listdir(self.applibs_dir):
+            # installed without a manifest (by an older version)
+            reinstall = True
+
+        added = []
+        if not reinstall:
+            # did we already install the libs ?
+            added, removed = applibs.changes(requirements)
+            if not added and not removed:
+                self.logger.debug('Application requirements already installed, pass')
+                return
 
-        # ok now check the availability of all requirements
-        for requirement in requirements:
-            self._install_application_requirement(requirement)
+            if removed:
+                self.logger.info('Remove requirements {} from applibs'.format(
+                    ', '.join(removed)))
+                uninstalled = applibs.remove(removed)
+                self.logger.debug('Uninstalled {}'.format(
+                    ', '.join(uninstalled) or 'nothing'))
+                applibs.save()
+
+            if added:
+                try:
+                    # the kept distributions must not change
+                    staging_dir = self._stage_application_requirements(
+                        added, applibs.pins())
+                except BuildozerCommandException:
+                    if not applibs.distributions:
+                        raise
+                    self.logger.info(
+                        'The requirements {} conflict with the installed ones, '
+                        'reinstall all the requirements'.format(', '.join(added)))
+                    reinstall = True
+
+        if reinstall:
+            added = requirements
+            if added:
+                staging_dir = self._stage_application_requirements(added)
+            applibs = self._open_applibs(reset=True)
+
+        if added:
+            applibs.install(added, staging_dir)
+            buildops.rmdir(staging_dir)
 
         # everything goes as expected, save this state!
-        self.state['cache.applibs'] = requirements
-
-    def _install_application_requirement(self, module):
+        applibs.save()
+
+    def _stage_application_requirements(self, requirements, pins=()):
+        '''Install requirements aside, constrained by pins, and return the
+        staging directory, to merge into applibs with AppLibs.install().'''
+        staging_dir = join(self.buildozer_dir, 'applibs.staging')
+        buildops.rmdir(staging_dir)
+        buildops.mkdir(staging_dir)
+        constraints = []
+        if pins:
+            constraints_file = join(self.buildozer_dir, 'applibs.constraints.txt')
+            with open(constraints_file, 'w') as fd:
+                fd.writelines(pin + '\n' for pin in pins)
+            constraints = [constraints_file]
+        self._install_application_requirements(
+            requirements, staging_dir, constraints=constraints)
+        return staging_dir
+
+    def _open_applibs(self, reset=False):
+        '''Open the manifest of applibs, after emptying it if reset.'''
+        manifest = join(self.buildozer_dir, 'applibs.json')
+        if reset:
+            buildops.rmdir(self.applibs_dir)
+            buildops.file_remove(manifest)
+        buildops.mkdir(self.applibs_dir)
+        return AppLibs(self.applibs_dir, manifest)
+
+    def _install_application_requirements(self, requirements, target_dir=None,
+                                          constraints=()):
+        '''Install all the requirements in target_dir (defaults to applibs),
+        in a single pip run, with the additional constraints files.
+
+        The wheels are built (or downloaded) into the global wheelhouse
+        first, then installed from there only: in offline mode
+        ([buildozer] pip_offline), the wheelhouse must already have them.
+        With a lock file ([app] requirements.lockfile), the versions are
+        constrained by it, and it is generated if missing.
+        '''
+        if target_dir is None:
+            target_dir = self.applibs_dir
         self._ensure_virtualenv()
-        self.logger.debug('Install requirement {} in virtualenv'.format(module))
+        wheelhouse = self.wheelhouse_dir
+        buildops.mkdir(wheelhouse)
+        options = ['--find-links', wheelhouse]
+        lockfile = self.requirements_lockfile
+        if lockfile and exists(lockfile):
+            options += ['--constraint', lockfile]
+        for constraints_file in constraints:
+            options += ['--constraint', constraints_file]
+
+        if self.config.getbooldefault('buildozer', 'pip_offline', False):
+            self.logger.info('Offline mode, use the wheels of {}'.format(wheelhouse))
+        else:
+            self.logger.debug('Build the wheels of {}'.format(
+                ', '.join(requirements)))
+            buildops.cmd(
+                [*self.pip_command, "wheel", "--wheel-dir", wheelhouse,
+                 *options, *requirements],
+                env=self.env_venv,
+                cwd=self.buildozer_dir,
+            )
+
+        self.logger.debug('Install requirements {} in virtualenv'.format(
+            ', '.join(requirements)))
         buildops.cmd(
-            ["pip", "install", f"--target={self.applibs_dir}", module],
+            [*self.pip_command, "install", f"--target={target_dir}",
+             "--no-index", *options, *requirements],
             env=self.env_venv,
             cwd=self.buildozer_dir,
         )
 
+        if lockfile and not exists(lockfile):
+            self._write_requirements_lockfile(lockfile, target_dir)
+
+    def _write_requirements_lockfile(self, lockfile, site_dir):
+        '''Pin the versions of the distributions installed in site_dir.'''
+        pins = []
+        for fn in listdir(site_dir):
+            if not fn.endswith('.dist-info'):
+                continue
+            # name-version.dist-info, the name has no "-" (PEP 427)
+            name, version = fn[:-len('.dist-info')].split('-', 1)
+            pins.append('{}=={}\n'.format(name, version))
+        self.logger.info('Write the requirements lock file {}'.format(lockfile))
+        with open(lockfile, 'w') as fd:
+            fd.writelines(sorted(pins, key=str.lower))
+
     def check_garden_requirements(self):
         garden_requirements = self.config.getlist('app',
             'garden_requirements', '')
@@ -283,37 +497,62 @@ class Buildozer:
             warnings.warn("`garden_requirements` settings is deprecated, use `requirements` instead", DeprecationWarning)
 
     def _ensure_virtualenv(self):
+        '''Prepare env_venv, the environment of the pip commands, according
+        to [buildozer] venv: a venv of the project (local), a venv shared by
+        the projects using the same Python version (shared), or the host
+        interpreter (none).
+        '''
         # Only do it once.
         if self._venv_created:
             return
 
-        venv_dir = join(self.buildozer_dir, 'venv')
-        if not buildops.file_exists(venv_dir):
-            venv.create(venv_dir)
-        self._venv_created = True
-
-        # read virtualenv output and parse it
-        assert sys.platform != "win32", "Can't call bash on Windows"
-        output = buildops.cmd(
-            ["bash", "-c", "source venv/bin/activate && env"],
-            get_stdout=True,
-            cwd=self.buildozer_dir,
-            env=self.environ)
         self.env_venv = self.environ.copy()
-        for line in output[0].splitlines():
-            args = line.split('=', 1)
-            if len(args) != 2:
-                continue
-            key, value = args
-            if key in ('VIRTUAL_ENV', 'PATH'):
-                self.env_venv[key] = value
-        if 'PYTHONHOME' in self.env_venv:
-            del self.env_venv['PYTHONHOME']
+        mode = self.config.getdefault('buildozer', 'venv', 'local')
+        if mode != 'none':
+            if mode == 'shared':
+                venv_dir = join(
+                    self.global_buildozer_dir, 'venv',
+                    'python{}.{}'.format(*sys.version_info[:2]))
+            else:
+                venv_dir = join(self.buildozer_dir, 'venv')
+            self._create_virtualenv(venv_dir)
+            # what bin/activate does
+            bin_dir = join(venv_dir, 'Scripts' if sys.platform == 'win32' else 'bin')
+            self.env_venv['VIRTUAL_ENV'] = venv_dir
+            self.env_venv['PATH'] = os.pathsep.join(
+                [bin_dir] + [path for path in
+                             self.env_venv.get('PATH', '').split(os.pathsep)
+                             if path])
+            self.env_venv.pop('PYTHONHOME', None)
+        self._venv_created = True
 
         # ensure any sort of compilation will fail
         self.env_venv['CC'] = '/bin/false'
         self.env_venv['CXX'] = '/bin/false'
 
+    def _create_virtualenv(self, venv_dir):
+        if buildops.file_exists(venv_dir):
+            return
+        self.logger.debug('Create the virtualenv {}'.format(venv_dir))
+        # created aside, as a shared venv may be created by several builds
+        # at once
+        partial = '{}.{}.tmp'.format(venv_dir, os.getpid())
+        buildops.rmdir(partial)
+        buildops.mkdir(dirname(venv_dir))
+        venv.create(partial)
+        try:
+            os.rename(partial, venv_dir)
+        except OSError:
+            # created by another build in the meantime
+            buildops.rmdir(partial)
+
+    def _prune_logs(self):
+        '''Only keep the most recent command logs.
+        '''
+        logs = sorted(listdir(self.logs_dir), reverse=True)
+        for fn in logs[LOGS_KEEP:]:
+            buildops.file_remove(join(self.logs_dir, fn))
+
     def clean_platform(self):
         self.logger.info('Clean the platform build directory')
         buildops.rmdir(self.platform_dir)
@@ -357,113 +596,106 @@ class Buildozer:
         self._copy_application_sources()
         self._copy_application_libs()
         self._add_sitecustomize()
+        if self.config.getbooldefault('app', 'bytecode.precompile', False):
+            self._precompile_application()
 
     def _copy_application_sources(self):
-        # XXX clean the inclusion/exclusion algo.
         source_dir = realpath(expanduser(self.config.getdefault('app', 'source.dir', '.')))
-        include_exts = self.config.getlist('app', 'source.include_exts', '')
-        exclude_exts = self.config.getlist('app', 'source.exclude_exts', '')
-        exclude_dirs = self.config.getlist('app', 'source.exclude_dirs', '')
-        exclude_patterns = self.config.getlist('app', 'source.exclude_patterns', '')
-        include_patterns = self.config.getlist('app',
-                                               'source.include_patterns',
-                                               '')
+        source_filter = SourceFilter(
+            include_exts=self.config.getlist('app', 'source.include_exts', ''),
+            exclude_exts=self.config.getlist('app', 'source.exclude_exts', ''),
+            exclude_dirs=self.config.getlist('app', 'source.exclude_dirs', ''),
+            exclude_patterns=self.config.getlist(
+                'app', 'source.exclude_patterns', ''),
+            include_patterns=self.config.getlist(
+                'app', 'source.include_patterns', ''))
         app_dir = self.app_dir
 
-        include_exts = [ext.lower() for ext in include_exts]
-        exclude_exts = [ext.lower() for ext in exclude_exts]
-        exclude_dirs = [dir.lower() for dir in exclude_dirs]
-        exclude_patterns = [pat.lower() for pat in exclude_patterns]
-        include_patterns = [pat.lower() for pat in include_patterns]
-
         self.logger.debug('Copy application source from {}'.format(source_dir))
 
-        buildops.rmdir(self.app_dir)
+        sources = self._optimize_assets(dict(source_filter.walk(source_dir)))
 
-        for root, dirs, files in walk(source_dir, followlinks=True):
-            # avoid hidden directory
-            if True in [x.startswith('.') for x in root.split(sep)]:
-                continue
-
-            # need to have sort-of normalization. Let's say you want to exclude
-            # image directory but not images, the filtered_root must have a / at
-            # the end, same for the exclude_dir. And then we can safely compare
-            filtered_root = root[len(source_dir) + 1:].lower()
-            if filtered_root:
-                filtered_root += '/'
-
-                # manual exclude_dirs approach
-                is_excluded = False
-                for exclude_dir in exclude_dirs:
-                    if exclude_dir[-1] != '/':
-                        exclude_dir += '/'
-                    if filtered_root.startswith(exclude_dir):
-                        is_excluded = True
-                        break
-
-                # pattern matching
-                if not is_excluded:
-                    # match pattern if not ruled out by exclude_dirs
-                    for pattern in exclude_patterns:
-                        if fnmatch(filtered_root, pattern):
-                            is_excluded = True
-                            break
-                for pattern in include_patterns:
-                    if fnmatch(filtered_root, pattern):
-                        is_excluded = False
-                        break
-
-                if is_excluded:
-                    continue
+        result = buildops.file_sync(
+            sources, app_dir, self._sync_manifest('app'),
+            checksum=self.config.getbooldefault(
+                'app', 'source.sync_checksum', False),
+            mode=self.copy_mode)
+        self.logger.debug(
+            'Application source: {0.copied} copied, {0.removed} removed, '
+            '{0.unchanged} unchanged'.format(result))
 
+    def _copy_application_libs(self):
+        # copy also the libs
+        sources = {}
+        for root, dirs, files in walk(self.applibs_dir):
             for fn in files:
-                # avoid hidden files
-                if fn.startswith('.'):
-                    continue
-
-                # pattern matching
-                is_excluded = False
-                dfn = fn.lower()
-                if filtered_root:
-                    dfn = join(filtered_root, fn)
-                for pattern in exclude_patterns:
-                    if fnmatch(dfn, pattern):
-                        is_excluded = True
-                        break
-                for pattern in include_patterns:
-                    if fnmatch(dfn, pattern):
-                        is_excluded = False
-                        break
-                if is_excluded:
-                    continue
-
-                # filter based on the extension
-                # TODO more filters
-                basename, ext = splitext(fn)
-                if ext:
-                    ext = ext[1:].lower()
-                    if include_exts and ext not in include_exts:
-                        continue
-                    if exclude_exts and ext in exclude_exts:
-                        continue
-
-                sfn = join(root, fn)
-                rfn = realpath(join(app_dir, root[len(source_dir) + 1:], fn))
-
-                # ensure the directory exists
-                dfn = dirname(rfn)
-                buildops.mkdir(dfn)
+                sources[join(root[len(self.applibs_dir) + 1:], fn)] = \
+                    join(root, fn)
+        buildops.file_sync(
+            sources, join(self.app_dir, '_applibs'),
+            self._sync_manifest('applibs'), mode=self.copy_mode)
+
+    def _sync_manifest(self, name):
+        '''Path of the manifest of the files synced to the app directory.
+        It lives out of the app directory, not to be packaged.
+        '''
+        return join(self.buildozer_dir, self.targetname,
+                    '{}.manifest.json'.format(name))
 
-                # copy!
-                buildops.file_copy(sfn, rfn)
+    @property
+    def copy_mode(self):
+        '''How the application files are copied to the app directory, one of
+        buildops.COPY_MODES.
+        '''
+        return self.config.getdefault('app', 'copy_mode', 'copy')
 
-    def _copy_application_libs(self):
-        # copy also the libs
-        buildops.file_copytree(self.applibs_dir, join(self.app_dir, '_applibs'))
+    def _optimize_assets(self, sources):
+        '''Return the sources to sync to the app directory, where the files
+        that the optimizers of the [assets] section made smaller are
+        replaced by their optimized copy from the global cache.
+        '''
+        optimizers = {}
+        if self.config.has_section('assets'):
+            optimizers = {
+                ext: self.config.get('assets', ext)
+                for ext in self.config.options('assets')}
+        if not any(command.strip() for command in optimizers.values()):
+            return sources
+        sources, result = assets.optimize(
+            sources, optimizers, join(self.global_cache_dir, 'assets'),
+            join(self.buildozer_dir, 'assets.json'), self.environ)
+        if result.files:
+            self.logger.info('Assets: {} files optimized, {} saved'.format(
+                result.files, format_size(result.saved)))
+        return sources
+
+    def _precompile_application(self):
+        '''Byte-compile the application and its libs, with an interpreter
+        of the Python version of the target ([app] bytecode.python, or the
+        one the target provides).
+        '''
+        python = (self.config.getdefault('app', 'bytecode.python', '') or
+                  self.target.get_python_interpreter())
+        if not python:
+            self.logger.error(
+                'No Python interpreter matching the target to precompile '
+                'the application, set [app] bytecode.python')
+            return
+        compiled, unchanged = precompile(
+            python, [self.app_dir], self._sync_manifest('bytecode'),
+            self.environ, optimize=self.target.get_python_optimization())
+        self.logger.debug(
+            'Application bytecode: {} compiled, {} unchanged'.format(
+                compiled, unchanged))
+        self.precompiled = True
 
     def _add_sitecustomize(self):
+        # The app files may be links to the source files: they must be
+        # replaced, not written to.
+        sitecustomize = join(self.app_dir, 'sitecustomize.py')
+        buildops.file_remove(sitecustomize)
         buildops.file_copy(join(dirname(__file__), 'sitecustomize.py'),
-                join(self.app_dir, 'sitecustomize.py'))
+                sitecustomize)
 
         main_py = join(self.app_dir, 'service', 'main.py')
         if not buildops.file_exists(main_py):
@@ -475,6 +707,7 @@ class Buildozer:
         with open(main_py, 'rb') as fd:
             data = fd.read()
         data = header + data
+        buildops.file_remove(main_py)
         with open(main_py, 'wb') as fd:
             fd.write(data)
         self.logger.info('Patched service/main.py to include applibs')
@@ -518,6 +751,11 @@ class Buildozer:
             return self.user_bin_dir
         return join(self.root_dir, 'bin')
 
+    @property
+    def logs_dir(self):
+        '''The directory in which the output of long commands is logged.'''
+        return join(self.buildozer_dir, 'logs')
+
     @property
     def platform_dir(self):
         return join(self.buildozer_dir, self.targetname, 'platform')
@@ -530,6 +768,24 @@ class Buildozer:
     def applibs_dir(self):
         return join(self.buildozer_dir, 'applibs')
 
+    @property
+    def pip_command(self):
+        # without a venv, the pip of the Python running buildozer
+        if self.config.getdefault('buildozer', 'venv', 'local') == 'none':
+            return [sys.executable, '-m', 'pip']
+        return ['pip']
+
+    @property
+    def requirements_lockfile(self):
+        lockfile = self.config.getdefault('app', 'requirements.lockfile', '')
+        return join(self.root_dir, lockfile) if lockfile else ''
+
+    @property
+    def wheelhouse_dir(self):
+        '''The wheels of the application requirements, shared by all the
+        projects.'''
+        return join(self.global_cache_dir, 'wheels')
+
     @property
     def global_buildozer_dir(self):
         return join(expanduser('~'), '.buildozer')
@@ -546,6 +802,36 @@ class Buildozer:
     def global_cache_dir(self):
         return join(self.global_buildozer_dir, 'cache')
 
+    @property
+    def download_cache(self):
+        '''The archive cache shared by all the projects, see
+        :class:`buildozer.downloadcache.DownloadCache`.'''
+        if self._download_cache is None:
+            max_size = self.config.getdefault(
+                'buildozer', 'download_cache_size', DOWNLOAD_CACHE_SIZE)
+            self._download_cache = DownloadCache(
+                join(self.global_cache_dir, 'downloads'),
+                max_size=parse_size(max_size))
+        return self._download_cache
+
+    @property
+    def git_cache(self):
+        '''The cache of the git clones shared by all the projects (see
+        :class:`buildozer.gitcache.GitCache`), or None if it is disabled.
+        It is enabled by the USE_GIT_CACHING environment variable.'''
+        if not self.environ.get('USE_GIT_CACHING'):
+            return None
+        return self._open_git_cache()
+
+    def _open_git_cache(self):
+        if self._git_cache is None:
+            max_size = self.config.getdefault(
+                'buildozer', 'git_cache_size', GIT_CACHE_SIZE)
+            self._git_cache = GitCache(
+                join(self.global_cache_dir, 'git'), env=self.environ,
+                max_size=parse_size(max_size))
+        return self._git_cache
+
     @property
     def package_full_name(self):
         package_name = self.config.getdefault('app', 'package.name', '')
@@ -574,7 +860,7 @@ class Buildozer:
 
     def usage(self):
         print('Usage:')
-        print('    buildozer [--profile <name>] [--verbose] [target] <command>...')
+        print('    buildozer [--profile <name>] [--verbose] [--force-compile] [target] <command>...')
         print('    buildozer --version')
         print('')
         print('Available targets:')
@@ -652,6 +938,9 @@ class Buildozer:
             elif arg in ('-p', '--profile'):
                 profile = args.pop(0)
 
+            elif arg == '--force-compile':
+                self.force_compile = True
+
             elif arg == '--version':
                 print('Buildozer {0}'.format(__version__))
                 exit(0)
@@ -739,6 +1028,42 @@ class Buildozer:
         else:
             self.logger.error('{} already deleted, skipping.'.format(self.buildozer_dir))
 
+    def cmd_cache(self, *args):
+        '''Manage the download cache, or the git cache with "cache git":
+        ls, prune [size], verify
+        '''
+        is_git = bool(args) and args[0] == 'git'
+        if is_git:
+            cache = self._open_git_cache()
+            args = args[1:]
+        else:
+            cache = self.download_cache
+        action = args[0] if args else 'ls'
+        if action == 'ls':
+            for name, entry in cache.entries():
+                if is_git:
+                    print('{0:>8}  {1} clone(s)  {2}'.format(
+                        format_size(entry['size']), len(entry['clones']),
+                        entry['url']))
+                else:
+                    print('{0:>8}  {1}  {2}'.format(
+                        format_size(entry['size']), entry['sha256'][:12], name))
+            print('Total: {0} (limit {1})'.format(
+                format_size(cache.total_size()), format_size(cache.max_size)))
+        elif action == 'prune':
+            max_size = parse_size(args[1]) if len(args) > 1 else None
+            freed = cache.evict(max_size)
+            print('Freed {0}'.format(format_size(freed)))
+        elif action == 'verify':
+            dropped = cache.verify()
+            for url in dropped:
+                print('Dropped {0}'.format(url))
+            print('{0} invalid entries'.format(len(dropped)))
+        else:
+            self.logger.error('Unknown cache action {0!r}, use one of: '
+                              'ls, prune [size], verify'.format(action))
+            exit(1)
+
     def cmd_help(self, *args):
         '''Show the Buildozer help.
         '''
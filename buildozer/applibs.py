@@ -0,0 +1,183 @@
+"""
+Incremental management of the applibs directory, where the application
+requirements that the target can't build are installed with pip.
+
+A manifest records, for every requirement, the distributions it pulled (the
+distribution itself and its dependencies), and, for every distribution, its
+version and the files it owns (from its RECORD). When the requirements
+change, only the new ones are installed, and only the distributions no
+longer needed by any requirement are removed.
+"""
+
+__all__ = ["AppLibs", "normalize_name"]
+
+import csv
+import io
+import json
+import os
+from os.path import dirname, exists, isdir, join, normpath
+import re
+
+import buildozer.buildops as buildops
+
+REQUIREMENT_NAME = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)")
+REQUIRES_DIST = re.compile(r"^Requires-Dist:\s*([A-Za-z0-9][A-Za-z0-9._-]*)", re.M)
+
+
+def normalize_name(name):
+    """Normalize a distribution name, as in PEP 503."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _read_distributions(site_dir):
+    """Return {normalized name: {"version", "files", "requires"}} for the
+    distributions installed in site_dir."""
+    distributions = {}
+    for fn in os.listdir(site_dir):
+        if not fn.endswith(".dist-info"):
+            continue
+        info_dir = join(site_dir, fn)
+        name, version = fn[:-len(".dist-info")].split("-", 1)
+        files = set()
+        record = join(info_dir, "RECORD")
+        if exists(record):
+            with io.open(record, encoding="utf-8", newline="") as fd:
+                for row in csv.reader(fd):
+                    if not row:
+                        continue
+                    path = normpath(row[0])
+                    # scripts are installed outside of the site directory
+                    if not path.startswith(".."):
+                        files.add(path)
+        # the RECORD may not list itself or the installer metadata
+        for info_fn in os.listdir(info_dir):
+            files.add(join(fn, info_fn))
+        requires = []
+        metadata = join(info_dir, "METADATA")
+        if exists(metadata):
+            with io.open(metadata, encoding="utf-8") as fd:
+                requires = [
+                    normalize_name(match)
+                    for match in REQUIRES_DIST.findall(fd.read())]
+        distributions[normalize_name(name)] = {
+            "version": version,
+            "files": sorted(files),
+            "requires": requires,
+        }
+    return distributions
+
+
+class AppLibs:
+
+    def __init__(self, applibs_dir, manifest_path):
+        self.applibs_dir = applibs_dir
+        self.manifest_path = manifest_path
+        self.requirements = {}
+        self.distributions = {}
+        if exists(manifest_path) and isdir(applibs_dir):
+            with io.open(manifest_path, encoding="utf-8") as fd:
+                manifest = json.load(fd)
+            self.requirements = manifest["requirements"]
+            self.distributions = manifest["distributions"]
+
+    def save(self):
+        with io.open(self.manifest_path, "w", encoding="utf-8") as fd:
+            json.dump({
+                "requirements": self.requirements,
+                "distributions": self.distributions,
+            }, fd, indent=1, sort_keys=True)
+
+    def changes(self, requirements):
+        """Return the (added, removed) requirements, compared to the
+        installed ones. A requirement whose version changed is both removed
+        and added."""
+        added = [req for req in requirements if req not in self.requirements]
+        removed = [req for req in self.requirements if req not in requirements]
+        return added, removed
+
+    def pins(self):
+        """Return the name==version of the installed distributions."""
+        return sorted(
+            "{}=={}".format(name, distribution["version"])
+            for name, distribution in self.distributions.items())
+
+    def remove(self, requirements):
+        """Forget requirements, and uninstall the distributions that no other
+        requirement needs. Returns the names of the uninstalled
+        distributions."""
+        for requirement in requirements:
+            self.requirements.pop(requirement, None)
+        needed = {
+            name for names in self.requirements.values() for name in names}
+        removed = [name for name in self.distributions if name not in needed]
+        for name in removed:
+            self._uninstall(name)
+        return removed
+
+    def _uninstall(self, name):
+        distribution = self.distributions.pop(name)
+        directories = set()
+        for path in distribution["files"]:
+            buildops.file_remove(join(self.applibs_dir, path))
+            directory = dirname(path)
+            while directory:
+                directories.add(directory)
+                directory = dirname(directory)
+        # the deepest first
+        for directory in sorted(directories, key=len, reverse=True):
+            try:
+                os.rmdir(join(self.applibs_dir, directory))
+            except OSError:  # not empty
+                pass
+
+    def install(self, requirements, staging_dir):
+        """Move the distributions installed for requirements in staging_dir
+        (by pip install --target) into applibs, and record them.
+
+        The distributions already installed at the same version are kept,
+        the other versions are replaced (pin the installed versions, see
+        pins(), to prevent it).
+        """
+        staged = _read_distributions(staging_dir)
+        for name, distribution in staged.items():
+            installed = self.distributions.get(name)
+            if installed and installed["version"] == distribution["version"]:
+                continue
+            if installed:
+                self._uninstall(name)
+            for path in distribution["files"]:
+                source = join(staging_dir, path)
+                if not exists(source):
+                    continue
+                target = join(self.applibs_dir, path)
+                buildops.mkdir(dirname(target))
+                os.replace(source, target)
+            self.distributions[name] = {
+                "version": distribution["version"],
+                "files": distribution["files"],
+                "requires": distribution["requires"],
+            }
+
+        for requirement in requirements:
+            self.requirements[requirement] = self._dependencies(
+                requirement, staged)
+
+    def _dependencies(self, requirement, staged):
+        """Names of the distributions needed by requirement: the one it
+        names, and its dependencies. If it can't be found (a requirement
+        given as an URL...), all the distributions of its installation."""
+        match = REQUIREMENT_NAME.match(requirement)
+        root = normalize_name(match.group(1)) if match else None
+        if root not in self.distributions or "://" in requirement:
+            return sorted(staged)
+        needed = set()
+        pending = [root]
+        while pending:
+            name = pending.pop()
+            if name in needed or name not in self.distributions:
+                continue
+            needed.add(name)
+            # optional dependencies (extras, markers) are included if they
+            # were installed
+            pending.extend(self.distributions[name]["requires"])
+        return sorted(needed)
@@ -0,0 +1,141 @@
+"""
+Optimization of the assets of the application, before packaging.
+
+Each source file with an optimizer command (by extension) is optimized on a
+copy, kept in a cache keyed by the hash of its content and of the command, so
+a file is only optimized once whatever the project or the build. The cached
+copy then replaces the source file in the app directory sync, so the source
+is never modified, and an unchanged file isn't copied again. An index keeps
+the cached copy of every source file by size and modification time, so the
+unchanged sources aren't even hashed again.
+"""
+
+__all__ = ["optimize", "AssetsResult"]
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import os
+from os.path import exists, join, splitext
+import shlex
+import threading
+
+import buildozer.buildops as buildops
+from buildozer.logger import Logger
+
+LOGGER = Logger()
+
+AssetsResult = namedtuple("AssetsResult", "files saved")
+
+
+def _extension(path):
+    return splitext(path)[1].lower().lstrip(".")
+
+
+def optimize(files, optimizers, cache_dir, index_path, env, workers=None):
+    """Optimize the files, a dict of {relative path: source path} as given
+    to buildops.file_sync(), with the optimizers, a dict of
+    {extension: command}, where {} is replaced by the path of the file to
+    optimize in place. Commands run in parallel, on workers threads (by
+    default, the ThreadPoolExecutor default).
+
+    Returns the files with the optimized copies in place of the sources
+    made smaller, and an AssetsResult with the number of files newly
+    optimized and the number of bytes they saved.
+    """
+    optimizers = {
+        ext.lower().lstrip("."): command
+        for ext, command in optimizers.items() if command.strip()}
+    try:
+        with io.open(index_path, encoding="utf-8") as fd:
+            previous = json.load(fd)
+    except (OSError, ValueError):
+        previous = {}
+    buildops.mkdir(cache_dir)
+
+    def cache_path(path, ext):
+        return "{}.{}".format(join(cache_dir, hashlib.sha256(
+            (optimizers[ext] + "\0" + buildops.file_sha256(path)).encode(
+                "utf-8")).hexdigest()), ext)
+
+    def optimize_file(source):
+        """Return the cached copy of source, or None if it can't be
+        optimized now."""
+        ext = _extension(source)
+        cached = cache_path(source, ext)
+        if exists(cached):
+            return cached
+        # optimized aside, so a failure doesn't leave a broken entry; the
+        # extension is kept for the optimizers
+        partial = "{}.{}-{}.tmp.{}".format(
+            cached[:-len(ext) - 1], os.getpid(), threading.get_ident(), ext)
+        buildops.file_copy(source, partial)
+        args = [
+            partial if arg == "{}" else arg.replace("{}", partial)
+            for arg in shlex.split(optimizers[ext])]
+        try:
+            return_code = buildops.cmd(
+                args, env=env, break_on_error=False).return_code
+        except OSError as error:  # the optimizer is not installed
+            LOGGER.error("Unable to run {}: {}".format(args[0], error))
+            return_code = None
+        if return_code != 0:
+            # not cached, the next build tries again
+            LOGGER.error("Unable to optimize {}".format(source))
+            buildops.file_remove(partial)
+            return None
+        if os.path.getsize(partial) >= os.path.getsize(source):
+            # the original is kept, and not optimized again
+            buildops.file_remove(partial)
+            buildops.file_copy(source, partial)
+        os.replace(partial, cached)
+        # an optimized file is not optimized again either
+        optimized = cache_path(cached, ext)
+        if not exists(optimized):
+            try:
+                os.link(cached, optimized)
+            except OSError:  # already created by another thread
+                pass
+        return cached
+
+    index = {}
+    pending = []
+    for source in files.values():
+        ext = _extension(source)
+        if ext not in optimizers:
+            continue
+        stat = os.stat(source)
+        entry = [stat.st_size, stat.st_mtime_ns, optimizers[ext]]
+        cached = previous.get(source)
+        if cached and cached[:3] == entry and exists(cached[3]):
+            index[source] = cached
+        else:
+            pending.append((source, entry))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        optimized = list(executor.map(
+            optimize_file, [source for source, _ in pending]))
+    count = saved = 0
+    for (source, entry), cached in zip(pending, optimized):
+        if cached is None:
+            continue
+        index[source] = entry + [cached]
+        gain = entry[0] - os.path.getsize(cached)
+        if gain > 0:
+            count += 1
+            saved += gain
+
+    buildops.mkdir(os.path.dirname(index_path))
+    with io.open(index_path, "w", encoding="utf-8") as fd:
+        json.dump(index, fd)
+
+    optimized_files = {}
+    for relative, source in files.items():
+        entry = index.get(source)
+        # only the copies made smaller replace their source
+        if entry and os.path.getsize(entry[3]) < entry[0]:
+            source = entry[3]
+        optimized_files[relative] = source
+    return optimized_files, AssetsResult(count, saved)
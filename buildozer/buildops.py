@@ -7,24 +7,39 @@ Changes to the system are logged.
 """
 
 import codecs
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import errno
 from glob import glob
+import hashlib
+import http.client
+import json
 import os
 from os.path import join, exists, realpath, expanduser
 from pathlib import Path
 import pexpect
 from queue import Queue, Empty
+import re
+import selectors
+import socket
 from sys import exit, stdout, stderr, platform
 from subprocess import Popen, PIPE
-from shutil import copyfile, rmtree, copytree, move, which
+from shutil import copyfile, copyfileobj, copystat, rmtree, move, which
 import shlex
+import stat
 import time
 import tarfile
-from threading import Thread
+from threading import Lock, Thread, local
+from urllib.error import HTTPError, URLError
 from urllib.request import Request, urlopen
 from zipfile import ZipFile
 
-from buildozer.exceptions import BuildozerCommandException
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from buildozer.exceptions import BuildozerCommandException, BuildozerException
 from buildozer.logger import Logger
 
 LOGGER = Logger()
@@ -108,6 +123,107 @@ def file_copy(source, target, cwd="."):
     copyfile(source, target)
 
 
+TAR_EXTENSIONS = (
+    ".tar", ".tgz", ".tar.gz", ".tbz2", ".tar.bz2", ".txz", ".tar.xz")
+
+
+def is_tar_archive(archive):
+    return str(archive).endswith(TAR_EXTENSIONS)
+
+
+def _tar_extractall(tar, cwd):
+    # The "tar" filter (Python 3.12+, and security backports) keeps the
+    # permissions and the symbolic links inside the archive, but refuses
+    # members escaping the destination.
+    if hasattr(tarfile, "tar_filter"):
+        tar.extractall(cwd, filter="tar")
+    else:
+        tar.extractall(cwd)
+
+
+def _zip_member_path(cwd, name):
+    parts = name.replace("\\", "/").split("/")
+    if name.startswith("/") or ".." in parts or ":" in parts[0]:
+        raise BuildozerException("Unsafe path in zip archive: {}".format(name))
+    return Path(cwd, name)
+
+
+def _zip_member_mode(info):
+    """Unix mode of a zip member, 0 if the archive doesn't have it."""
+    return info.external_attr >> 16
+
+
+def _zip_chmod(path, info):
+    mode = stat.S_IMODE(_zip_member_mode(info))
+    if mode and platform != "win32":
+        os.chmod(path, mode)
+
+
+def _extract_zip(path, cwd, workers=None):
+    """
+    Extract a zip archive into cwd, with a pool of threads.
+
+    Unlike ZipFile.extractall, the Unix permissions and the symbolic links
+    stored in the archive (in the high bits of external_attr) are restored,
+    as the Android NDK (for example) relies on them.
+    """
+    with ZipFile(path, "r") as archive:
+        dirs, files, links = [], [], []
+        for info in archive.infolist():
+            target = _zip_member_path(cwd, info.filename)
+            if info.is_dir():
+                dirs.append((target, info))
+            elif stat.S_ISLNK(_zip_member_mode(info)):
+                links.append((target, info))
+            else:
+                files.append((target, info))
+
+        parents = {target for target, _ in dirs}
+        parents.update(target.parent for target, _ in files + links)
+        for parent in parents:
+            parent.mkdir(parents=True, exist_ok=True)
+
+        # ZipFile reads are serialized on the underlying file: give each
+        # thread its own handle.
+        thread_state = local()
+        handles = []
+
+        def extract(member):
+            target, info = member
+            if not hasattr(thread_state, "archive"):
+                thread_state.archive = ZipFile(path, "r")
+                handles.append(thread_state.archive)
+            if target.is_symlink():
+                target.unlink()
+            with thread_state.archive.open(info) as in_file, \
+                    open(target, "wb") as out_file:
+                copyfileobj(in_file, out_file, DOWNLOAD_BLOCK_SIZE)
+            _zip_chmod(target, info)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in executor.map(extract, files):
+                    pass
+        finally:
+            for handle in handles:
+                handle.close()
+
+        for target, info in links:
+            link = archive.read(info).decode("utf-8")
+            if target.is_symlink() or target.exists():
+                target.unlink()
+            try:
+                os.symlink(link, target)
+            except OSError:
+                # No symbolic links (on Windows, without privileges): keep
+                # what ZipFile.extractall would have written.
+                target.write_text(link)
+
+    # Last, as directories may be read-only.
+    for target, info in sorted(dirs, key=lambda member: member[0], reverse=True):
+        _zip_chmod(target, info)
+
+
 def file_extract(archive, env, cwd="."):
     """
     Extract compressed files.
@@ -117,34 +233,15 @@ def file_extract(archive, env, cwd="."):
     """
     path = Path(cwd, archive)
 
-    if any(
-        str(archive).endswith(extension)
-        for extension in (".tgz", ".tar.gz", ".tbz2", ".tar.bz2")
-    ):
+    if is_tar_archive(archive):
         LOGGER.debug("Extracting {0} to {1}".format(archive, cwd))
         with tarfile.open(path, "r") as compressed_file:
-            compressed_file.extractall(cwd)
+            _tar_extractall(compressed_file, cwd)
         return
 
     if path.suffix == ".zip":
         LOGGER.debug("Extracting {0} to {1}".format(archive, cwd))
-        if platform == "win32":
-            # This won't work on Unix/OSX, because Android NDK (for example)
-            # relies on non-standard handling of file permissions and symbolic
-            # links that Python's zipfile doesn't support.
-            # Windows doesn't support them either.
-            with ZipFile(path, "r") as compressed_file:
-                compressed_file.extractall(cwd)
-            return
-        else:
-            # This won't work on Windows, because there is no unzip command
-            # there
-            return_code = cmd(
-                ["unzip", "-q", join(cwd, archive)], cwd=cwd, env=env
-            ).return_code
-            if return_code != 0:
-                raise BuildozerCommandException(
-                    "Unzip gave bad return code: {}".format(return_code))
+        _extract_zip(path, cwd)
         return
 
     if path.suffix == ".bin":
@@ -159,6 +256,127 @@ def file_extract(archive, env, cwd="."):
     raise ValueError("Unhandled extraction for type {0}".format(archive))
 
 
+# How file_copy_batch() copies the files:
+# - copy: plain copies;
+# - hardlink: hard links to the sources;
+# - reflink: copy-on-write clones, sharing the data blocks with the sources
+#   (btrfs, XFS, ...);
+# - auto: the first of reflink, hardlink and copy that works.
+# Hard links and reflinks are only possible on the same filesystem, and fall
+# back to plain copies otherwise.
+COPY_MODES = ("copy", "hardlink", "reflink", "auto")
+
+# ioctl cloning a file, from linux/fs.h
+FICLONE = 0x40049409
+
+# copy_file_range() errors meaning it can't be used for these files.
+COPY_FILE_RANGE_UNSUPPORTED = (
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def file_reflink(source, target):
+    """Clone source to target, sharing its data blocks until either is
+    modified. Raise OSError when the filesystem doesn't support it."""
+    if fcntl is None or not platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            target_file.close()
+            os.unlink(target)
+            raise
+    copystat(source, target)
+
+
+class _FileCopier:
+    """
+    Copy files according to one of COPY_MODES. When a mode fails (e.g.
+    across filesystems), the next one is used for the remaining files.
+    Safe to share between threads.
+    """
+
+    def __init__(self, mode="copy"):
+        if mode not in COPY_MODES:
+            raise ValueError("Unknown copy mode {!r}".format(mode))
+        self.modes = {
+            "copy": [],
+            "hardlink": ["hardlink"],
+            "reflink": ["reflink"],
+            "auto": ["reflink", "hardlink"],
+        }[mode]
+        self.copy_file_range = hasattr(os, "copy_file_range")
+
+    def copy(self, source, target):
+        for mode in list(self.modes):
+            try:
+                if mode == "reflink":
+                    file_reflink(source, target)
+                else:
+                    os.link(source, target)
+                return
+            except OSError as error:
+                LOGGER.debug("Cannot {} {} ({}), falling back".format(
+                    mode, source, error))
+                try:
+                    self.modes.remove(mode)
+                except ValueError:
+                    pass  # Already removed by another thread.
+        self._copy_data(source, target)
+        copystat(source, target)
+
+    def _copy_data(self, source, target):
+        # copy_file_range() copies in the kernel, or even on the server for
+        # network filesystems. shutil.copyfile() otherwise uses sendfile()
+        # or fcopyfile() where available.
+        if self.copy_file_range:
+            try:
+                _copy_file_range(source, target)
+                return
+            except OSError as error:
+                if error.errno not in COPY_FILE_RANGE_UNSUPPORTED:
+                    raise
+                LOGGER.debug("Cannot use copy_file_range ({}), falling "
+                             "back".format(error))
+                self.copy_file_range = False
+        copyfile(source, target)
+
+
+def _copy_file_range(source, target):
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        while os.copy_file_range(
+                source_file.fileno(), target_file.fileno(), 1 << 30):
+            pass
+
+
+def file_copy_batch(pairs, mode="copy", workers=None):
+    """
+    Copy many files at once, from a list of (source, target) pairs. Existing
+    targets are replaced.
+
+    The target directories are created first, once each, then the files are
+    copied by a pool of `workers` threads (by default, the
+    ThreadPoolExecutor default), which mostly helps on network filesystems,
+    where each file costs several round trips. The files are copied
+    according to mode, one of COPY_MODES, with their times.
+    """
+    pairs = [(Path(source), Path(target)) for source, target in pairs]
+    for directory in {target.parent for _, target in pairs}:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    copier = _FileCopier(mode)
+
+    def copy(pair):
+        source, target = pair
+        if target.is_symlink() or target.exists():
+            target.unlink()
+        copier.copy(source, target)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(copy, pairs):
+            pass
+
+
 def file_copytree(source, target):
     """
     Move an entire directory tree from source to target.
@@ -170,10 +388,160 @@ def file_copytree(source, target):
     target = Path(target)
 
     LOGGER.debug("copy {} to {}".format(source, target))
-    if source.is_dir():
-        copytree(source, target)
-    else:
+    if not source.is_dir():
         copyfile(source, target)
+        return
+
+    directories, pairs = [], []
+    for root, dirnames, filenames in os.walk(source, followlinks=True):
+        relative_root = Path(root).relative_to(source)
+        directories.extend(
+            target / relative_root / dirname for dirname in dirnames)
+        pairs.extend(
+            (Path(root, filename), target / relative_root / filename)
+            for filename in filenames)
+    # Like shutil.copytree(), refuse an existing target.
+    target.mkdir(parents=True)
+    for directory in directories:
+        directory.mkdir(parents=True, exist_ok=True)
+    file_copy_batch(pairs)
+
+
+SyncResult = namedtuple("SyncResult", "copied removed unchanged")
+
+
+def _sync_entry(source, source_stat, target, entry, checksum):
+    """
+    Return the updated manifest entry of target if it is still a copy of
+    the source, None if the source must be copied again.
+
+    Entries are [size, source mtime, target mtime, sha256 or None].
+    """
+    if entry is None:
+        return None
+    size, source_mtime, target_mtime, digest = entry
+    try:
+        target_stat = os.stat(target)
+    except OSError:
+        return None
+    if (target_stat.st_size, target_stat.st_mtime_ns) != (size, target_mtime):
+        return None  # Modified since the last sync.
+    if source_stat.st_size != size:
+        return None
+    if source_stat.st_mtime_ns == source_mtime:
+        return entry
+    if not checksum:
+        return None
+    # Touched, but maybe not modified (e.g. by a VCS checkout).
+    if digest is None:
+        digest = file_sha256(target)
+    if file_sha256(source) != digest:
+        return None
+    return [size, source_stat.st_mtime_ns, target_mtime, digest]
+
+
+def file_sync(files, target, manifest, checksum=False, mode="copy"):
+    """
+    Make the target directory a copy of files, a dict of
+    {relative path: source path}, like rsync would: only the files that
+    changed since the last sync are copied (preserving their times), and
+    the files that were synced before but aren't in files anymore are
+    removed, as are the directories in the way of files, and the files in
+    the way of directories.
+
+    The manifest file records the state of the synced files. Without it,
+    the target directory is emptied first, as its content is unknown.
+
+    Files are compared by size and modification time, and if checksum is
+    true, by content when only the modification time differs. They are
+    copied with file_copy_batch(), according to mode, one of COPY_MODES:
+    with links, the target files must be replaced rather than modified.
+    The sources of several paths (the same file, or hard links) are never
+    hard linked, so no two target files share an inode: archivers such as
+    tarfile store the others as links, which not every extractor supports.
+
+    Returns a SyncResult with the number of copied, removed and unchanged
+    files.
+    """
+    target = Path(target)
+    manifest = Path(manifest)
+    try:
+        previous = json.loads(manifest.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        previous = None
+    if previous is None:
+        rmdir(target)
+        previous = {}
+    target.mkdir(parents=True, exist_ok=True)
+
+    current = {}
+    copies = []
+    inodes = Counter()
+    for relative, source in files.items():
+        source_stat = os.stat(source)
+        inodes[source_stat.st_dev, source_stat.st_ino] += 1
+        entry = _sync_entry(
+            source, source_stat, target / relative, previous.get(relative),
+            checksum)
+        if entry is None:
+            copies.append((relative, source, source_stat))
+        else:
+            current[relative] = entry
+
+    LOGGER.debug("Sync {} files to {}: {} changed".format(
+        len(files), target, len(copies)))
+    # The removed files go first, they may be in the way of the copies.
+    removed = [relative for relative in previous if relative not in files]
+    parents = set()
+    for relative in removed:
+        path = target / relative
+        if path.is_symlink() or path.is_file():
+            path.unlink()
+        parents.update(path.parents)
+    # Remove the directories left empty, deepest first.
+    for directory in sorted(parents, key=lambda path: len(path.parts),
+                            reverse=True):
+        if directory != target and target in directory.parents:
+            try:
+                directory.rmdir()
+            except OSError:
+                pass
+    # A file may have become a directory, or the other way around.
+    for relative, _, _ in copies:
+        path = target / relative
+        if path.is_dir() and not path.is_symlink():
+            rmtree(path)
+        for parent in path.parents:
+            if parent == target:
+                break
+            if (parent.is_symlink() or parent.exists()) and not parent.is_dir():
+                parent.unlink()
+
+    shared = [
+        inodes[source_stat.st_dev, source_stat.st_ino] > 1
+        for _, _, source_stat in copies]
+    file_copy_batch(
+        [(source, target / relative)
+         for (relative, source, _), is_shared in zip(copies, shared)
+         if not is_shared],
+        mode=mode)
+    file_copy_batch(
+        [(source, target / relative)
+         for (relative, source, _), is_shared in zip(copies, shared)
+         if is_shared],
+        mode={"hardlink": "copy", "auto": "reflink"}.get(mode, mode))
+    for relative, source, source_stat in copies:
+        current[relative] = [
+            source_stat.st_size, source_stat.st_mtime_ns,
+            os.stat(target / relative).st_mtime_ns, None]
+
+    manifest.parent.mkdir(parents=True, exist_ok=True)
+    manifest_tmp = manifest.with_name(manifest.name + ".tmp")
+    manifest_tmp.write_text(json.dumps(current), encoding="utf-8")
+    manifest_tmp.replace(manifest)
+
+    return SyncResult(
+        len(copies), len(removed), len(files) - len(copies))
 
 
 class _StreamReader:
@@ -245,6 +613,176 @@ class _StreamReader:
 
 CommandResult = namedtuple("CommandResult", "stdout stderr return_code")
 
+# Size of the reads done on the pipes of a subprocess.
+PIPE_READ_SIZE = 64 * 1024
+
+# How much of a spilled command output is kept in memory, for error reports.
+OUTPUT_TAIL_SIZE = 1024 * 1024  # 1 MB
+
+
+class CommandOutput:
+    """
+    Output of a command, spilled to a log file as it is produced.
+
+    Only the last `tail_size` bytes are kept in memory, to report errors. The
+    complete output is read back from the log file when asked for, either at
+    once (`read()`) or line by line (iterating over the instance).
+    """
+
+    def __init__(self, path, tail_size=OUTPUT_TAIL_SIZE):
+        self.path = Path(path)
+        self.tail_size = tail_size
+        self.size = 0
+        self._tail = bytearray()
+        self._file = open(self.path, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+        self._tail += data
+        if len(self._tail) > self.tail_size:
+            del self._tail[:-self.tail_size]
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def tail(self):
+        """The last bytes of the output, as text."""
+        return self._tail.decode("utf-8", "ignore")
+
+    def read(self):
+        """Return the complete output, as text."""
+        with open(self.path, "rb") as fd:
+            return fd.read().decode("utf-8", "ignore")
+
+    def __iter__(self):
+        with open(self.path, encoding="utf-8", errors="ignore") as fd:
+            for line in fd:
+                yield line.rstrip("\n")
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __str__(self):
+        return self.read()
+
+    def __repr__(self):
+        return "<CommandOutput {} ({} bytes)>".format(self.path, self.size)
+
+
+def _spill_output(output_dir, command, pid, stream):
+    """Create the CommandOutput for one stream of a command."""
+    mkdir(output_dir)
+    name = "{}-{}-{}.{}.log".format(
+        time.strftime("%Y%m%d-%H%M%S"),
+        pid,
+        re.sub(r"[^a-zA-Z0-9_\-.]", "_", Path(command[0]).name),
+        stream,
+    )
+    return CommandOutput(Path(output_dir, name))
+
+
+def _pump_threads(process, run_condition):
+    """
+    Yield (stdout_data, stderr_data) tuples as the process produces output,
+    one of them being None.
+
+    Uses a thread per stream, polling once per second. This is the fallback
+    for platforms (i.e. Windows) where pipes can't be waited on with select.
+    """
+    reader = _StreamReader(process.stdout, process.stderr)
+    while True:
+        item = reader.read(timeout=1)
+        if item:
+            yield item
+        elif process.poll() is not None:
+            # process has completed.
+            break
+        elif run_condition and not run_condition():
+            # time to terminate the process.
+            process.terminate()
+            # keep looping to get the rest of the output.
+
+
+def _open_pidfd(process):
+    """Return a file descriptor that becomes readable when the process exits,
+    or None if the platform doesn't support it."""
+    pidfd_open = getattr(os, "pidfd_open", None)
+    if pidfd_open is None:
+        return None
+    try:
+        return pidfd_open(process.pid)
+    except OSError:
+        return None
+
+
+def _pump_selector(process, run_condition):
+    """
+    Yield (stdout_data, stderr_data) tuples as the process produces output,
+    one of them being None.
+
+    Blocks in select() until there is output, the pipes are closed or the
+    process exits, so no time is lost polling. POSIX only.
+
+    If a run_condition is given, it is still polled once per second.
+    """
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, "out")
+    selector.register(process.stderr, selectors.EVENT_READ, "err")
+
+    # Children of the process may keep the pipes open after it exited, so
+    # also wait on the process itself. Without pidfd support, fall back to
+    # checking it every second.
+    pidfd = _open_pidfd(process)
+    if pidfd is not None:
+        selector.register(pidfd, selectors.EVENT_READ, "exit")
+    timeout = 1 if run_condition or pidfd is None else None
+
+    open_pipes = 2
+    exited = False
+    try:
+        while open_pipes:
+            events = selector.select(0 if exited else timeout)
+            if not events and exited:
+                # Everything written before the exit has been read.
+                break
+            for key, _ in events:
+                if key.data == "exit":
+                    selector.unregister(pidfd)
+                    exited = True
+                    continue
+                data = os.read(key.fd, PIPE_READ_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    open_pipes -= 1
+                elif key.data == "out":
+                    yield data, None
+                else:
+                    yield None, data
+            if not events and pidfd is None and process.poll() is not None:
+                exited = True
+            if run_condition and not exited and not run_condition():
+                # time to terminate the process.
+                process.terminate()
+                # keep looping to get the rest of the output.
+                run_condition = None
+    finally:
+        selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
+    process.wait()
+
+
+def _select_pump(process):
+    """Choose how to read the output of the process."""
+    streams = (process.stdout, process.stderr)
+    if platform == "win32" or not all(
+        hasattr(stream, "fileno") for stream in streams
+    ):
+        return _pump_threads
+    return _pump_selector
+
 
 def cmd(
     command,
@@ -256,6 +794,7 @@ def cmd(
     run_condition=None,
     show_output=None,
     quiet=False,
+    output_dir=None,
 ) -> CommandResult:
     """run a command as a subprocess, with the ability to display progress
     and to abort the process early.
@@ -281,6 +820,10 @@ def cmd(
     quiet parameter reduces logging; useful to keep passwords in command lines
     out of the log.
 
+    If output_dir is set, the stdout and stderr requested by get_stdout and
+    get_stderr are not accumulated in memory, but written to log files in
+    that directory, and returned as CommandOutput instances.
+
     The env parameter is deliberately not optional, to ensure it is considered
     during the migration to use this library. Once completed, it can return
     to having a default of None.
@@ -297,6 +840,7 @@ def cmd(
         LOGGER.debug("Run {0!r} ...".format(" ".join(command)))
         LOGGER.debug("Cwd {}".format(cwd))
 
+    start_time = time.monotonic()
     process = Popen(
         command,
         env=env,
@@ -305,34 +849,63 @@ def cmd(
         close_fds=True,
         cwd=cwd,
     )
+    spawn_time = time.monotonic() - start_time
 
-    reader = _StreamReader(process.stdout, process.stderr)
+    pump = _select_pump(process)
 
-    ret_stdout = [] if get_stdout else None
-    ret_stderr = [] if get_stderr else None
-    while True:
-        item = reader.read(timeout=1)
-        if item:
-            stdout_line, stderr_line = item
+    if output_dir is None:
+        ret_stdout = [] if get_stdout else None
+        ret_stderr = [] if get_stderr else None
+        add_stdout = get_stdout and ret_stdout.append
+        add_stderr = get_stderr and ret_stderr.append
+    else:
+        ret_stdout = (
+            _spill_output(output_dir, command, process.pid, "stdout")
+            if get_stdout else None)
+        ret_stderr = (
+            _spill_output(output_dir, command, process.pid, "stderr")
+            if get_stderr else None)
+        add_stdout = get_stdout and ret_stdout.write
+        add_stderr = get_stderr and ret_stderr.write
+
+    wakeups = 0
+    try:
+        for stdout_line, stderr_line in pump(process, run_condition):
+            wakeups += 1
             if stdout_line:
-                if get_stdout:
-                    ret_stdout.append(stdout_line)
+                if add_stdout:
+                    add_stdout(stdout_line)
                 if show_output:
                     stdout.write(stdout_line.decode("utf-8", "replace"))
                     stdout.flush()
             if stderr_line:
-                if get_stderr:
-                    ret_stderr.append(stderr_line)
+                if add_stderr:
+                    add_stderr(stderr_line)
                 if show_output:
                     stderr.write(stderr_line.decode("utf-8", "replace"))
                     stderr.flush()
-        elif process.poll() is not None:
-            # process has completed.
-            break
-        elif run_condition and not run_condition():
-            # time to terminate the process.
-            process.terminate()
-            # keep looping to get the rest of the output.
+    finally:
+        if output_dir is not None:
+            for output in (ret_stdout, ret_stderr):
+                if output is not None:
+                    output.close()
+
+    if not quiet:
+        LOGGER.debug(
+            "Command finished in {:.3f}s (spawn {:.3f}s, {} output wakeups, "
+            "{})".format(
+                time.monotonic() - start_time,
+                spawn_time,
+                wakeups,
+                pump.__name__.replace("_pump_", "") + " pump",
+            )
+        )
+
+    if output_dir is not None:
+        if process.returncode != 0 and break_on_error:
+            spilled = [] if show_output else [ret_stdout, ret_stderr]
+            _command_fail(command, env, process.returncode, spilled)
+        return CommandResult(ret_stdout, ret_stderr, process.returncode)
 
     if process.returncode != 0 and break_on_error:
         _command_fail(command, env, process.returncode)
@@ -343,9 +916,16 @@ def cmd(
     return CommandResult(ret_stdout, ret_stderr, process.returncode)
 
 
-def _command_fail(command, env, returncode):
+def _command_fail(command, env, returncode, outputs=()):
     LOGGER.error("Command failed: {0}".format(command))
     LOGGER.error("Error code: {0}".format(returncode))
+    for output in outputs:
+        if not output:
+            continue
+        LOGGER.error("Last output of the command (full log in {}):".format(
+            output.path))
+        for line in output.tail.splitlines():
+            LOGGER.error("    {}".format(line))
     LOGGER.log_env(LOGGER.ERROR, env)
     LOGGER.error("")
     LOGGER.error("Buildozer failed to execute the last command")
@@ -384,6 +964,23 @@ def cmd_expect(command, env, **kwargs):
     return pexpect.spawn(shlex.join(command), env=env, encoding="utf-8", **kwargs)
 
 
+# Download tuning. Retries are delayed by DOWNLOAD_BACKOFF seconds, doubled
+# after each failed attempt.
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024  # 1 MB
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 2
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/28.0.1500.71 Safari/537.36"
+)
+
+# The network errors worth retrying (with HTTP errors >= 500). The local
+# errors, such as a full disk, would fail again.
+DOWNLOAD_TRANSIENT_ERRORS = (
+    URLError, ConnectionError, socket.timeout, http.client.IncompleteRead)
+
+
 def _report_download_progress(bytes_read, total_size):
     if total_size <= 0:  # Sometimes we don't get told.
         progression = "{0} bytes".format(bytes_read)
@@ -395,38 +992,353 @@ def _report_download_progress(bytes_read, total_size):
         stdout.flush()
 
 
-def download(url, filename, cwd=None):
-    """Download the file at url/filename to filename"""
-    url = url + str(filename)
+class _DownloadProgress:
+    """Progress of a download, possibly shared by several threads."""
 
-    LOGGER.debug("Downloading {0}".format(url))
+    def __init__(self, total_size=0):
+        self.total_size = total_size
+        self.bytes_read = 0
+        self._lock = Lock()
 
-    if cwd:
-        filename = join(cwd, filename)
-    file_remove(filename)
+    def add(self, count):
+        with self._lock:
+            self.bytes_read += count
+            _report_download_progress(self.bytes_read, self.total_size)
 
-    request = Request(
-        url,
-        headers={
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-            "(KHTML, like Gecko) Chrome/28.0.1500.71 Safari/537.36"
-        },
-    )
 
-    with urlopen(request) as response:
-        total_size = int(response.headers.get("Content-Length", 0))
-        block_size = 1024 * 1024  # 1 MB
-        bytes_read = 0
+def _download_request(url, method="GET", start=0, end=None, validator=None):
+    headers = {"User-Agent": DOWNLOAD_USER_AGENT}
+    if start or end is not None:
+        headers["Range"] = "bytes={}-{}".format(
+            start, "" if end is None else end)
+        if validator:
+            # The server sends the whole file if it changed since.
+            headers["If-Range"] = validator
+    return Request(url, headers=headers, method=method)
 
-        with open(filename, "wb") as out_file:
+
+def _download_validator(response):
+    """Return the value identifying the version of the file sent in
+    response, for If-Range: its strong ETag or its Last-Modified date."""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def _download_probe(url):
+    """Return (size, accept_ranges) for the file at url."""
+    try:
+        response = urlopen(
+            _download_request(url, method="HEAD"), timeout=DOWNLOAD_TIMEOUT)
+    except HTTPError:
+        # Some servers refuse HEAD requests, assume the worst.
+        return 0, False
+    with response:
+        size = int(response.headers.get("Content-Length", 0))
+        accept_ranges = response.headers.get("Accept-Ranges", "") == "bytes"
+    return size, accept_ranges
+
+
+def _download_range(url, part_path, progress, start=0, end=None):
+    """
+    Download the bytes start to end (inclusive, None meaning up to the end of
+    the file) of url into part_path.
+
+    If part_path already holds the beginning of the range, only the remainder
+    is requested, provided the file didn't change on the server since: the
+    version of the file is kept in part_path.validator for If-Range.
+    """
+    part_path = Path(part_path)
+    validator_path = Path("{}.validator".format(part_path))
+    validator = (
+        validator_path.read_text(encoding="utf-8")
+        if validator_path.exists() else None)
+    # Without a validator, the part may come from another version.
+    done = part_path.stat().st_size if part_path.exists() and validator else 0
+    if end is not None and start + done > end:
+        return  # Already complete.
+
+    try:
+        response = urlopen(
+            _download_request(
+                url, start=start + done, end=end,
+                validator=validator if done else None),
+            timeout=DOWNLOAD_TIMEOUT)
+    except HTTPError as error:
+        if error.code == 416 and done and end is None:
+            # Range not satisfiable: nothing left to get.
+            return
+        raise
+
+    with response:
+        mode = "ab" if done else "wb"
+        if start + done and response.status != 206:
+            # The server ignored the Range header, or the file changed:
+            # start over.
+            if start:
+                file_remove(part_path)
+                file_remove(validator_path)
+                raise URLError("Cannot resume the range {}-{} of {}".format(
+                    start, end, url))
+            LOGGER.debug("Cannot resume download of {}, restarting".format(url))
+            mode = "wb"
+            done = 0
+        elif done:
+            LOGGER.debug("Resuming download of {} at byte {}".format(
+                url, start + done))
+        if not done:
+            validator = _download_validator(response)
+            if validator:
+                validator_path.write_text(validator, encoding="utf-8")
+            else:
+                file_remove(validator_path)
+        if not progress.total_size and end is None:
+            # The total size, from "bytes start-end/total" when resuming.
+            content_range = response.headers.get("Content-Range", "")
+            total = content_range.rpartition("/")[2]
+            if response.status == 206 and total.isdigit():
+                progress.total_size = int(total)
+            elif response.status != 206:
+                progress.total_size = int(
+                    response.headers.get("Content-Length", 0))
+        progress.add(done)
+
+        expected = int(response.headers.get("Content-Length", -1))
+        received = 0
+        with open(part_path, mode) as out_file:
             # Read in blocks, so we can give a progress bar.
             while True:
-                block = response.read(block_size)
+                block = response.read(DOWNLOAD_BLOCK_SIZE)
                 if not block:
                     break
                 out_file.write(block)
-                bytes_read += len(block)
+                received += len(block)
+                progress.add(len(block))
+
+    if 0 <= expected != received:
+        raise ConnectionError(
+            "Connection closed after {} of {} bytes".format(received, expected))
+
+
+def _download_parallel(url, part_path, progress, size, connections):
+    """
+    Download url into part_path with several connections, each fetching a
+    range of the file into its own segment file. Segments are resumable
+    individually, and appended to part_path once all are complete.
+    """
+    chunk_size = -(-size // connections)
+    segments = [
+        (Path("{}.{}".format(part_path, index)), start,
+         min(start + chunk_size, size) - 1)
+        for index, start in enumerate(range(0, size, chunk_size))
+    ]
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [
+            executor.submit(_download_range, url, segment, progress, start, end)
+            for segment, start, end in segments
+        ]
+        for future in futures:
+            future.result()
+
+    with open(part_path, "wb") as out_file:
+        for segment, _, _ in segments:
+            with open(segment, "rb") as in_file:
+                copyfileobj(in_file, out_file, DOWNLOAD_BLOCK_SIZE)
+    for segment, _, _ in segments:
+        segment.unlink()
+        file_remove("{}.validator".format(segment))
+
+
+def file_sha256(path):
+    """Return the hex sha256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(DOWNLOAD_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tree_fingerprint(path):
+    """Return a hex digest that changes whenever a file is added, removed or
+    modified under path (a directory or a single file).
+
+    Only the names, sizes and modification times are hashed, not the
+    content, so large trees are fingerprinted quickly.
+    """
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        st = os.stat(path)
+        digest.update("{}:{}".format(st.st_size, st.st_mtime_ns).encode())
+        return digest.hexdigest()
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs.sort()
+        for fn in sorted(files):
+            full_path = join(root, fn)
+            try:
+                st = os.stat(full_path)
+            except OSError:  # dangling symlink
+                continue
+            digest.update("{}:{}:{}\n".format(
+                os.path.relpath(full_path, path), st.st_size,
+                st.st_mtime_ns).encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def _download_retrying(url, retries, attempt):
+    """Call attempt(), retrying it `retries` times on transient errors."""
+    for count in range(retries + 1):
+        try:
+            return attempt()
+        except DOWNLOAD_TRANSIENT_ERRORS as error:
+            if isinstance(error, HTTPError) and error.code < 500:
+                raise
+            if count == retries:
+                raise
+            delay = DOWNLOAD_BACKOFF * 2 ** count
+            LOGGER.info("Download of {} failed ({}), retrying in {}s".format(
+                url, error, delay))
+            time.sleep(delay)
+
+
+class _DownloadReader:
+    """
+    File-like view of a download response, hashing (and optionally saving)
+    the data as it is consumed. A truncated response raises ConnectionError.
+    """
+
+    def __init__(self, response, progress, save_file=None):
+        self.response = response
+        self.progress = progress
+        self.save_file = save_file
+        self.expected = int(response.headers.get("Content-Length", -1))
+        self.received = 0
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        try:
+            block = self.response.read(None if size < 0 else size)
+        except http.client.IncompleteRead as error:
+            raise ConnectionError(str(error))
+        if not block and 0 <= self.expected != self.received:
+            raise ConnectionError(
+                "Connection closed after {} of {} bytes".format(
+                    self.received, self.expected))
+        self.received += len(block)
+        self.digest.update(block)
+        if self.save_file is not None:
+            self.save_file.write(block)
+        self.progress.add(len(block))
+        return block
+
+    def drain(self):
+        while self.read(DOWNLOAD_BLOCK_SIZE):
+            pass
+
+
+def download_extract(
+    url,
+    filename,
+    cwd=".",
+    sha256=None,
+    save_to=None,
+    retries=DOWNLOAD_RETRIES,
+):
+    """Download the tar archive at url/filename and extract it into cwd while
+    it is received, without storing the archive first.
+
+    If save_to is given, the archive is also written to that path (e.g. to
+    cache it). Failed attempts are restarted from scratch, `retries` times.
+
+    The checksum can only be verified after the extraction: on mismatch, a
+    BuildozerException is raised and save_to is deleted, but the extracted
+    files are left in cwd.
+
+    Returns the hex sha256 digest of the archive.
+    """
+    assert is_tar_archive(filename), filename
+    url = url + str(filename)
+    LOGGER.debug("Downloading and extracting {0} to {1}".format(url, cwd))
+
+    def attempt():
+        response = urlopen(_download_request(url), timeout=DOWNLOAD_TIMEOUT)
+        save_file = open(save_to, "wb") if save_to else None
+        try:
+            with response:
+                progress = _DownloadProgress(
+                    int(response.headers.get("Content-Length", 0)))
+                reader = _DownloadReader(response, progress, save_file)
+                with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                    _tar_extractall(tar, cwd)
+                # Padding after the end of the archive is part of the file.
+                reader.drain()
+        finally:
+            if save_file is not None:
+                save_file.close()
+        return reader.digest.hexdigest()
+
+    digest = _download_retrying(url, retries, attempt)
+
+    if sha256 is not None and digest != sha256.lower():
+        if save_to:
+            file_remove(save_to)
+        raise BuildozerException(
+            "Checksum mismatch for {}: expected sha256 {}, got {}".format(
+                url, sha256, digest))
+    return digest
+
+
+def download(
+    url,
+    filename,
+    cwd=None,
+    sha256=None,
+    retries=DOWNLOAD_RETRIES,
+    connections=1,
+):
+    """Download the file at url/filename to filename
+
+    The data is first written to filename.part, which is kept when the
+    download fails, so the next attempt resumes it (using HTTP Range
+    requests).
+
+    Failed attempts are retried `retries` times, with an exponential backoff.
+
+    If connections is more than 1, and the server supports ranges, the file
+    is fetched in that many parallel ranges.
+
+    If sha256 is given, the downloaded file is checked against it, and a
+    BuildozerException is raised on mismatch.
+    """
+    url = url + str(filename)
+
+    LOGGER.debug("Downloading {0}".format(url))
+
+    if cwd:
+        filename = join(cwd, filename)
+    file_remove(filename)
+    part_path = Path("{}.part".format(filename))
+
+    def attempt():
+        size, accept_ranges = 0, False
+        if connections > 1:
+            size, accept_ranges = _download_probe(url)
+        progress = _DownloadProgress(size)
+        if accept_ranges and size > connections * DOWNLOAD_BLOCK_SIZE:
+            _download_parallel(url, part_path, progress, size, connections)
+        else:
+            _download_range(url, part_path, progress)
+
+    _download_retrying(url, retries, attempt)
 
-                _report_download_progress(bytes_read, total_size)
+    if sha256 is not None:
+        digest = file_sha256(part_path)
+        if digest != sha256.lower():
+            part_path.unlink()
+            raise BuildozerException(
+                "Checksum mismatch for {}: expected sha256 {}, got {}".format(
+                    url, sha256, digest))
 
+    part_path.replace(filename)
+    file_remove("{}.validator".format(part_path))
     return filename
@@ -0,0 +1,110 @@
+"""
+Byte-compilation of the application on the host, before packaging.
+
+The sources are compiled by an interpreter of the Python version of the
+target, at the optimization level the target runs with, into the legacy
+layout (module.pyc next to module.py), as python-for-android does: the
+package ships the pycs without the sources, which the device then imports
+without compiling anything. A manifest records the hash of every compiled
+source, so only the new and changed modules are compiled again.
+"""
+
+__all__ = ["precompile"]
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
+from os.path import dirname, exists, join
+
+import buildozer.buildops as buildops
+from buildozer.logger import Logger
+
+LOGGER = Logger()
+
+# Number of modules compiled by one compileall process, at least.
+CHUNK_SIZE = 64
+
+
+def _pyc_path(source):
+    return source + "c"
+
+
+def _sources(directories):
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [fn for fn in dirs if fn != "__pycache__"]
+            for fn in files:
+                if fn.endswith(".py"):
+                    yield join(root, fn)
+
+
+def precompile(python, directories, manifest_path, env, optimize=0,
+               workers=None):
+    """Compile the modules of directories with the interpreter python, at
+    the optimize level (as python -O), across a pool of workers processes
+    (by default, one per CPU).
+
+    Returns the (compiled, unchanged) numbers of modules.
+    """
+    cache_tag = buildops.cmd(
+        [python, "-c", "import sys; print(sys.implementation.cache_tag)"],
+        env=env, get_stdout=True, quiet=True).stdout.strip()
+
+    try:
+        with io.open(manifest_path, encoding="utf-8") as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError):
+        manifest = {}
+    previous = {}
+    if (manifest.get("python"), manifest.get("cache_tag"),
+            manifest.get("optimize")) == (python, cache_tag, optimize):
+        previous = manifest["sources"]
+
+    current = {}
+    changed = []
+    for source in _sources(directories):
+        digest = buildops.file_sha256(source)
+        current[source] = digest
+        if previous.get(source) != digest or not exists(_pyc_path(source)):
+            changed.append(source)
+
+    # the pycs of the removed modules would still be imported
+    for source in manifest.get("sources", {}):
+        if source not in current:
+            buildops.file_remove(_pyc_path(source))
+
+    if changed:
+        workers = workers or os.cpu_count() or 1
+        size = max(CHUNK_SIZE, -(-len(changed) // workers))
+        chunks = [changed[i:i + size] for i in range(0, len(changed), size)]
+        LOGGER.debug("Compile {} modules with {} processes".format(
+            len(changed), len(chunks)))
+
+        def compile_chunk(args):
+            index, chunk = args
+            list_path = "{}.{}.list".format(manifest_path, index)
+            with io.open(list_path, "w", encoding="utf-8") as fd:
+                fd.writelines(source + "\n" for source in chunk)
+            try:
+                buildops.cmd(
+                    [python, "-m", "compileall", "-q", "-f", "-b",
+                     "-o", str(optimize),
+                     "--invalidation-mode", "unchecked-hash", "-i", list_path],
+                    env=env)
+            finally:
+                buildops.file_remove(list_path)
+
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            for _ in executor.map(compile_chunk, enumerate(chunks)):
+                pass
+
+    buildops.mkdir(dirname(manifest_path))
+    with io.open(manifest_path, "w", encoding="utf-8") as fd:
+        json.dump({
+            "python": python,
+            "cache_tag": cache_tag,
+            "optimize": optimize,
+            "sources": current,
+        }, fd)
+    return len(changed), len(current) - len(changed)
@@ -33,6 +33,17 @@ source.include_exts = py,png,jpg,kv,atlas
 # Do not prefix with './'
 #source.exclude_patterns = license,images/*/*.jpg
 
+# (bool) Compare the content of the source files whose modification time
+# changed since the last build, so touched but unmodified files aren't copied
+#source.sync_checksum = False
+
+# (str) How the application files are copied to the build directory:
+# copy, hardlink, reflink (copy-on-write clones, on btrfs, XFS, ...) or auto
+# (the first of reflink, hardlink and copy that works). Links need the
+# sources and the build directory on the same filesystem, and fall back to
+# copies otherwise.
+#copy_mode = copy
+
 # (str) Application versioning (method 1)
 version = 0.1
 
@@ -44,10 +55,26 @@ version = 0.1
 # comma separated e.g. requirements = sqlite3,kivy
 requirements = python3,kivy
 
+# (str) Lock file pinning the versions of the requirements installed with pip
+# (the ones without a recipe for the target), relative to this file. It is
+# generated if missing.
+# requirements.lockfile = requirements.lock
+
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
 # requirements.source.kivy = ../../kivy
 
+# (bool) Byte-compile the application and its requirements on the host,
+# in parallel, before packaging: only the changed modules are compiled again.
+# As with python-for-android, the package ships the pycs, compiled at the
+# optimization level of the app, instead of the sources (with the android
+# target, python-for-android doesn't byte-compile them then)
+# bytecode.precompile = False
+
+# (str) Python interpreter of the Python version of the target used to
+# precompile, the one built by python-for-android by default
+# bytecode.python =
+
 # (str) Presplash of the application
 #presplash.filename = %(source.dir)s/data/presplash.png
 
@@ -226,6 +253,19 @@ fullscreen = 0
 # e.g. android.gradle_repositories = "maven { url 'https://kotlin.bintray.com/ktor' }"
 #android.add_gradle_repositories =
 
+# (bool) Use the Gradle daemon (defaults to Gradle's own setting)
+#android.gradle.daemon = True
+
+# (bool) Build the independent Gradle modules in parallel
+#android.gradle.parallel = True
+
+# (str) JVM arguments of the Gradle daemon
+#android.gradle.jvmargs = -Xmx4g
+
+# (str) Directory of the Gradle build cache, to share it between the
+# projects, e.g. in the global buildozer cache (disabled by default)
+#android.gradle.build_cache_dir = ~/.buildozer/cache/gradle-build-cache
+
 # (list) packaging options to add 
 # see https://google.github.io/android-gradle-dsl/current/com.android.build.gradle.internal.dsl.PackagingOptions.html
 # can be necessary to solve conflicts in gradle_dependencies
@@ -422,6 +462,52 @@ warn_on_root = 1
 # (str) Path to build output (i.e. .apk, .aab, .ipa) storage
 # bin_dir = ./bin
 
+# (str) Maximum size of the global download cache (SDK, NDK, ... archives),
+# the least recently used archives are removed beyond it.
+# Manage it with `buildozer cache ls|prune [size]|verify`
+# download_cache_size = 20G
+
+# (bool) Install the requirements only from the wheels already in the global
+# wheel cache (for offline builders)
+# pip_offline = False
+
+# (str) Virtualenv running pip for the requirements: local (in the .buildozer
+# directory of the project), shared (by the projects using the same Python
+# version, in ~/.buildozer/venv) or none (the Python running buildozer)
+# venv = local
+
+# (str) Maximum size of the global git cache (used when the USE_GIT_CACHING
+# environment variable is set), the least recently used repositories are
+# removed beyond it. Manage it with `buildozer cache git ls|prune [size]|verify`
+# git_cache_size = 10G
+
+# (str) Storage of the build state: json (a state.db JSON file) or sqlite
+# (state.sqlite, only the changed values are written, and their history is
+# kept; the state.db content is imported on the first use)
+# state_backend = json
+
+
+[assets]
+
+# Lossless optimizers of the application files, by extension, run on a copy
+# of each file before packaging: {} is replaced by the path of the file to
+# optimize in place. The results are cached by content in the global cache,
+# so each file is optimized once.
+# png = optipng -quiet -strip all -o2 {}
+# jpg = jpegoptim --quiet --strip-all {}
+
+
+[hooks]
+
+# Commands to run before (pre_) and after (post_) each stage of a build:
+# check_requirements, install_platform, check_application_requirements,
+# compile_platform, build_application and build_package. They run in the
+# directory of this file, with BUILDOZER_HOOK, BUILDOZER_TARGET,
+# BUILDOZER_BUILD_MODE, BUILDOZER_APP_DIR and BUILDOZER_BIN_DIR set in their
+# environment. A failing hook aborts the build.
+# pre_build_application = ./scripts/generate_assets.sh
+# post_build_package = ./scripts/upload.sh
+
 #-----------------------------------------------------------------------------
 #   Notes about using this file:
 #
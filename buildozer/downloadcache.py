@@ -0,0 +1,273 @@
+"""
+Content-addressed cache for downloaded archives.
+
+The cache lives in the global buildozer directory, so it is shared by all
+the projects and targets of a machine (or of several machines mounting the
+same directory). Each archive is stored once, named after the sha256 digest
+of its content. An index maps the URLs to these digests, and records the size
+and the last use of every entry, so the least recently used archives can be
+evicted when the cache grows over its budget.
+
+The downloads in progress are kept in a partial directory per URL, locked
+while in use, so the builds sharing the cache download each URL once.
+"""
+
+__all__ = ["DownloadCache", "parse_size", "format_size"]
+
+from contextlib import contextmanager
+from hashlib import sha1
+import os
+from os.path import join, exists, getsize
+import re
+import time
+
+import buildozer.buildops as buildops
+from buildozer.exceptions import BuildozerException
+from buildozer.jsonstore import JsonStore
+from buildozer.logger import Logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOGGER = Logger()
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """Parse a size such as 500M or 20G into a number of bytes."""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", str(value).upper())
+    if not match:
+        raise BuildozerException("Invalid size: {}".format(value))
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def format_size(size):
+    for unit in ("", "K", "M", "G"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "T"
+    return "{:.1f}{}".format(size, unit) if unit else "{}B".format(int(size))
+
+
+class DownloadCache:
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.blobs_dir = join(cache_dir, "blobs")
+        self.partial_dir = join(cache_dir, "partial")
+        buildops.mkdir(self.blobs_dir)
+        self.index = JsonStore(join(cache_dir, "index.json"))
+
+    def blob_path(self, digest):
+        return join(self.blobs_dir, digest)
+
+    def fetch(self, url, filename, cwd=None, sha256=None, **kwargs):
+        """Same as :func:`buildops.download`, but served from the cache when
+        the file at url/filename was already downloaded (and matches sha256,
+        if given). Other arguments are passed to :func:`buildops.download`.
+
+        Returns the path of the file in cwd.
+        """
+        full_url = url + str(filename)
+        target = join(cwd, filename) if cwd else str(filename)
+
+        blob = self._lookup(full_url, sha256)
+        if blob:
+            LOGGER.info("Using cached {}".format(full_url))
+            self._touch(full_url)
+            self._place(blob, target)
+            return target
+
+        with self._locked(full_url):
+            # Maybe downloaded by another process, while waiting for it.
+            blob = self._lookup(full_url, sha256)
+            if not blob:
+                partial_dir = self._partial_dir(full_url)
+                path = buildops.download(
+                    url, filename, cwd=partial_dir, sha256=sha256, **kwargs)
+                blob = self.store(full_url, path)
+                buildops.rmdir(partial_dir)
+            self._place(blob, target)
+        self.evict()
+        return target
+
+    def fetch_extract(self, url, filename, cwd, env, sha256=None):
+        """Download (or take from the cache) the archive at url/filename and
+        extract it into cwd, see :func:`buildops.file_extract`.
+
+        Tar archives missing from the cache are extracted while they are
+        downloaded, and the archive is only kept in the cache.
+        """
+        full_url = url + str(filename)
+        if (buildops.is_tar_archive(filename)
+                and not self._lookup(full_url, sha256)):
+            with self._locked(full_url):
+                # Maybe downloaded by another process, while waiting for it.
+                extract = not self._lookup(full_url, sha256)
+                if extract:
+                    partial_dir = self._partial_dir(full_url)
+                    path = join(partial_dir, filename)
+                    digest = buildops.download_extract(
+                        url, filename, cwd=cwd, sha256=sha256, save_to=path)
+                    self.store(full_url, path, digest)
+                    buildops.rmdir(partial_dir)
+            if extract:
+                self.evict()
+                return
+
+        self.fetch(url, filename, cwd=cwd, sha256=sha256)
+        buildops.file_extract(filename, cwd=cwd, env=env)
+        buildops.file_remove(join(cwd, filename))
+
+    def _lookup(self, url, sha256=None):
+        """Return the path of the cached content of url, or None."""
+        entry = self.index.get(url)
+        if not entry or sha256 and entry["sha256"] != sha256.lower():
+            return None
+        blob = self.blob_path(entry["sha256"])
+        return blob if exists(blob) else None
+
+    def _partial_dir(self, url):
+        # Specific to the URL, so partial downloads can be resumed and don't
+        # clash with others of the same name. Only use it while holding
+        # the lock of the URL, see _locked().
+        partial_dir = join(
+            self.partial_dir, sha1(url.encode("utf-8")).hexdigest())
+        buildops.mkdir(partial_dir)
+        return partial_dir
+
+    @contextmanager
+    def _locked(self, url):
+        """Hold the lock of the download of url, shared with the other
+        processes using the cache."""
+        if fcntl is None:
+            yield
+            return
+        buildops.mkdir(self.partial_dir)
+        # Not in the partial directory: it is removed once downloaded.
+        lock = join(self.partial_dir, "{}.lock".format(
+            sha1(url.encode("utf-8")).hexdigest()))
+        with open(lock, "a") as fd:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                # What the previous holder stored.
+                self.index.reload()
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def store(self, url, path, digest=None):
+        """Move the file at path into the cache, as the content of url.
+        Returns the path of the blob."""
+        if digest is None:
+            digest = buildops.file_sha256(path)
+        blob = self.blob_path(digest)
+        if exists(blob):
+            buildops.file_remove(path)
+        else:
+            os.replace(path, blob)
+            # Blobs are hardlinked into build directories: protect them.
+            os.chmod(blob, 0o444)
+        self.index[url] = {
+            "sha256": digest,
+            "size": getsize(blob),
+            "last_access": time.time(),
+        }
+        return blob
+
+    def _touch(self, url):
+        entry = dict(self.index[url])
+        entry["last_access"] = time.time()
+        self.index[url] = entry
+
+    def _place(self, blob, target):
+        """Make the blob available at target, sharing the data if possible."""
+        buildops.file_remove(target)
+        try:
+            os.link(blob, target)
+        except OSError:
+            buildops.file_copy(blob, target)
+            os.chmod(target, 0o644)
+
+    def entries(self):
+        """Return the list of (url, entry), most recently used first."""
+        return sorted(
+            ((url, self.index[url]) for url in self.index.keys()),
+            key=lambda item: item[1]["last_access"],
+            reverse=True)
+
+    def total_size(self):
+        blobs = {entry["sha256"]: entry["size"] for _, entry in self.entries()}
+        return sum(blobs.values())
+
+    def evict(self, max_size=None):
+        """Remove the least recently used archives until the cache fits in
+        max_size bytes (defaults to the budget of the cache).
+        Returns the number of bytes freed."""
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+
+        # Several URLs can share a blob: it is as recent as its last use.
+        blobs = {}
+        for url, entry in self.entries():
+            blob = blobs.setdefault(entry["sha256"], {
+                "size": entry["size"], "last_access": 0, "urls": []})
+            blob["last_access"] = max(blob["last_access"], entry["last_access"])
+            blob["urls"].append(url)
+
+        total = sum(blob["size"] for blob in blobs.values())
+        freed = 0
+        with self.index.transaction():
+            for digest, blob in sorted(
+                    blobs.items(), key=lambda item: item[1]["last_access"]):
+                if total - freed <= max_size:
+                    break
+                LOGGER.debug("Evict {} from the download cache".format(
+                    ", ".join(blob["urls"])))
+                self._remove_blob(digest, blob["urls"])
+                freed += blob["size"]
+        return freed
+
+    def verify(self):
+        """Check every archive against its digest, dropping the corrupted or
+        missing ones, and the files unknown to the index.
+        Returns the list of URLs that were dropped."""
+        by_digest = {}
+        for url, entry in self.entries():
+            by_digest.setdefault(entry["sha256"], []).append(url)
+
+        dropped = []
+        for digest, urls in by_digest.items():
+            blob = self.blob_path(digest)
+            if not exists(blob):
+                LOGGER.error("Missing archive for {}".format(", ".join(urls)))
+            elif buildops.file_sha256(blob) != digest:
+                LOGGER.error("Corrupted archive for {}".format(", ".join(urls)))
+            else:
+                continue
+            self._remove_blob(digest, urls)
+            dropped.extend(urls)
+
+        for fn in os.listdir(self.blobs_dir):
+            if fn not in by_digest:
+                LOGGER.debug("Remove unindexed archive {}".format(fn))
+                buildops.file_remove(self.blob_path(fn))
+        return dropped
+
+    def _remove_blob(self, digest, urls):
+        with self.index.transaction():
+            for url in urls:
+                del self.index[url]
+        blob = self.blob_path(digest)
+        if exists(blob):
+            os.chmod(blob, 0o644)
+            buildops.file_remove(blob)
@@ -0,0 +1,260 @@
+"""
+Cache of the cloned git repositories, shared by all the projects.
+
+Every repository is fetched once into a bare mirror, updated by a fetch when
+it is used again. The clones borrow the objects of the mirror
+(`git clone --shared`), so each project gets its own working tree (cleaning
+it doesn't affect the other projects) while the branches of a repository
+share the same objects. The origin of the clones is the original URL, so
+they can also be updated without the cache.
+
+An index records the size, the last use and the clones of every mirror, so
+the least recently used mirrors can be evicted when the cache grows over its
+budget. The clones of an evicted mirror get their own copy of the objects
+first.
+"""
+
+__all__ = ["GitCache"]
+
+from hashlib import sha1
+import os
+from os.path import basename, exists, isdir, join, realpath
+import time
+
+import buildozer.buildops as buildops
+from buildozer.gitmeta import GitRepository
+from buildozer.jsonstore import JsonStore
+from buildozer.logger import Logger
+
+LOGGER = Logger()
+
+
+def _tree_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                size += os.lstat(join(root, fn)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class GitCache:
+
+    def __init__(self, cache_dir, env=None, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.mirrors_dir = join(cache_dir, "mirrors")
+        self.env = os.environ.copy() if env is None else env
+        buildops.mkdir(self.mirrors_dir)
+        self.index = JsonStore(join(cache_dir, "index.json"))
+
+    def _git(self, *args, **kwargs):
+        return buildops.cmd(["git", *args], env=self.env, **kwargs)
+
+    def mirror_path(self, url):
+        url = url.rstrip("/")
+        name = basename(url)
+        if name.endswith(".git"):
+            name = name[:-4]
+        return join(self.mirrors_dir, "{}_{}.git".format(
+            name, sha1(url.encode("utf-8")).hexdigest()))
+
+    def update_mirror(self, url):
+        """Create or update the bare mirror of url, return its path.
+
+        A failed update (offline?) is not an error: the mirror may still
+        have what is needed.
+        """
+        mirror = self.mirror_path(url)
+        if exists(mirror):
+            LOGGER.info("Update the cached mirror of {}".format(url))
+            result = self._git(
+                "--git-dir", mirror, "fetch", "--prune", "origin",
+                break_on_error=False)
+            if result.return_code:
+                LOGGER.error(
+                    "Unable to update the mirror of {}, using it as is".format(url))
+            return mirror
+
+        LOGGER.info("Cache {} into {}".format(url, mirror))
+        # cloned aside, so a failed clone doesn't leave a broken mirror
+        partial = "{}.{}.tmp".format(mirror, os.getpid())
+        buildops.rmdir(partial)
+        self._git("clone", "--mirror", url, partial)
+        # the clones use its objects: they must never be pruned
+        self._git("--git-dir", partial, "config", "gc.pruneExpire", "never")
+        try:
+            os.rename(partial, mirror)
+        except OSError:
+            # created by another process in the meantime
+            buildops.rmdir(partial)
+        return mirror
+
+    def clone(self, url, branch, dest, options=(), origin="origin"):
+        """Clone the branch (or tag) of url into dest, through the cache.
+        options are passed to git clone, origin is the name of the remote."""
+        mirror = self.update_mirror(url)
+        clone_options = ["--branch", branch] if branch else []
+        self._git(
+            "clone", "--shared", "--origin", origin, *clone_options, *options,
+            mirror, dest)
+        # point to the original repository, not to the mirror
+        self._git("remote", "set-url", origin, url, cwd=dest)
+        self._record(url, mirror, dest)
+
+    def update(self, dest, branch):
+        """Update the clone dest to the latest commit of branch of its
+        origin, fetched through the cache. Local changes to the tracked files
+        are kept if they don't conflict. A tag is checked out detached."""
+        url = GitRepository(dest).remote_url()
+        mirror = self.update_mirror(url)
+        if GitRepository(mirror, bare=True).resolve_ref(
+                "refs/heads/{}".format(branch)):
+            self._git(
+                "fetch", "--tags", mirror,
+                "+refs/heads/{0}:refs/remotes/origin/{0}".format(branch),
+                cwd=dest)
+            self._git(
+                "checkout", "-B", branch,
+                "refs/remotes/origin/{}".format(branch), cwd=dest)
+        else:
+            self._git(
+                "fetch", mirror, "+refs/tags/{0}:refs/tags/{0}".format(branch),
+                cwd=dest)
+            self._git(
+                "checkout", "--detach", "refs/tags/{}".format(branch),
+                cwd=dest)
+        self._record(url, mirror, dest)
+
+    def _record(self, url, mirror, dest):
+        """Update the index entry of mirror after it was used for dest, then
+        make room in the cache if needed."""
+        name = basename(mirror)
+        entry = dict(self.index.get(name, {}))
+        # forget the clones that were removed
+        clones = {clone for clone in entry.get("clones", []) if exists(clone)}
+        clones.add(realpath(dest))
+        entry.update({
+            "url": url,
+            "size": _tree_size(mirror),
+            "last_access": time.time(),
+            "clones": sorted(clones),
+        })
+        self.index[name] = entry
+        self.evict(keep=name)
+
+    def entries(self):
+        """Return the list of (mirror name, entry), most recently used
+        first."""
+        return sorted(
+            ((name, self.index[name]) for name in self.index.keys()),
+            key=lambda item: item[1]["last_access"],
+            reverse=True)
+
+    def total_size(self):
+        return sum(entry["size"] for _, entry in self.entries())
+
+    def evict(self, max_size=None, keep=None):
+        """Remove the least recently used mirrors (but keep) until the cache
+        fits in max_size bytes (defaults to the budget of the cache).
+        Returns the number of bytes freed."""
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+
+        total = self.total_size()
+        freed = 0
+        with self.index.transaction():
+            for name, entry in reversed(self.entries()):
+                if total - freed <= max_size:
+                    break
+                if name == keep:
+                    continue
+                LOGGER.debug("Evict {} from the git cache".format(entry["url"]))
+                if self._remove_mirror(name):
+                    freed += entry["size"]
+        return freed
+
+    def verify(self):
+        """Check every mirror with git fsck, dropping the corrupted or
+        missing ones (but those still used by a clone that can't get its own
+        copy of the objects). The valid mirrors unknown to the index are added to
+        it, the other directories are removed.
+        Returns the list of URLs that were dropped."""
+        dropped = []
+        for name, entry in self.entries():
+            mirror = join(self.mirrors_dir, name)
+            if not isdir(mirror):
+                LOGGER.error("Missing mirror for {}".format(entry["url"]))
+            elif self._git(
+                    "--git-dir", mirror, "fsck", "--no-progress",
+                    break_on_error=False, get_stderr=True).return_code:
+                LOGGER.error("Corrupted mirror for {}".format(entry["url"]))
+            else:
+                continue
+            if self._remove_mirror(name):
+                dropped.append(entry["url"])
+
+        for fn in os.listdir(self.mirrors_dir):
+            if fn in self.index:
+                continue
+            path = join(self.mirrors_dir, fn)
+            if fn.endswith(".tmp"):
+                # may be cloned by another process right now
+                if time.time() - os.stat(path).st_mtime > 24 * 3600:
+                    LOGGER.debug("Remove the partial mirror {}".format(fn))
+                    buildops.rmdir(path)
+                continue
+            url = GitRepository(path, bare=True).remote_url()
+            if url:
+                # its clones are unknown, but may exist: keep it
+                LOGGER.debug("Index the mirror of {}".format(url))
+                self.index[fn] = {
+                    "url": url,
+                    "size": _tree_size(path),
+                    "last_access": os.stat(path).st_mtime,
+                    "clones": [],
+                }
+            else:
+                LOGGER.debug("Remove the unknown mirror {}".format(fn))
+                buildops.rmdir(path)
+        return dropped
+
+    def _dissociate(self, clone, mirror):
+        """Copy the objects borrowed from mirror into clone, so it keeps
+        working once mirror is removed. Returns False if that failed."""
+        alternates = join(clone, ".git", "objects", "info", "alternates")
+        if not exists(alternates):
+            return True
+        with open(alternates) as fd:
+            if join(mirror, "objects") not in fd.read().splitlines():
+                return True
+        LOGGER.debug("Copy the objects of {} into {}".format(mirror, clone))
+        result = self._git(
+            "repack", "-a", "-d", "-q", cwd=clone, break_on_error=False)
+        if result.return_code:
+            LOGGER.error("Unable to copy the objects of {} into {}".format(
+                mirror, clone))
+            return False
+        buildops.file_remove(alternates)
+        return True
+
+    def _remove_mirror(self, name):
+        """Remove the mirror name, unless one of its clones still needs it.
+        Returns True if it was removed."""
+        mirror = join(self.mirrors_dir, name)
+        entry = self.index[name]
+        if isdir(mirror):
+            dissociated = [
+                self._dissociate(clone, mirror)
+                for clone in entry.get("clones", [])]
+            if not all(dissociated):
+                LOGGER.error("Keep the mirror of {}, still used".format(
+                    entry["url"]))
+                return False
+        del self.index[name]
+        buildops.rmdir(mirror)
+        return True
@@ -0,0 +1,202 @@
+"""
+Read the metadata of a git checkout (remote URLs, current branch and commit,
+references) directly from its files, without running git.
+
+Only what is needed to check that a checkout matches the spec is supported:
+anything fancier (fetching, resetting, ...) still goes through the git
+command.
+"""
+
+__all__ = ["GitRepository", "parse_git_config"]
+
+import io
+from os.path import join, isabs, isdir, isfile, normpath
+import re
+
+SECTION = re.compile(r'^\s*\[\s*([^\s\]"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+HEX_SHA = re.compile(r"^[0-9a-f]{4,40}$")
+
+
+def _unquote(value):
+    """Decode a git config value: strip the comments, quotes and escapes."""
+    result = []
+    quoted = False
+    chars = iter(value.strip())
+    for char in chars:
+        if char == '"':
+            quoted = not quoted
+        elif char == "\\":
+            char = next(chars, "")
+            result.append({"n": "\n", "t": "\t", "b": "\b"}.get(char, char))
+        elif char in "#;" and not quoted:
+            break
+        else:
+            result.append(char)
+    return "".join(result).strip()
+
+
+def parse_git_config(text):
+    """
+    Parse the content of a git config file into a dict mapping
+    (section, subsection) to a dict of the keys of the section. Section and
+    key names are lowercased, as git does. Subsection is None for plain
+    sections.
+    """
+    config = {}
+    section = None
+    for line in text.splitlines():
+        match = SECTION.match(line)
+        if match:
+            name, subsection = match.groups()
+            if subsection is not None:
+                subsection = re.sub(r"\\(.)", r"\1", subsection)
+            section = config.setdefault((name.lower(), subsection), {})
+            line = line[match.end():]
+        line = line.strip()
+        if not line or line[0] in "#;" or section is None:
+            continue
+        key, sep, value = line.partition("=")
+        # A key without value is a boolean set to true.
+        section[key.strip().lower()] = _unquote(value) if sep else "true"
+    return config
+
+
+class GitRepository:
+    """
+    A git checkout, read from its files.
+
+    path is the working tree (or the repository itself if bare is set).
+    Linked worktrees and checkouts whose .git is a "gitdir:" file are
+    supported. `is_valid` is False if path is not a git checkout.
+    """
+
+    def __init__(self, path, bare=False):
+        self.path = path
+        self.git_dir = path if bare else self._find_git_dir(path)
+        self.common_dir = self.git_dir
+        if self.git_dir and isfile(join(self.git_dir, "commondir")):
+            common_dir = self._read(join(self.git_dir, "commondir"))
+            if not isabs(common_dir):
+                common_dir = normpath(join(self.git_dir, common_dir))
+            self.common_dir = common_dir
+        self._config = None
+
+    @staticmethod
+    def _read(path):
+        with io.open(path, encoding="utf-8") as fd:
+            return fd.read().strip()
+
+    def _find_git_dir(self, path):
+        dot_git = join(path, ".git")
+        if isdir(dot_git):
+            return dot_git
+        if isfile(dot_git):
+            content = self._read(dot_git)
+            if content.startswith("gitdir:"):
+                git_dir = content[len("gitdir:"):].strip()
+                if not isabs(git_dir):
+                    git_dir = normpath(join(path, git_dir))
+                return git_dir
+        return None
+
+    @property
+    def is_valid(self):
+        return self.git_dir is not None and isfile(join(self.git_dir, "HEAD"))
+
+    @property
+    def config(self):
+        """The parsed config of the repository, see parse_git_config()."""
+        if self._config is None:
+            self._config = {}
+            if self.is_valid and isfile(join(self.common_dir, "config")):
+                self._config = parse_git_config(
+                    self._read(join(self.common_dir, "config")))
+        return self._config
+
+    def remote_url(self, remote="origin"):
+        """Return the URL of remote, or None."""
+        return self.config.get(("remote", remote), {}).get("url")
+
+    def _head(self):
+        return self._read(join(self.git_dir, "HEAD")) if self.is_valid else ""
+
+    @property
+    def branch(self):
+        """The name of the checked out branch, None if HEAD is detached."""
+        head = self._head()
+        if head.startswith("ref: refs/heads/"):
+            return head[len("ref: refs/heads/"):]
+        return None
+
+    @property
+    def head_commit(self):
+        """The sha1 of the checked out commit, None if there is none."""
+        head = self._head()
+        if head.startswith("ref:"):
+            return self.resolve_ref(head[len("ref:"):].strip())
+        return head or None
+
+    def _packed_refs(self):
+        """Yield (ref, sha1) from the packed-refs file. The tags are peeled:
+        their sha1 is the one of the tagged commit."""
+        packed_refs = join(self.common_dir, "packed-refs")
+        if not isfile(packed_refs):
+            return
+        last_ref = None
+        for line in self._read(packed_refs).splitlines():
+            if line.startswith("#") or not line.strip():
+                continue
+            if line.startswith("^"):
+                # peeled value of the annotated tag of the previous line
+                yield last_ref, line[1:].strip()
+                continue
+            sha1, _, last_ref = line.partition(" ")
+            last_ref = last_ref.strip()
+            yield last_ref, sha1
+
+    def resolve_ref(self, ref):
+        """Return the sha1 of a full reference name (refs/heads/master, ...),
+        or None if it doesn't exist."""
+        if not self.is_valid:
+            return None
+        for base_dir in {self.git_dir, self.common_dir}:
+            path = join(base_dir, *ref.split("/"))
+            if isfile(path):
+                value = self._read(path)
+                if value.startswith("ref:"):
+                    return self.resolve_ref(value[len("ref:"):].strip())
+                return value
+        sha1 = None
+        for name, value in self._packed_refs():
+            if name == ref:
+                # keep going: the peeled value of a tag comes after it
+                sha1 = value
+            elif sha1:
+                break
+        return sha1
+
+    def resolve(self, name):
+        """Return the sha1 of a revision given as a branch or tag name, a
+        full reference, or a (possibly abbreviated) sha1. Returns None if it
+        can't be resolved without git."""
+        if name == "HEAD":
+            return self.head_commit
+        if name.startswith("refs/"):
+            refs = [name]
+        else:
+            refs = ["refs/tags/" + name, "refs/heads/" + name,
+                    "refs/remotes/origin/" + name]
+        for ref in refs:
+            sha1 = self.resolve_ref(ref)
+            if sha1:
+                return sha1
+        head_commit = self.head_commit
+        if (HEX_SHA.match(name) and head_commit
+                and head_commit.startswith(name)):
+            return head_commit
+        return None
+
+    def is_at(self, revision):
+        """Whether the checkout is at revision (see resolve())."""
+        head_commit = self.head_commit
+        return head_commit is not None and self.resolve(revision) == head_commit
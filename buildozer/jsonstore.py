@@ -1,37 +1,212 @@
 """
 Replacement for shelve, using json.
 This was needed to correctly support db between Python 2 and 3.
+
+Several processes can share a store: the changes are merged into the current
+content of the storage when they are written, under a lock.
+
+The storage is pluggable: a JSON file (the default), or an SQLite database,
+which writes only the changed keys and keeps the history of the values.
 """
 
-__all__ = ["JsonStore"]
+__all__ = ["JsonStore", "JsonFileBackend", "SqliteBackend"]
 
+from contextlib import contextmanager
 import io
-from json import load, dump
+from json import load, dump, dumps, loads
+import os
 from os.path import exists
+import sqlite3
+import time
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-class JsonStore:
+# Marks a deleted key in the pending changes.
+_DELETED = object()
+
+
+class JsonFileBackend:
+    '''Store everything in a JSON file, rewritten on every change.'''
 
     def __init__(self, filename):
         self.filename = filename
-        self.data = {}
-        if exists(filename):
+
+    def load(self):
+        if not exists(self.filename):
+            return {}
+        try:
+            with io.open(self.filename, encoding='utf-8') as fd:
+                return load(fd)
+        except ValueError:
+            print("Unable to read the state.db, content will be replaced.")
+            return {}
+
+    @contextmanager
+    def _locked(self):
+        '''Hold the lock of the file, shared with the other processes.'''
+        if fcntl is None:
+            yield
+            return
+        # Not the store itself: it is replaced when written.
+        with open('{}.lock'.format(self.filename), 'a') as fd:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
             try:
-                with io.open(filename, encoding='utf-8') as fd:
-                    self.data = load(fd)
-            except ValueError:
-                print("Unable to read the state.db, content will be replaced.")
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def update(self):
+        '''Yield the current content, as a dict to modify, and save it at
+        the end, while holding the lock.'''
+        with self._locked():
+            data = self.load()
+            yield data
+            self._write(data)
+
+    def _write(self, data):
+        # The data is written to a temporary file, which replaces the store
+        # once flushed to the disk: a crash leaves either the old or the new
+        # content, never a truncated file.
+        tmp_filename = '{}.tmp'.format(self.filename)
+        with io.open(tmp_filename, 'w', encoding='utf-8') as fd:
+            dump(data, fd, ensure_ascii=False)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_filename, self.filename)
+
+    def history(self, key):
+        # no history is kept in the JSON file
+        return []
+
+
+class _TrackedDict(dict):
+    '''dict remembering which keys were set or deleted.'''
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.changed = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed.add(key)
+
+    def pop(self, key, *args):
+        self.changed.add(key)
+        return super().pop(key, *args)
+
+
+class SqliteBackend:
+    '''
+    Store the values in an SQLite database (in WAL mode, so readers never
+    block), one row per key: only the changed keys are written. Every change
+    is also appended to a history table.
+
+    If migrate_from is the path of a JSON store, its content is imported when
+    the database is created.
+    '''
+
+    def __init__(self, filename, migrate_from=None):
+        self.filename = filename
+        is_new = not exists(filename)
+        self.connection = sqlite3.connect(
+            filename, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction() as cursor:
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS store ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS history ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, '
+                'value TEXT, time REAL NOT NULL)')
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS history_key ON history (key)')
+            if is_new and migrate_from and exists(migrate_from):
+                data = JsonFileBackend(migrate_from).load()
+                self._save(cursor, data, data.keys())
+
+    @contextmanager
+    def _transaction(self):
+        cursor = self.connection.cursor()
+        # Take the write lock now, not at the first write, so the data read
+        # in the transaction can't change before it is written.
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+
+    def load(self):
+        return {
+            key: loads(value) for key, value in
+            self.connection.execute('SELECT key, value FROM store')}
+
+    @contextmanager
+    def update(self):
+        '''Yield the current content, as a dict to modify, and save the
+        changed keys at the end, in a single transaction.'''
+        with self._transaction() as cursor:
+            data = _TrackedDict(
+                (key, loads(value)) for key, value in
+                cursor.execute('SELECT key, value FROM store'))
+            yield data
+            self._save(cursor, data, data.changed)
+
+    def _save(self, cursor, data, keys):
+        now = time.time()
+        for key in keys:
+            if key in data:
+                value = dumps(data[key], ensure_ascii=False)
+                cursor.execute(
+                    'INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)',
+                    (key, value))
+            else:
+                value = None
+                cursor.execute('DELETE FROM store WHERE key = ?', (key, ))
+            cursor.execute(
+                'INSERT INTO history (key, value, time) VALUES (?, ?, ?)',
+                (key, value, now))
+
+    def history(self, key):
+        '''Return the list of (time, value) of key, oldest first. The value
+        is None when the key was deleted.'''
+        return [
+            (timestamp, None if value is None else loads(value))
+            for timestamp, value in self.connection.execute(
+                'SELECT time, value FROM history WHERE key = ? ORDER BY id',
+                (key, ))]
+
+
+class JsonStore:
+
+    def __init__(self, filename, backend=None):
+        self.filename = filename
+        self.backend = backend or JsonFileBackend(filename)
+        self.data = self.backend.load()
+        self._changes = {}
+        self._transactions = 0
 
     def __getitem__(self, key):
         return self.data[key]
 
     def __setitem__(self, key, value):
         self.data[key] = value
-        self.sync()
+        self._changed(key, value)
 
     def __delitem__(self, key):
         del self.data[key]
-        self.sync()
+        self._changed(key, _DELETED)
 
     def __contains__(self, item):
         return item in self.data
@@ -42,6 +217,71 @@ class JsonStore:
     def keys(self):
         return self.data.keys()
 
+    def history(self, key):
+        '''Previous values of key, see SqliteBackend.history(). Empty with
+        the JSON file backend, which keeps no history.'''
+        return self.backend.history(key)
+
+    def _changed(self, key, value):
+        self._changes[key] = value
+        if not self._transactions:
+            self.sync()
+
+    @contextmanager
+    def transaction(self):
+        '''Write all the changes made in the block at once, at its end.
+        Transactions can be nested, the outermost one writes.
+        '''
+        self._transactions += 1
+        try:
+            yield self
+        finally:
+            self._transactions -= 1
+            if not self._transactions:
+                self.sync()
+
+    def _merge(self, data):
+        '''Apply the pending changes over the current content of the
+        storage, which may have been modified by other processes.
+        '''
+        for key, value in self._changes.items():
+            if value is _DELETED:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        self._changes = {}
+
+    def reload(self):
+        '''Read the content of the storage again, with the changes made by
+        other processes since. The pending changes stay pending.
+        '''
+        changes = dict(self._changes)
+        data = self.backend.load()
+        self._merge(data)
+        self._changes = changes
+        self.data = data
+
     def sync(self):
-        with open(self.filename, 'w') as fd:
-            dump(self.data, fd, ensure_ascii=False)
+        '''Write the changes, if any, merged with the changes made by
+        other processes to the other keys.
+        '''
+        if not self._changes:
+            return
+        with self.backend.update() as data:
+            self._merge(data)
+            self.data = dict(data)
+
+    def increment(self, key, step=1, default=0):
+        '''Increment the integer at key (default if missing) and return the
+        new value, atomically even if other processes do the same.
+
+        The pending changes are written along. Values stored as strings stay
+        strings.
+        '''
+        with self.backend.update() as data:
+            self._merge(data)
+            value = data.get(key, default)
+            result = int(value) + step
+            data[key] = str(result) if isinstance(value, str) else result
+            self.data = dict(data)
+        return result
@@ -0,0 +1,138 @@
+"""
+Selection of the application source files, from the source.* tokens of the
+spec file.
+
+The patterns are compiled once, into a single regular expression per kind,
+and the excluded directories are pruned from the walk, so large excluded
+trees (virtualenvs, node_modules, ...) are never traversed.
+"""
+
+__all__ = ["SourceFilter"]
+
+from fnmatch import translate
+import os
+from os.path import join, normcase, splitext
+import re
+
+WILDCARDS = re.compile(r"[*?\[]")
+
+
+def _compile(patterns):
+    """Compile fnmatch patterns into a single regex, None if no pattern."""
+    if not patterns:
+        return None
+    return re.compile("|".join(
+        "(?:{})".format(translate(normcase(pattern))) for pattern in patterns))
+
+
+def _match(regex, name):
+    return regex is not None and regex.match(normcase(name)) is not None
+
+
+class SourceFilter:
+    """
+    Decide which files of the source directory are part of the application.
+
+    Directory paths are matched with a trailing "/" (so "images/" can be
+    excluded without excluding "images2/"), relative to the source directory
+    and lowercased, as the patterns are.
+    """
+
+    def __init__(self, include_exts=(), exclude_exts=(), exclude_dirs=(),
+                 exclude_patterns=(), include_patterns=()):
+        self.include_exts = {ext.lower() for ext in include_exts}
+        self.exclude_exts = {ext.lower() for ext in exclude_exts}
+        exclude_patterns = [pattern.lower() for pattern in exclude_patterns]
+        include_patterns = [pattern.lower() for pattern in include_patterns]
+        self.exclude_regex = _compile(exclude_patterns)
+        self.include_regex = _compile(include_patterns)
+
+        # Trie of the excluded directories, by path component. A node
+        # containing None ends an excluded directory.
+        self.exclude_dirs = {}
+        for exclude_dir in exclude_dirs:
+            node = self.exclude_dirs
+            for part in exclude_dir.lower().strip("/").split("/"):
+                node = node.setdefault(part, {})
+            node[None] = True
+
+        # What is excluded by a pattern ending with "*" stays excluded in
+        # all the subdirectories.
+        self.exclude_tree_regex = _compile(
+            [pattern for pattern in exclude_patterns if pattern.endswith("*")])
+        # Only the include patterns that can match a directory (ending with
+        # "/" or a wildcard) matter, with the literal part before their
+        # first wildcard.
+        self.include_dir_prefixes = [
+            WILDCARDS.split(pattern, 1)[0] for pattern in include_patterns
+            if pattern[-1] in "/*?]"]
+
+    def _in_exclude_dirs(self, dirname):
+        node = self.exclude_dirs
+        for part in dirname.rstrip("/").split("/"):
+            node = node.get(part)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def is_dir_excluded(self, dirname):
+        """Whether the files directly in dirname are excluded."""
+        is_excluded = (
+            self._in_exclude_dirs(dirname)
+            or _match(self.exclude_regex, dirname))
+        return is_excluded and not _match(self.include_regex, dirname)
+
+    def is_tree_excluded(self, dirname):
+        """Whether dirname and all its subdirectories are excluded."""
+        if not (self._in_exclude_dirs(dirname)
+                or _match(self.exclude_tree_regex, dirname)):
+            return False
+        return not any(
+            prefix.startswith(dirname) or dirname.startswith(prefix)
+            for prefix in self.include_dir_prefixes)
+
+    def is_file_excluded(self, filename):
+        """Whether filename (relative to the source directory) is excluded,
+        by the patterns or by its extension."""
+        if (_match(self.exclude_regex, filename)
+                and not _match(self.include_regex, filename)):
+            return True
+        ext = splitext(filename)[1]
+        if ext:
+            ext = ext[1:].lower()
+            if self.include_exts and ext not in self.include_exts:
+                return True
+            if self.exclude_exts and ext in self.exclude_exts:
+                return True
+        return False
+
+    def walk(self, source_dir):
+        """
+        Yield (relative path, path) for every file of the application.
+
+        Hidden files and directories (starting with a ".") are always
+        excluded.
+        """
+        for root, dirs, files in os.walk(source_dir, followlinks=True):
+            relative_root = root[len(source_dir) + 1:]
+            dirname = relative_root.lower().replace(os.sep, "/")
+            if dirname:
+                dirname += "/"
+
+            dirs[:] = [
+                name for name in dirs
+                if not name.startswith(".")
+                and not self.is_tree_excluded(dirname + name.lower() + "/")]
+
+            if dirname and self.is_dir_excluded(dirname):
+                continue
+
+            for fn in files:
+                if fn.startswith("."):
+                    continue
+                # Only the files at the root are lowercased before matching.
+                if self.is_file_excluded(dirname + fn if dirname else fn.lower()):
+                    continue
+                yield join(relative_root, fn), join(root, fn)
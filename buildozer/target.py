@@ -1,6 +1,7 @@
 from sys import exit
 import os
 from os.path import join
+from buildozer.gitmeta import GitRepository
 from buildozer.scripts.cachetools import select_git
 
 import buildozer.buildops as buildops
@@ -51,6 +52,18 @@ class Target:
     def get_available_packages(self):
         return ['kivy']
 
+    def get_python_interpreter(self):
+        '''Return the path of a host interpreter of the Python version of
+        the target, to byte-compile the application, or None if unknown.
+        '''
+        return None
+
+    def get_python_optimization(self):
+        '''Return the optimization level (as python -O) the application
+        runs with on the target, to byte-compile it at that level.
+        '''
+        return 0
+
     def run_commands(self, args):
         if not args:
             self.logger.error('Missing target command')
@@ -249,14 +262,28 @@ class Target:
         """
         install_dir = join(self.buildozer.platform_dir, repo)
         custom_dir, clone_url, clone_branch = self.path_or_git_url(repo, **kwargs)
+        if not custom_dir and buildops.file_exists(install_dir):
+            # check that url/branch has not been changed, without running git.
+            # A tag is checked out on a detached HEAD: only a different
+            # branch is detected.
+            repository = GitRepository(install_dir)
+            cur_url = repository.remote_url()
+            cur_branch = repository.branch
+            if cur_url != clone_url or cur_branch not in (None, clone_branch):
+                self.logger.info(
+                    f"Detected old url/branch ({cur_url}/{cur_branch}), deleting...")
+                buildops.rmdir(install_dir)
         if not buildops.file_exists(install_dir):
             if custom_dir:
                 buildops.mkdir(install_dir)
                 buildops.file_copytree(custom_dir, install_dir)
+            elif self.buildozer.git_cache:
+                self.buildozer.git_cache.clone(
+                    clone_url, clone_branch, install_dir)
             else:
                 buildops.cmd(
                     [
-                        select_git(allow_cache=True),
+                        select_git(),
                         "clone",
                         "--depth", "1",
                         "--branch",
@@ -273,8 +300,11 @@ class Target:
                     [select_git(), "clean", "-dxf"],
                     cwd=install_dir,
                     env=self.buildozer.environ)
-                buildops.cmd(
-                    [select_git(), "pull", "origin", clone_branch],
-                    cwd=install_dir,
-                    env=self.buildozer.environ)
+                if self.buildozer.git_cache:
+                    self.buildozer.git_cache.update(install_dir, clone_branch)
+                else:
+                    buildops.cmd(
+                        [select_git(), "pull", "origin", clone_branch],
+                        cwd=install_dir,
+                        env=self.buildozer.environ)
         return install_dir
@@ -22,7 +22,10 @@ DEFAULT_ANDROID_NDK_VERSION = '17c'
 
 import ast
 from glob import glob
+import hashlib
+import importlib.metadata
 import io
+import json
 from os import environ
 from os.path import exists, join, realpath, expanduser, basename, relpath
 from platform import architecture
@@ -36,8 +39,14 @@ import traceback
 from distutils.version import LooseVersion
 import pexpect
 
+try:
+    from packaging.requirements import Requirement
+except ImportError:
+    Requirement = None
+
 import buildozer.buildops as buildops
 from buildozer.exceptions import BuildozerException
+from buildozer.gitmeta import GitRepository
 from buildozer.logger import USE_COLOR
 from buildozer.scripts.cachetools import select_git
 from buildozer.target import Target
@@ -55,6 +64,18 @@ DEFAULT_SDK_TAG = '6514223'
 
 DEFAULT_ARCHS = ['arm64-v8a', 'armeabi-v7a']
 
+# State key of the fingerprint of the inputs of the last p4a create.
+P4A_CREATE_FINGERPRINT_KEY = 'android:p4a_create_fingerprint'
+
+# State key of the fingerprint of the python-for-android dependencies
+# installed by pip.
+P4A_INSTALL_REQS_FINGERPRINT_KEY = 'android:p4a_install_reqs_fingerprint'
+
+# Delimit the build cache configuration written into the settings.gradle of
+# the distribution, so it can be updated.
+GRADLE_BUILD_CACHE_BEGIN = '// buildozer build cache {'
+GRADLE_BUILD_CACHE_END = '// } buildozer build cache'
+
 MSG_P4A_RECOMMENDED_NDK_ERROR = (
     "WARNING: Unable to find recommended Android NDK for current "
     "installation of python-for-android, defaulting to the default "
@@ -62,6 +83,33 @@ MSG_P4A_RECOMMENDED_NDK_ERROR = (
 )
 
 
+def requirements_installed(requirements):
+    '''Check, without running pip, that distributions satisfying the
+    requirements (as in a setup.py) are installed for this interpreter.
+
+    The versions and environment markers are only checked if the packaging
+    module is available.
+    '''
+    for requirement in requirements:
+        if Requirement is None:
+            name = re.match(r'\s*([A-Za-z0-9._-]*)', requirement).group(1)
+            try:
+                importlib.metadata.version(name)
+            except importlib.metadata.PackageNotFoundError:
+                return False
+            continue
+        requirement = Requirement(requirement)
+        if requirement.marker and not requirement.marker.evaluate():
+            continue
+        try:
+            version = importlib.metadata.version(requirement.name)
+        except importlib.metadata.PackageNotFoundError:
+            return False
+        if not requirement.specifier.contains(version, prereleases=True):
+            return False
+    return True
+
+
 class TargetAndroid(Target):
     targetname = 'android'
     p4a_directory_name = "python-for-android"
@@ -206,6 +254,7 @@ class TargetAndroid(Target):
                 command, env=self.buildozer.environ, **kwargs)
         else:
             kwargs['get_stdout'] = kwargs.get('get_stdout', True)
+            kwargs.setdefault('output_dir', self.buildozer.logs_dir)
             return buildops.cmd(command, env=self.buildozer.environ, **kwargs)
 
     @property
@@ -365,11 +414,8 @@ class TargetAndroid(Target):
         self.logger.info('Android ANT is missing, downloading')
         archive = 'apache-ant-{0}-bin.tar.gz'.format(APACHE_ANT_VERSION)
         url = 'https://archive.apache.org/dist/ant/binaries/'
-        buildops.download(
+        self.buildozer.download_cache.fetch_extract(
             url,
-            archive,
-            cwd=ant_dir)
-        buildops.file_extract(
             archive,
             cwd=ant_dir,
             env=self.buildozer.environ)
@@ -396,13 +442,8 @@ class TargetAndroid(Target):
             os.makedirs(sdk_dir)
 
         url = 'https://dl.google.com/android/repository/'
-        buildops.download(
+        self.buildozer.download_cache.fetch_extract(
             url,
-            archive,
-            cwd=sdk_dir)
-
-        self.logger.info('Unpacking Android SDK')
-        buildops.file_extract(
             archive,
             cwd=sdk_dir,
             env=self.buildozer.environ)
@@ -461,12 +502,8 @@ class TargetAndroid(Target):
         else:
             url = 'https://dl.google.com/android/ndk/'
 
-        buildops.download(url,
-                                archive,
-                                cwd=self.buildozer.global_platform_dir)
-
-        self.logger.info('Unpacking Android NDK')
-        buildops.file_extract(
+        self.buildozer.download_cache.fetch_extract(
+            url,
             archive,
             cwd=self.buildozer.global_platform_dir,
             env=self.buildozer.environ)
@@ -480,11 +517,9 @@ class TargetAndroid(Target):
     def _android_list_build_tools_versions(self):
         available_packages = self._sdkmanager('--list')
 
-        lines = available_packages[0].split('\n')
-
         build_tools_versions = []
 
-        for line in lines:
+        for line in available_packages.stdout:
             if not line.strip().startswith('build-tools;'):
                 continue
             package_name = line.strip().split(' ')[0]
@@ -691,28 +726,23 @@ class TargetAndroid(Target):
         else:
             # check that url/branch has not been changed
             if buildops.file_exists(p4a_dir):
-                cur_url = buildops.cmd(
-                    [select_git(), "config", "--get", "remote.origin.url"],
-                    get_stdout=True,
-                    cwd=p4a_dir,
-                    env=self.buildozer.environ
-                ).stdout.strip()
-                cur_branch = buildops.cmd(
-                    [select_git(), "branch", "-vv"],
-                    get_stdout=True,
-                    cwd=p4a_dir,
-                    env=self.buildozer.environ
-                ).stdout.split()[1]
+                repository = GitRepository(p4a_dir)
+                cur_url = repository.remote_url()
+                cur_branch = repository.branch
                 if any([cur_url != p4a_url, cur_branch != p4a_branch]):
                     self.logger.info(
                         f"Detected old url/branch ({cur_url}/{cur_branch}), deleting..."
                     )
                     buildops.rmdir(p4a_dir)
 
-            if not buildops.file_exists(p4a_dir):
+            git_cache = self.buildozer.git_cache
+            if not buildops.file_exists(p4a_dir) and git_cache:
+                git_cache.clone(
+                    p4a_url, p4a_branch, p4a_dir, options=["--single-branch"])
+            elif not buildops.file_exists(p4a_dir):
                 buildops.cmd(
                     [
-                        select_git(allow_cache=True),
+                        select_git(),
                         "clone",
                         "--depth", "1",
                         "-b",
@@ -729,12 +759,9 @@ class TargetAndroid(Target):
                     [select_git(), "clean", "-dxf"],
                     cwd=p4a_dir,
                     env=self.buildozer.environ)
-                current_branch = buildops.cmd(
-                    [select_git(), "rev-parse", "--abbrev-ref", "HEAD"],
-                    get_stdout=True,
-                    cwd=p4a_dir,
-                    env=self.buildozer.environ).stdout.strip()
-                if current_branch == p4a_branch:
+                if git_cache:
+                    git_cache.update(p4a_dir, p4a_branch)
+                elif GitRepository(p4a_dir).branch == p4a_branch:
                     buildops.cmd(
                         [select_git(), "pull"],
                         cwd=p4a_dir,
@@ -748,7 +775,8 @@ class TargetAndroid(Target):
                         [select_git(), "checkout", p4a_branch],
                         cwd=p4a_dir,
                         env=self.buildozer.environ)
-            if p4a_commit != 'HEAD':
+            # the commit may already be checked out
+            if p4a_commit != 'HEAD' and not GitRepository(p4a_dir).is_at(p4a_commit):
                 buildops.cmd(
                     [select_git(), "reset", "--hard", p4a_commit],
                     cwd=p4a_dir,
@@ -770,9 +798,21 @@ class TargetAndroid(Target):
         options = ["--user"]
         if "VIRTUAL_ENV" in os.environ or "CONDA_PREFIX" in os.environ:
             options = []
+
+        # pip takes seconds even when there is nothing to install: skip it if
+        # the same dependencies were installed for the same interpreter and
+        # are still there.
+        fingerprint = hashlib.sha256(json.dumps(
+            [executable, sys.version, options, deps]).encode('utf-8')).hexdigest()
+        state = self.buildozer.state
+        if (state.get(P4A_INSTALL_REQS_FINGERPRINT_KEY) == fingerprint
+                and requirements_installed(deps)):
+            self.logger.debug('python-for-android dependencies already installed, pass')
+            return
         buildops.cmd(
             [executable, "-m", "pip", "install", "-q", *options, *deps],
             env=self.buildozer.environ)
+        state[P4A_INSTALL_REQS_FINGERPRINT_KEY] = fingerprint
 
     def compile_platform(self):
         app_requirements = self.buildozer.config.getlist(
@@ -807,11 +847,78 @@ class TargetAndroid(Target):
 
         p4a_create.extend(options)
 
-        self._p4a(p4a_create, get_stdout=True, env=self.buildozer.environ)
+        # p4a create is slow even when there is nothing to rebuild: reuse the
+        # distribution if none of its inputs changed since it was created.
+        state = self.buildozer.state
+        fingerprint = self._p4a_create_fingerprint(
+            p4a_create, source_dirs, local_recipes)
+        if (not self.buildozer.force_compile
+                and state.get(P4A_CREATE_FINGERPRINT_KEY) == fingerprint
+                and exists(self.get_dist_dir(dist_name))):
+            self.logger.info('Distribution already compiled, pass.')
+            return
+
+        # forget the previous fingerprint first: a failed p4a create may
+        # leave a partially rebuilt distribution
+        if P4A_CREATE_FINGERPRINT_KEY in state:
+            del state[P4A_CREATE_FINGERPRINT_KEY]
+        self._p4a(
+            p4a_create,
+            get_stdout=True,
+            output_dir=self.buildozer.logs_dir,
+            env=self.buildozer.environ)
+        state[P4A_CREATE_FINGERPRINT_KEY] = fingerprint
+
+    def _p4a_create_fingerprint(self, p4a_create, source_dirs, local_recipes):
+        '''Return a digest of everything the distribution created by the
+        p4a_create command depends on.
+        '''
+        inputs = {
+            'command': [*p4a_create, *self.extra_p4a_args],
+            'android_api': self.android_api,
+            'android_minapi': self.android_minapi,
+            'ndk': [self.android_ndk_version, self.android_ndk_dir],
+            'p4a': self._p4a_version(),
+            # the trees are fingerprinted from the file metadata: touching a
+            # file is enough to force a rebuild
+            'trees': {
+                path: buildops.tree_fingerprint(path)
+                for path in [*source_dirs.values(), local_recipes]
+                if path and exists(path)
+            },
+        }
+        hook = self.buildozer.config.getdefault('app', 'p4a.hook', None)
+        if hook and exists(expanduser(hook)):
+            inputs['hook'] = buildops.tree_fingerprint(expanduser(hook))
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _p4a_version(self):
+        '''Identify the python-for-android sources: the commit of the clone
+        managed by buildozer, or the state of the files of p4a.source_dir,
+        which may be modified.
+        '''
+        if self.buildozer.config.getdefault('app', 'p4a.source_dir'):
+            return buildops.tree_fingerprint(self.p4a_dir)
+        return GitRepository(self.p4a_dir).head_commit
 
     def get_available_packages(self):
         return True
 
+    def get_python_interpreter(self):
+        # the hostpython built by p4a for the distribution
+        dist_name = self.buildozer.config.get('app', 'package.name')
+        dist_info = join(self.get_dist_dir(dist_name), 'dist_info.json')
+        if not exists(dist_info):
+            return None
+        with open(dist_info) as fd:
+            hostpython = json.load(fd).get('hostpython')
+        return hostpython if hostpython and exists(hostpython) else None
+
+    def get_python_optimization(self):
+        # the apps of p4a run with PYTHONOPTIMIZE=2, as it compiles them
+        return 0 if '--no-optimize-python' in self.extra_p4a_args else 2
+
     def get_dist_dir(self, dist_name):
         """Find the dist dir with the given name if one
         already exists, otherwise return a new dist_dir name.
@@ -883,9 +990,14 @@ class TargetAndroid(Target):
         if whitelist_src:
             cmd.append('--whitelist')
             cmd.append(realpath(expanduser(whitelist_src)))
+        if blacklist_src:
+            blacklist_src = realpath(expanduser(blacklist_src))
+        if self.buildozer.precompiled:
+            # the pycs are packaged instead of the sources, as p4a does
+            blacklist_src = self._write_precompiled_blacklist(blacklist_src)
         if blacklist_src:
             cmd.append('--blacklist')
-            cmd.append(realpath(expanduser(blacklist_src)))
+            cmd.append(blacklist_src)
 
         # support for java directory
         javadirs = self.buildozer.config.getlist('app', 'android.add_src', [])
@@ -967,14 +1079,105 @@ class TargetAndroid(Target):
 
         # support disabling of byte compile for .py files
         no_byte_compile = self.buildozer.config.getdefault('app', 'android.no-byte-compile-python', False)
-        if no_byte_compile:
+        # the application was compiled by buildozer already
+        if no_byte_compile or self.buildozer.precompiled:
             cmd.append('--no-byte-compile-python')
 
         for arch in self._archs:
             cmd.append('--arch')
             cmd.append(arch)
 
-        self._p4a(cmd, env=self.buildozer.environ)
+        self._p4a(cmd, env=self._configure_gradle(self.get_dist_dir(dist_name)))
+
+    def _write_precompiled_blacklist(self, blacklist_src):
+        '''Write the blacklist of a precompiled application: the one of
+        blacklist_src (if any), and the sources. Returns its path.
+        '''
+        patterns = ''
+        if blacklist_src:
+            with open(blacklist_src) as fd:
+                patterns = fd.read()
+        blacklist_dir = join(self.buildozer.buildozer_dir, self.targetname)
+        buildops.mkdir(blacklist_dir)
+        blacklist = join(blacklist_dir, 'precompiled.blacklist.txt')
+        with open(blacklist, 'w') as fd:
+            fd.write(patterns.rstrip('\n') + '\n*.py\n')
+        return blacklist
+
+    def _configure_gradle(self, dist_dir):
+        '''Apply the android.gradle.* options to the Gradle build of the
+        distribution, and return the environment to run it with.
+
+        The gradle.properties of the distribution is rendered again by p4a
+        at every build, so the options are passed as system properties in
+        GRADLE_OPTS instead. The local build cache is only enabled with
+        android.gradle.build_cache_dir, usually shared by all the projects.
+        '''
+        config = self.buildozer.config
+        properties = {}
+        daemon = config.getbooldefault('app', 'android.gradle.daemon', None)
+        if daemon is not None:
+            properties['org.gradle.daemon'] = str(daemon).lower()
+        parallel = config.getbooldefault('app', 'android.gradle.parallel', None)
+        if parallel is not None:
+            properties['org.gradle.parallel'] = str(parallel).lower()
+        jvmargs = config.getdefault('app', 'android.gradle.jvmargs', '')
+        if jvmargs:
+            properties['org.gradle.jvmargs'] = jvmargs
+
+        build_cache_dir = config.getdefault(
+            'app', 'android.gradle.build_cache_dir', '')
+        if build_cache_dir:
+            build_cache_dir = realpath(expanduser(build_cache_dir))
+            buildops.mkdir(build_cache_dir)
+            properties['org.gradle.caching'] = 'true'
+        self._write_gradle_build_cache(dist_dir, build_cache_dir)
+
+        env = self.buildozer.environ.copy()
+        options = [
+            shlex.quote('-D{}={}'.format(key, value))
+            for key, value in sorted(properties.items())]
+        if env.get('GRADLE_OPTS'):
+            # the user options have the last word
+            options.append(env['GRADLE_OPTS'])
+        if options:
+            env['GRADLE_OPTS'] = ' '.join(options)
+        return env
+
+    def _write_gradle_build_cache(self, dist_dir, build_cache_dir):
+        '''Set (or remove, if build_cache_dir is empty) the local build cache
+        directory in the settings.gradle of the distribution.
+        '''
+        if not exists(dist_dir):
+            return
+        settings_path = join(dist_dir, 'settings.gradle')
+        settings = ''
+        if exists(settings_path):
+            with io.open(settings_path, encoding='utf-8') as fd:
+                settings = fd.read()
+        previous = settings
+        settings = re.sub(
+            r'{}.*?{}\n'.format(re.escape(GRADLE_BUILD_CACHE_BEGIN),
+                                   re.escape(GRADLE_BUILD_CACHE_END)),
+            '', settings, flags=re.DOTALL)
+        if build_cache_dir:
+            directory = build_cache_dir.replace('\\', '/').replace("'", "\\'")
+            settings = (
+                "{settings}{newline}{begin}\n"
+                "buildCache {{\n"
+                "    local {{\n"
+                "        directory = new File('{directory}')\n"
+                "    }}\n"
+                "}}\n"
+                "{end}\n").format(
+                    settings=settings,
+                    newline='\n' if settings and not settings.endswith('\n') else '',
+                    begin=GRADLE_BUILD_CACHE_BEGIN, end=GRADLE_BUILD_CACHE_END,
+                    directory=directory)
+        if settings == previous:
+            return
+        with io.open(settings_path, 'w', encoding='utf-8') as fd:
+            fd.write(settings)
 
     def get_release_mode(self):
         # aab, also if unsigned is named as *-release
@@ -1299,14 +1502,6 @@ class TargetAndroid(Target):
 
         self.execute_build_package(build_cmd)
 
-        try:
-            self.buildozer.hook("android_pre_build_apk")
-            self.execute_build_package(build_cmd)
-            self.buildozer.hook("android_post_build_apk")
-        except:
-            # maybe the hook fail because the apk is not
-            pass
-
         build_tools_versions = os.listdir(join(self.android_sdk_dir, "build-tools"))
         build_tools_versions = sorted(build_tools_versions, key=LooseVersion)
         build_tools_version = build_tools_versions[-1]
@@ -1352,8 +1547,9 @@ class TargetAndroid(Target):
         self.logger.info('Android packaging done!')
         self.logger.info(
             u'APK {0} available in the bin directory'.format(artifact_dest))
-        self.buildozer.state['android:latestapk'] = artifact_dest
-        self.buildozer.state['android:latestmode'] = self.build_mode
+        with self.buildozer.state.transaction() as state:
+            state['android:latestapk'] = artifact_dest
+            state['android:latestmode'] = self.build_mode
 
     def _update_libraries_references(self, dist_dir):
         # ensure the project.properties exist
@@ -177,7 +177,7 @@ class TargetIos(Target):
                             available_modules]
 
         need_compile = 0
-        if last_requirements != ios_requirements:
+        if last_requirements != ios_requirements or self.buildozer.force_compile:
             need_compile = 1
 
         # len('requirements.source.') == 20, so use name[20:]
@@ -334,8 +334,9 @@ class TargetIos(Target):
         self.logger.info('iOS packaging done!')
         self.logger.info('IPA {0} available in the bin directory'.format(
             basename(ipa)))
-        self.buildozer.state['ios:latestipa'] = ipa
-        self.buildozer.state['ios:latestmode'] = self.build_mode
+        with self.buildozer.state.transaction() as state:
+            state['ios:latestipa'] = ipa
+            state['ios:latestmode'] = self.build_mode
 
     def cmd_deploy(self, *args):
         super().cmd_deploy(*args)
@@ -29,8 +29,9 @@ class TargetOSX(Target):
 
         self.logger.info('kivy-sdk-packager does not exist, clone it')
         platdir = self.buildozer.platform_dir
+        # not cached: the archive of a branch changes over time
         buildops.download(
-            'https://github.com/kivy/kivy-sdk-packager/archive/master.zip',
+            'https://github.com/kivy/kivy-sdk-packager/archive/',
             'master.zip',
             cwd=platdir)
         buildops.file_extract(
@@ -47,8 +48,8 @@ class TargetOSX(Target):
             if not exists(join(cwd, 'Kivy.dmg')):
                 self.logger.info('Downloading kivy...')
                 try:
-                    buildops.download(
-                        f'https://kivy.org/downloads/{current_kivy_vers}/Kivy.dmg',
+                    self.buildozer.download_cache.fetch(
+                        f'https://kivy.org/downloads/{current_kivy_vers}/',
                         'Kivy.dmg',
                         cwd=cwd
                     )
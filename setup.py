@@ -68,7 +68,7 @@ setup(
     packages=[
         'buildozer', 'buildozer.targets', 'buildozer.libs', 'buildozer.scripts'
     ],
-    package_data={'buildozer': ['default.spec', 'scripts/bash/*']},
+    package_data={'buildozer': ['default.spec']},
     include_package_data=True,
     install_requires=[
         'pexpect',
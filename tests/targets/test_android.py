@@ -1,3 +1,4 @@
+import importlib.metadata
 import os
 import os.path
 import tempfile
@@ -7,7 +8,7 @@ import sys
 
 import pytest
 
-from buildozer.targets.android import TargetAndroid
+from buildozer.targets.android import TargetAndroid, requirements_installed
 from buildozer.scripts.cachetools import select_git
 from tests.targets.utils import (
     init_buildozer,
@@ -21,12 +22,8 @@ def patch_buildops_cmd_expect():
     return mock.patch("buildozer.buildops.cmd_expect")
 
 
-def patch_buildops_download():
-    return mock.patch("buildozer.buildops.download")
-
-
-def patch_buildops_file_extract():
-    return mock.patch("buildozer.buildops.file_extract")
+def patch_download_cache_fetch_extract():
+    return mock.patch("buildozer.downloadcache.DownloadCache.fetch_extract")
 
 
 def patch_os_isfile():
@@ -186,17 +183,17 @@ class TestTargetAndroid:
     def test_install_android_sdk(self, platform):
         """Basic tests for the _install_android_sdk() method."""
         target_android = init_target(self.temp_dir)
-        with patch_buildops_file_exists() as m_file_exists, patch_buildops_download() as m_download:
+        with patch_buildops_file_exists() as m_file_exists, \
+                patch_download_cache_fetch_extract() as m_fetch_extract:
             m_file_exists.return_value = True
             sdk_dir = target_android._install_android_sdk()
         assert m_file_exists.call_args_list == [
             mock.call(target_android.android_sdk_dir)
         ]
-        assert m_download.call_args_list == []
+        assert m_fetch_extract.call_args_list == []
         assert sdk_dir.endswith(".buildozer/android/platform/android-sdk")
         with patch_buildops_file_exists() as m_file_exists, \
-                patch_buildops_download() as m_download, \
-                patch_buildops_file_extract() as m_file_extract, \
+                patch_download_cache_fetch_extract() as m_fetch_extract, \
                 patch_platform(platform):
             m_file_exists.return_value = False
             sdk_dir = target_android._install_android_sdk()
@@ -206,15 +203,14 @@ class TestTargetAndroid:
         platform_map = {"linux": "linux", "darwin": "mac"}
         platform = platform_map[platform]
         archive = "commandlinetools-{platform}-6514223_latest.zip".format(platform=platform)
-        assert m_download.call_args_list == [
+        assert m_fetch_extract.call_args_list == [
             mock.call(
                 "https://dl.google.com/android/repository/",
                 archive,
                 cwd=mock.ANY,
+                env=mock.ANY,
             )
         ]
-        assert m_file_extract.call_args_list == [
-            mock.call(archive, cwd=mock.ANY, env=mock.ANY)]
         assert sdk_dir.endswith(".buildozer/android/platform/android-sdk")
 
     def test_build_package(self):
@@ -263,6 +259,28 @@ class TestTargetAndroid:
             ], env=mock.ANY)
         ]
 
+    def test_execute_build_package__precompiled(self):
+        """A precompiled application is packaged without its sources, and
+        not compiled again by p4a."""
+        blacklist_src = os.path.join(self.temp_dir.name, "blacklist.txt")
+        with open(blacklist_src, "w") as fd:
+            fd.write("*.txt")
+        target_android = init_target(self.temp_dir, {
+            "android.blacklist_src": blacklist_src,
+        })
+        buildozer = target_android.buildozer
+        buildozer.precompiled = True
+        assert target_android.get_python_optimization() == 2
+        with patch_target_android("_p4a") as m__p4a:
+            target_android.execute_build_package([("debug",)])
+        args = m__p4a.call_args[0][0]
+        assert "--no-byte-compile-python" in args
+        with open(args[args.index("--blacklist") + 1]) as fd:
+            assert fd.read() == "*.txt\n*.py\n"
+
+        target_android.extra_p4a_args.append("--no-optimize-python")
+        assert target_android.get_python_optimization() == 0
+
     def test_execute_build_package__release__apk(self):
         """Basic tests for the execute_build_package() method. (in apk release mode)"""
         target_android = init_target(self.temp_dir)
@@ -471,6 +489,131 @@ class TestTargetAndroid:
             cwd=mock.ANY,
             env=mock.ANY) in m_cmd.call_args_list
 
+    def test_compile_platform_fingerprint(self):
+        """`p4a create` only runs again when one of its inputs changed."""
+        local_recipes = os.path.join(self.temp_dir.name, "recipes")
+        os.makedirs(os.path.join(local_recipes, "mylib"))
+        target_android = init_target(self.temp_dir, {
+            "p4a.local_recipes": local_recipes,
+        })
+        buildozer = target_android.buildozer
+        dist_dir = target_android.get_dist_dir("myapp")
+
+        def compile_platform():
+            with patch_target_android("_p4a") as m_p4a, \
+                    patch_target_android("_p4a_version") as m_p4a_version:
+                m_p4a.side_effect = lambda *args, **kwargs: os.makedirs(
+                    dist_dir, exist_ok=True)
+                m_p4a_version.return_value = "0123abcd"
+                target_android.compile_platform()
+            return m_p4a.call_count
+
+        assert compile_platform() == 1
+        assert compile_platform() == 0
+
+        # A new file in the local recipes.
+        with open(os.path.join(local_recipes, "mylib", "__init__.py"), "w"):
+            pass
+        assert compile_platform() == 1
+        assert compile_platform() == 0
+
+        target_android._archs = ["arm64-v8a"]
+        assert compile_platform() == 1
+
+        buildozer.force_compile = True
+        assert compile_platform() == 1
+        buildozer.force_compile = False
+
+        # The distribution was removed.
+        os.rmdir(dist_dir)
+        assert compile_platform() == 1
+
+    def test_configure_gradle(self):
+        """The android.gradle.* options are passed to the Gradle build."""
+        build_cache_dir = os.path.join(self.temp_dir.name, "gradle-cache")
+        target_android = init_target(self.temp_dir, {
+            "android.gradle.daemon": "False",
+            "android.gradle.jvmargs": "-Xmx4g -XX:+UseParallelGC",
+            "android.gradle.build_cache_dir": build_cache_dir,
+        })
+        dist_dir = os.path.join(self.temp_dir.name, "dist")
+        os.mkdir(dist_dir)
+        settings_path = os.path.join(dist_dir, "settings.gradle")
+        with open(settings_path, "w") as fd:
+            fd.write("rootProject.name = 'myapp'\n")
+
+        target_android.buildozer.environ["GRADLE_OPTS"] = "-Dfoo=bar"
+        env = target_android._configure_gradle(dist_dir)
+        assert env["GRADLE_OPTS"] == (
+            "-Dorg.gradle.caching=true -Dorg.gradle.daemon=false "
+            "'-Dorg.gradle.jvmargs=-Xmx4g -XX:+UseParallelGC' -Dfoo=bar")
+        assert os.path.isdir(build_cache_dir)
+
+        # The build cache block is replaced, not duplicated.
+        target_android._configure_gradle(dist_dir)
+        with open(settings_path) as fd:
+            settings = fd.read()
+        assert settings == (
+            "rootProject.name = 'myapp'\n"
+            "// buildozer build cache {\n"
+            "buildCache {\n"
+            "    local {\n"
+            "        directory = new File('" + build_cache_dir + "')\n"
+            "    }\n"
+            "}\n"
+            "// } buildozer build cache\n")
+
+        # Without the option, the block is removed, and the build cache is
+        # not enabled.
+        target_android.buildozer.config.set(
+            "app", "android.gradle.build_cache_dir", "")
+        env = target_android._configure_gradle(dist_dir)
+        assert "caching" not in env["GRADLE_OPTS"]
+        with open(settings_path) as fd:
+            assert fd.read() == "rootProject.name = 'myapp'\n"
+
+    def test_configure_gradle_default(self):
+        """Without android.gradle.* options, the Gradle build is unchanged."""
+        target_android = init_target(self.temp_dir)
+        dist_dir = os.path.join(self.temp_dir.name, "dist")
+        os.mkdir(dist_dir)
+        settings_path = os.path.join(dist_dir, "settings.gradle")
+        with open(settings_path, "w") as fd:
+            fd.write("rootProject.name = 'myapp'\n")
+        os.utime(settings_path, (0, 0))
+
+        target_android.buildozer.environ.pop("GRADLE_OPTS", None)
+        env = target_android._configure_gradle(dist_dir)
+        assert "GRADLE_OPTS" not in env
+        assert os.stat(settings_path).st_mtime == 0
+
+    def test_install_platform_p4a_reqs_cached(self):
+        """The p4a dependencies are only installed with pip when needed."""
+        target_android = init_target(self.temp_dir)
+
+        def install_p4a(install_reqs):
+            with patch_buildops_cmd() as m_cmd, mock.patch("buildozer.targets.android.open") as m_open:
+                m_open.return_value = StringIO("install_reqs = {!r}".format(install_reqs))
+                target_android._install_p4a()
+            return [
+                call for call in m_cmd.call_args_list
+                if call.args[0][1:3] == ["-m", "pip"]]
+
+        assert len(install_p4a(["pytest", "pexpect>=1"])) == 1
+        assert install_p4a(["pytest", "pexpect>=1"]) == []
+        # New dependencies.
+        assert len(install_p4a(["pytest"])) == 1
+        # Not installed anymore.
+        with mock.patch("importlib.metadata.version") as m_version:
+            m_version.side_effect = importlib.metadata.PackageNotFoundError
+            assert len(install_p4a(["pytest"])) == 1
+
+    def test_requirements_installed(self):
+        assert requirements_installed(["pytest", "pexpect>=1"])
+        assert not requirements_installed(["pexpect<1"])
+        assert not requirements_installed(["not-a-distribution-buildozer"])
+        assert requirements_installed(['pexpect<1; sys_platform == "nowhere"'])
+
     def test_orientation(self):
         target_android = init_target(self.temp_dir, {
             "orientation": "portrait,portrait-reverse"
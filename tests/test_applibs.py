@@ -0,0 +1,88 @@
+import os
+from os.path import exists, join
+import shutil
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from buildozer.applibs import AppLibs
+
+
+class TestAppLibs(TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.applibs_dir = join(self.temp_dir.name, "applibs")
+        self.staging_dir = join(self.temp_dir.name, "staging")
+        self.manifest = join(self.temp_dir.name, "applibs.json")
+        os.mkdir(self.applibs_dir)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def stage(self, name, version, requires=()):
+        """Install a fake distribution in the staging directory, as pip
+        install --target would."""
+        package = name.lower()
+        info_dir = "{}-{}.dist-info".format(name, version)
+        files = [join(package, "__init__.py"), join(info_dir, "METADATA")]
+        os.makedirs(join(self.staging_dir, package), exist_ok=True)
+        os.makedirs(join(self.staging_dir, info_dir))
+        with open(join(self.staging_dir, files[0]), "w") as fd:
+            fd.write(version)
+        with open(join(self.staging_dir, files[1]), "w") as fd:
+            fd.write("Name: {}\nVersion: {}\n".format(name, version))
+            for requirement in requires:
+                fd.write("Requires-Dist: {}\n".format(requirement))
+        with open(join(self.staging_dir, info_dir, "RECORD"), "w") as fd:
+            for path in files + [join("..", "..", "bin", package)]:
+                fd.write("{},,\n".format(path))
+
+    def install(self, requirements, *distributions):
+        os.mkdir(self.staging_dir)
+        for distribution in distributions:
+            self.stage(*distribution)
+        applibs = AppLibs(self.applibs_dir, self.manifest)
+        applibs.install(requirements, self.staging_dir)
+        applibs.save()
+        shutil.rmtree(self.staging_dir)
+        return applibs
+
+    def test_incremental(self):
+        applibs = self.install(
+            ["requests", "six"],
+            ("requests", "2.31.0", ["Urllib3 (<3)", "idna>=2.5"]),
+            ("urllib3", "2.0.7"), ("idna", "3.4"), ("six", "1.16.0"))
+        assert applibs.requirements == {
+            "requests": ["idna", "requests", "urllib3"],
+            "six": ["six"],
+        }
+        assert sorted(os.listdir(self.applibs_dir)) == [
+            "idna", "idna-3.4.dist-info", "requests", "requests-2.31.0.dist-info",
+            "six", "six-1.16.0.dist-info", "urllib3", "urllib3-2.0.7.dist-info"]
+
+        # Unchanged, nothing to do.
+        applibs = AppLibs(self.applibs_dir, self.manifest)
+        assert applibs.changes(["requests", "six"]) == ([], [])
+
+        # A new version of a requirement, and a requirement sharing a
+        # dependency.
+        added, removed = applibs.changes(["requests", "six==1.17.0", "httpx"])
+        assert (added, removed) == (["six==1.17.0", "httpx"], ["six"])
+        assert applibs.remove(removed) == ["six"]
+        applibs.save()
+        applibs = self.install(
+            added, ("six", "1.17.0"), ("httpx", "0.25.0", ["idna"]),
+            ("idna", "3.4"))
+        with open(join(self.applibs_dir, "six", "__init__.py")) as fd:
+            assert fd.read() == "1.17.0"
+        assert not exists(join(self.applibs_dir, "six-1.16.0.dist-info"))
+
+        # A dependency is kept as long as a requirement needs it.
+        applibs = AppLibs(self.applibs_dir, self.manifest)
+        assert applibs.remove(["requests"]) == ["requests", "urllib3"]
+        assert sorted(os.listdir(self.applibs_dir)) == [
+            "httpx", "httpx-0.25.0.dist-info", "idna", "idna-3.4.dist-info",
+            "six", "six-1.17.0.dist-info"]
+        assert sorted(applibs.remove(["httpx", "six==1.17.0"])) == [
+            "httpx", "idna", "six"]
+        assert os.listdir(self.applibs_dir) == []
@@ -0,0 +1,95 @@
+import os
+from os.path import join
+import shlex
+import sys
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from buildozer.assets import optimize
+
+# Strips the trailing spaces of the file, and logs its runs.
+OPTIMIZER = (
+    "import sys; path, log = sys.argv[1:]; data = open(path, 'rb').read(); "
+    "open(path, 'wb').write(data.rstrip(b' ')); open(log, 'a').write('.')")
+
+
+class TestAssets(TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.source_dir = join(self.temp_dir.name, "src")
+        self.cache_dir = join(self.temp_dir.name, "cache")
+        self.index = join(self.temp_dir.name, "assets.json")
+        self.log = join(self.temp_dir.name, "log")
+        os.mkdir(self.source_dir)
+        self.optimizers = {
+            "png": "{} -c {} {{}} {}".format(
+                shlex.quote(sys.executable), shlex.quote(OPTIMIZER),
+                shlex.quote(self.log)),
+            "jpg": "",
+        }
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, path, content):
+        path = join(self.source_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fd:
+            fd.write(content)
+        return path
+
+    def runs(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as fd:
+            return len(fd.read())
+
+    def optimize(self, files, optimizers=None):
+        return optimize(
+            files, optimizers or self.optimizers, self.cache_dir, self.index,
+            os.environ)
+
+    def test_optimize(self):
+        files = {
+            "icon.png": self.write("icon.png", b"01234     "),
+            "data/logo.PNG": self.write(join("data", "logo.PNG"), b"abc   "),
+            "main.py": self.write("main.py", b"import kivy"),
+        }
+        optimized, result = self.optimize(files)
+        assert result == (2, 8)
+        assert self.runs() == 2
+        assert optimized["main.py"] == files["main.py"]
+        with open(optimized["icon.png"], "rb") as fd:
+            assert fd.read() == b"01234"
+        with open(optimized["data/logo.PNG"], "rb") as fd:
+            assert fd.read() == b"abc"
+        # the sources are not modified
+        with open(files["icon.png"], "rb") as fd:
+            assert fd.read() == b"01234     "
+
+        # Unchanged sources are taken from the index, the same content from
+        # the cache, and the optimized files are not optimized again.
+        assert self.optimize(files) == (optimized, (0, 0))
+        assert self.optimize({"copy.png": optimized["icon.png"]})[1] == (0, 0)
+        os.remove(self.index)
+        assert self.optimize(files) == (optimized, (2, 8))
+        assert self.runs() == 2
+
+        # The files that can't be made smaller are left as is.
+        files["other.png"] = self.write("other.png", b"xyz")
+        optimized, result = self.optimize(files)
+        assert result == (0, 0)
+        assert optimized["other.png"] == files["other.png"]
+        assert self.runs() == 3
+        self.optimize(files)
+        assert self.runs() == 3
+
+    def test_optimize_missing(self):
+        # A missing optimizer leaves the files as they are, and nothing in
+        # the cache.
+        files = {"icon.png": self.write("icon.png", b"01234     ")}
+        optimized, result = self.optimize(
+            files, {"png": "buildozer-missing-optimizer {}"})
+        assert (optimized, result) == (files, (0, 0))
+        assert os.listdir(self.cache_dir) == []
@@ -1,14 +1,22 @@
+import errno
+import hashlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+import os
 from os import environ, unlink
+from os.path import join
 from pathlib import Path
 import tarfile
 from queue import Queue
 from sys import executable, platform
+from threading import Thread
 import time
 from tempfile import TemporaryDirectory
 from unittest import TestCase, mock, skipIf
-from zipfile import ZipFile
+from urllib.error import HTTPError
+from zipfile import ZipFile, ZipInfo
 
-from buildozer.exceptions import BuildozerCommandException
+from buildozer.exceptions import BuildozerCommandException, BuildozerException
 import buildozer.buildops as buildops
 
 
@@ -51,6 +59,67 @@ class MockStream:
         self.queue.put("HALT")
 
 
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files with support for single HTTP ranges.
+
+    The first `fail_after` bytes served overall are followed by a dropped
+    connection, to simulate a flaky mirror.
+    """
+
+    fail_after = None
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        type(self).requests.append(self.headers.get("Range"))
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return None
+        data = path.read_bytes()
+        last_modified = self.date_time_string(int(path.stat().st_mtime))
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range != last_modified:
+            # changed since: the whole file is sent
+            range_header = None
+        if range_header:
+            first, last = range_header[len("bytes="):].split("-")
+            start = int(first)
+            end = int(last) if last else end
+            if start >= len(data):
+                self.send_error(416)
+                return None
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        return data[start:end + 1]
+
+    def do_HEAD(self):
+        self.send_head()
+
+    def do_GET(self):
+        data = self.send_head()
+        if data is None:
+            return
+        fail_after = type(self).fail_after
+        if fail_after is not None:
+            type(self).fail_after = None
+            self.wfile.write(data[:fail_after])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+
 class TestBuildOps(TestCase):
     def test_file_exists(self):
         with TemporaryDirectory() as base_dir:
@@ -217,6 +286,157 @@ class TestBuildOps(TestCase):
             m_logger.error.assert_not_called()
             m_logger.reset_mock()
 
+    def test_file_copy_batch(self):
+        with mock.patch(
+            "buildozer.buildops.LOGGER"
+        ), TemporaryDirectory() as base_dir:
+            source_dir = Path(base_dir) / "source"
+            target_dir = Path(base_dir) / "target"
+            pairs = []
+            for index in range(50):
+                source = source_dir / str(index % 5) / "{}.txt".format(index)
+                source.parent.mkdir(parents=True, exist_ok=True)
+                source.write_text(str(index) * 1000)
+                pairs.append((source, target_dir / source.relative_to(source_dir)))
+            # Existing targets are replaced.
+            buildops.mkdir(target_dir / "0")
+            (target_dir / "0" / "0.txt").write_text("old")
+
+            buildops.file_copy_batch(pairs, workers=4)
+            for source, target in pairs:
+                assert target.read_text() == source.read_text()
+                assert target.stat().st_mtime_ns == source.stat().st_mtime_ns
+
+            # Without copy_file_range.
+            with mock.patch(
+                    "buildozer.buildops.os.copy_file_range",
+                    side_effect=OSError(errno.EXDEV, "Cross-device"),
+                    create=True) as m_copy_file_range:
+                buildops.file_copy_batch(pairs[:3], workers=1)
+            assert m_copy_file_range.call_count <= 1
+            assert pairs[0][1].read_text() == "0" * 1000
+
+    def test_file_sync(self):
+        with mock.patch(
+            "buildozer.buildops.LOGGER"
+        ), TemporaryDirectory() as base_dir:
+            source_dir = Path(base_dir) / "source"
+            target_dir = Path(base_dir) / "target"
+            manifest = Path(base_dir) / "manifest.json"
+            buildops.mkdir(source_dir / "sub")
+            (source_dir / "a.py").write_text("a")
+            (source_dir / "sub" / "b.py").write_text("b")
+            files = {
+                "a.py": str(source_dir / "a.py"),
+                join("sub", "b.py"): str(source_dir / "sub" / "b.py"),
+            }
+
+            # Without manifest, the target is emptied and fully copied.
+            buildops.mkdir(target_dir)
+            (target_dir / "stale.py").write_text("stale")
+            result = buildops.file_sync(files, target_dir, manifest)
+            assert result == buildops.SyncResult(2, 0, 0)
+            assert not (target_dir / "stale.py").exists()
+            assert (target_dir / "sub" / "b.py").read_text() == "b"
+            assert (target_dir / "a.py").stat().st_mtime_ns == \
+                (source_dir / "a.py").stat().st_mtime_ns
+
+            # Nothing changed.
+            assert buildops.file_sync(files, target_dir, manifest) == \
+                buildops.SyncResult(0, 0, 2)
+
+            # Modified source, modified target and removed file.
+            (source_dir / "a.py").write_text("aa")
+            (target_dir / "sub" / "b.py").write_text("patched")
+            del files["a.py"]
+            files["c.py"] = str(source_dir / "a.py")
+            result = buildops.file_sync(files, target_dir, manifest)
+            assert result == buildops.SyncResult(2, 1, 0)
+            assert not (target_dir / "a.py").exists()
+            assert (target_dir / "c.py").read_text() == "aa"
+            assert (target_dir / "sub" / "b.py").read_text() == "b"
+
+            # Touched files are only copied if their content changed, when
+            # comparing checksums.
+            stat = (source_dir / "a.py").stat()
+            os.utime(source_dir / "a.py",
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            assert buildops.file_sync(
+                files, target_dir, manifest, checksum=True) == \
+                buildops.SyncResult(0, 0, 2)
+            assert buildops.file_sync(files, target_dir, manifest) == \
+                buildops.SyncResult(0, 0, 2)
+            os.utime(source_dir / "a.py",
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+            assert buildops.file_sync(files, target_dir, manifest) == \
+                buildops.SyncResult(1, 0, 1)
+
+            # Emptied directories are removed.
+            del files[join("sub", "b.py")]
+            buildops.file_sync(files, target_dir, manifest)
+            assert not (target_dir / "sub").exists()
+
+    def test_file_sync_type_change(self):
+        with mock.patch(
+            "buildozer.buildops.LOGGER"
+        ), TemporaryDirectory() as base_dir:
+            source = Path(base_dir) / "source.txt"
+            source.write_text("content")
+            target_dir = Path(base_dir) / "target"
+            manifest = Path(base_dir) / "manifest.json"
+
+            # A file becomes a directory.
+            buildops.file_sync({"data": str(source)}, target_dir, manifest)
+            assert buildops.file_sync(
+                {join("data", "file.txt"): str(source)}, target_dir,
+                manifest) == buildops.SyncResult(1, 1, 0)
+            assert (target_dir / "data" / "file.txt").read_text() == "content"
+
+            # A directory becomes a file, even with unknown files in it.
+            (target_dir / "data" / "file.pyc").write_text("compiled")
+            assert buildops.file_sync(
+                {"data": str(source)}, target_dir,
+                manifest) == buildops.SyncResult(1, 1, 0)
+            assert (target_dir / "data").read_text() == "content"
+            assert buildops.file_sync(
+                {"data": str(source)}, target_dir,
+                manifest) == buildops.SyncResult(0, 0, 1)
+
+    def test_file_sync_modes(self):
+        with mock.patch(
+            "buildozer.buildops.LOGGER"
+        ), TemporaryDirectory() as base_dir:
+            source = Path(base_dir) / "source.txt"
+            source.write_text("content")
+            files = {"file.txt": str(source)}
+
+            for mode in buildops.COPY_MODES:
+                target_dir = Path(base_dir) / mode
+                buildops.file_sync(
+                    files, target_dir, Path(base_dir) / (mode + ".json"),
+                    mode=mode)
+                target = target_dir / "file.txt"
+                assert target.read_text() == "content"
+                assert target.stat().st_mtime_ns == source.stat().st_mtime_ns
+                if mode == "copy":
+                    assert not target.samefile(source)
+                if mode == "hardlink" and platform != "win32":
+                    assert target.samefile(source)
+
+            # Links fall back to copies, across filesystems for example.
+            with mock.patch("buildozer.buildops.os.link",
+                            side_effect=OSError(errno.EXDEV, "Cross-device")):
+                target_dir = Path(base_dir) / "fallback"
+                buildops.file_sync(
+                    files, target_dir, Path(base_dir) / "fallback.json",
+                    mode="hardlink")
+                assert (target_dir / "file.txt").read_text() == "content"
+
+            with self.assertRaises(ValueError):
+                buildops.file_sync(files, Path(base_dir) / "unknown",
+                                   Path(base_dir) / "unknown.json",
+                                   mode="unknown")
+
     def test_extract_file(self):
 
         with mock.patch(
@@ -241,13 +461,8 @@ class TestBuildOps(TestCase):
             m_logger.reset_mock()
 
             nonexistent_path = Path(base_dir) / "nonexistent.zip"
-            try:
+            with self.assertRaises(FileNotFoundError):
                 buildops.file_extract(nonexistent_path, environ)
-                self.fail("No exception raised")
-            except FileNotFoundError:
-                pass  # This is raised by zipfile on Windows.
-            except BuildozerCommandException:
-                pass  # This is raised by cmd when not on Windows.
 
             m_logger.reset_mock()
 
@@ -266,8 +481,35 @@ class TestBuildOps(TestCase):
                 assert uncompressed_file.read() == "Text to zip"
             m_logger.reset_mock()
 
-            # Todo: Create a multi-file zip file with permissions.
-            # Show it unpacks.
+            # Create a multi-file zip file with permissions and symbolic
+            # links, and show it unpacks.
+            zipfile_path = Path(base_dir) / "tree.zip"
+            with ZipFile(zipfile_path, "w") as outfile:
+                info = ZipInfo("tree/")
+                info.external_attr = (0o40755 << 16) | 0x10
+                outfile.writestr(info, "")
+                info = ZipInfo("tree/bin/tool")
+                info.external_attr = 0o100755 << 16
+                outfile.writestr(info, "#!/bin/sh\n")
+                outfile.writestr("tree/lib/data.txt", "data")
+                info = ZipInfo("tree/data.txt")
+                info.external_attr = 0o120777 << 16
+                outfile.writestr(info, "lib/data.txt")
+            buildops.file_extract(zipfile_path, environ, cwd=base_dir)
+            tree_path = Path(base_dir) / "tree"
+            assert (tree_path / "lib" / "data.txt").read_text() == "data"
+            assert (tree_path / "data.txt").read_text() == "data"
+            if platform != "win32":
+                assert (tree_path / "data.txt").is_symlink()
+                assert (tree_path / "bin" / "tool").stat().st_mode & 0o777 == 0o755
+
+            zipfile_path = Path(base_dir) / "unsafe.zip"
+            with ZipFile(zipfile_path, "w") as outfile:
+                outfile.writestr("../escaped.txt", "data")
+            with self.assertRaises(BuildozerException):
+                buildops.file_extract(zipfile_path, environ, cwd=base_dir)
+            assert not (Path(base_dir).parent / "escaped.txt").exists()
+            m_logger.reset_mock()
 
             # Create a tgz file and untgz it.
             text_file_path = Path(base_dir) / "text_to_tgz.txt"
@@ -416,6 +658,98 @@ class TestBuildOps(TestCase):
         ]
         assert cmd_result.return_code != 0
 
+    @skipIf(platform == "win32", "select() can't wait on pipes on Windows")
+    def test_cmd_selector_pump(self):
+        with mock.patch("buildozer.buildops.Popen") as m_popen:
+            m_popen().stdout = [b"output"]
+            assert buildops._select_pump(m_popen()) is buildops._pump_threads
+
+        # A real process is read through the selector.
+        with mock.patch(
+            "buildozer.buildops._pump_threads"
+        ) as m_pump_threads, mock.patch(
+            "buildozer.buildops.LOGGER", log_level=2, INFO=1
+        ) as m_logger:
+            cmd_result = buildops.cmd(
+                [executable, "-c", "import sys; print('out'); "
+                 "print('err', file=sys.stderr)"],
+                environ,
+                get_stdout=True,
+                get_stderr=True,
+            )
+        m_pump_threads.assert_not_called()
+        assert cmd_result == ("out\n", "err\n", 0)
+        assert any(
+            "selector pump" in call.args[0]
+            for call in m_logger.debug.call_args_list
+        )
+
+        # A child process keeping the pipes open doesn't stall the command.
+        start_time = time.time()
+        cmd_result = buildops.cmd(
+            [
+                executable,
+                "-c",
+                "import subprocess, sys; "
+                "subprocess.Popen([sys.executable, '-c', "
+                "'import time; time.sleep(5)']); "
+                "print('Started', flush=True)",
+            ],
+            environ,
+            get_stdout=True,
+        )
+        assert cmd_result.stdout == "Started\n"
+        assert cmd_result.return_code == 0
+        assert time.time() - start_time < 4
+
+    def test_cmd_output_dir(self):
+        with TemporaryDirectory() as log_dir:
+            script = (
+                "import sys; "
+                "[print('line', i) for i in range(10000)]; "
+                "print('oops', file=sys.stderr)"
+            )
+            cmd_result = buildops.cmd(
+                [executable, "-c", script],
+                environ,
+                get_stdout=True,
+                get_stderr=True,
+                show_output=False,
+                output_dir=log_dir,
+            )
+            assert cmd_result.return_code == 0
+            out, err = cmd_result.stdout, cmd_result.stderr
+            assert isinstance(out, buildops.CommandOutput)
+            assert out.path.parent == Path(log_dir)
+            assert out.path.name.endswith(".stdout.log")
+            assert out.size == out.path.stat().st_size
+            assert list(out)[-1] == "line 9999"
+            assert out.read().splitlines()[0] == "line 0"
+            assert str(err) == "oops\n"
+            assert out.tail.endswith("line 9999\n")
+
+            # Only the end of the output is kept in memory.
+            output = buildops.CommandOutput(Path(log_dir, "small"), tail_size=8)
+            output.write(b"0123456789")
+            output.write(b"abcdef")
+            output.close()
+            assert output.tail == "89abcdef"
+            assert output.read() == "0123456789abcdef"
+
+            # On failure, the end of the output is logged.
+            with mock.patch(
+                "buildozer.buildops.LOGGER", log_level=0, INFO=1
+            ) as m_logger:
+                with self.assertRaises(BuildozerCommandException):
+                    buildops.cmd(
+                        [executable, "-c", script + "; sys.exit(3)"],
+                        environ,
+                        get_stderr=True,
+                        show_output=False,
+                        output_dir=log_dir,
+                    )
+            m_logger.error.assert_any_call("    oops")
+
     @skipIf(platform != "win32", "Windows only test to confirm failure")
     def test_cmd_expect_win(self):
         with self.assertRaises(AssertionError):
@@ -435,6 +769,128 @@ class TestBuildOps(TestCase):
             )
             assert ico_path.exists()
 
+    def test_download_local(self):
+        content = bytes(range(256)) * 20000  # ~5 MB
+        digest = hashlib.sha256(content).hexdigest()
+
+        with TemporaryDirectory() as serve_dir, \
+                TemporaryDirectory() as download_dir, \
+                mock.patch("buildozer.buildops.DOWNLOAD_BACKOFF", 0), \
+                mock.patch("buildozer.buildops.stdout"):
+            Path(serve_dir, "archive.zip").write_bytes(content)
+            server = ThreadingHTTPServer(
+                ("127.0.0.1", 0),
+                partial(RangeRequestHandler, directory=serve_dir))
+            Thread(target=server.serve_forever, daemon=True).start()
+            url = "http://127.0.0.1:{}/".format(server.server_port)
+            target = Path(download_dir) / "archive.zip"
+
+            try:
+                # Plain download, checked against its digest.
+                RangeRequestHandler.requests = []
+                buildops.download(url, "archive.zip", cwd=download_dir,
+                                  sha256=digest)
+                assert target.read_bytes() == content
+                assert RangeRequestHandler.requests == [None]
+                assert not Path(download_dir, "archive.zip.part").exists()
+
+                # A dropped connection is retried, and resumed.
+                RangeRequestHandler.requests = []
+                RangeRequestHandler.fail_after = 1000000
+                buildops.download(url, "archive.zip", cwd=download_dir)
+                assert target.read_bytes() == content
+                assert RangeRequestHandler.requests == [None, "bytes=1000000-"]
+
+                # A part of another version of the file is not resumed.
+                part = Path(download_dir, "archive.zip.part")
+                part.write_bytes(b"old")
+                Path(download_dir, "archive.zip.part.validator").write_text(
+                    "Thu, 01 Jan 1970 00:00:00 GMT")
+                RangeRequestHandler.requests = []
+                with mock.patch("buildozer.buildops._report_download_progress") \
+                        as m_progress:
+                    buildops.download(url, "archive.zip", cwd=download_dir)
+                assert target.read_bytes() == content
+                assert RangeRequestHandler.requests == ["bytes=3-"]
+                # The total size is known, from the response.
+                assert m_progress.call_args.args == (len(content), len(content))
+                assert not Path(
+                    download_dir, "archive.zip.part.validator").exists()
+
+                # Parallel ranges.
+                RangeRequestHandler.requests = []
+                buildops.download(url, "archive.zip", cwd=download_dir,
+                                  sha256=digest, connections=2)
+                assert target.read_bytes() == content
+                assert sorted(RangeRequestHandler.requests[1:]) == [
+                    "bytes=0-2559999", "bytes=2560000-5119999"]
+
+                # Wrong digest.
+                with self.assertRaises(BuildozerException):
+                    buildops.download(url, "archive.zip", cwd=download_dir,
+                                      sha256="0" * 64)
+                assert not target.exists()
+
+                # Missing files are not retried.
+                RangeRequestHandler.requests = []
+                with self.assertRaises(HTTPError):
+                    buildops.download(url, "missing.zip", cwd=download_dir)
+                assert RangeRequestHandler.requests == [None]
+
+                # Neither are local errors.
+                RangeRequestHandler.requests = []
+                with mock.patch("buildozer.buildops.open",
+                                side_effect=PermissionError, create=True), \
+                        self.assertRaises(PermissionError):
+                    buildops.download(url, "archive.zip", cwd=download_dir)
+                assert len(RangeRequestHandler.requests) == 1
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_download_extract(self):
+        with TemporaryDirectory() as serve_dir, \
+                TemporaryDirectory() as extract_dir, \
+                mock.patch("buildozer.buildops.DOWNLOAD_BACKOFF", 0), \
+                mock.patch("buildozer.buildops.stdout"):
+            content = os.urandom(300000)
+            Path(serve_dir, "data.bin").write_bytes(content)
+            archive_path = Path(serve_dir, "archive.tar.gz")
+            with tarfile.open(archive_path, "x:gz") as outfile:
+                outfile.add(Path(serve_dir, "data.bin"), arcname="dir/data.bin")
+            digest = hashlib.sha256(archive_path.read_bytes()).hexdigest()
+            server = ThreadingHTTPServer(
+                ("127.0.0.1", 0),
+                partial(RangeRequestHandler, directory=serve_dir))
+            Thread(target=server.serve_forever, daemon=True).start()
+            url = "http://127.0.0.1:{}/".format(server.server_port)
+            saved = Path(serve_dir, "saved.tar.gz")
+
+            try:
+                # The archive is extracted, and saved.
+                assert buildops.download_extract(
+                    url, "archive.tar.gz", cwd=extract_dir, sha256=digest,
+                    save_to=saved) == digest
+                assert Path(extract_dir, "dir", "data.bin").read_bytes() == content
+                assert saved.read_bytes() == archive_path.read_bytes()
+
+                # A dropped connection restarts the extraction.
+                RangeRequestHandler.requests = []
+                RangeRequestHandler.fail_after = 100000
+                buildops.download_extract(url, "archive.tar.gz", cwd=extract_dir)
+                assert RangeRequestHandler.requests == [None, None]
+                assert Path(extract_dir, "dir", "data.bin").read_bytes() == content
+
+                # Wrong digest.
+                with self.assertRaises(BuildozerException):
+                    buildops.download_extract(
+                        url, "archive.tar.gz", cwd=extract_dir,
+                        sha256="0" * 64, save_to=saved)
+                assert not saved.exists()
+            finally:
+                server.shutdown()
+                server.server_close()
+
     def test_checkbin(self):
 
         with mock.patch("buildozer.buildops.exit") as m_exit, mock.patch(
@@ -1,10 +1,13 @@
 import re
 import os
 import codecs
+import shutil
 import unittest
 import buildozer as buildozer_module
 from buildozer import Buildozer
+from buildozer.exceptions import BuildozerCommandException
 from io import StringIO
+import sys
 from sys import platform
 import tempfile
 from unittest import mock
@@ -125,15 +128,13 @@ class TestBuildozer(unittest.TestCase):
         target = TargetAndroid(buildozer=buildozer)
 
         # Mock first run
-        with mock.patch('buildozer.buildops.download') as download, \
-                mock.patch('buildozer.buildops.file_extract') as m_file_extract, \
+        with mock.patch('buildozer.downloadcache.DownloadCache.fetch_extract') as m_fetch_extract, \
                 mock.patch('os.makedirs'):
             ant_path = target._install_apache_ant()
-        assert m_file_extract.call_args_list == [
-            mock.call(mock.ANY, cwd='/my/ant/path', env=mock.ANY)]
         assert ant_path == my_ant_path
-        assert download.call_args_list == [
-            mock.call("https://archive.apache.org/dist/ant/binaries/", mock.ANY, cwd=my_ant_path)]
+        assert m_fetch_extract.call_args_list == [
+            mock.call("https://archive.apache.org/dist/ant/binaries/", mock.ANY,
+                      cwd=my_ant_path, env=mock.ANY)]
         # Mock ant already installed
         with mock.patch('buildozer.buildops.file_exists', return_value=True):
             ant_path = target._install_apache_ant()
@@ -179,3 +180,293 @@ class TestBuildozer(unittest.TestCase):
         # file, the performed above
         ndk_version = buildozer.target.p4a_recommended_android_ndk
         mock_open.assert_called_once()
+
+    @unittest.skipIf(platform == "win32", "Hard links need privileges on Windows")
+    def test_build_application_hardlink(self):
+        """
+        With hard links, the source files are never modified when the app
+        directory is patched.
+        """
+        with tempfile.TemporaryDirectory() as base_dir:
+            source_dir = os.path.join(base_dir, 'src')
+            os.makedirs(os.path.join(source_dir, 'service'))
+            for fn, content in (('main.py', 'main'),
+                                ('sitecustomize.py', 'custom'),
+                                (os.path.join('service', 'main.py'), 'service')):
+                with open(os.path.join(source_dir, fn), 'w') as fd:
+                    fd.write(content)
+            specfilename = os.path.join(base_dir, 'buildozer.spec')
+            shutil.copyfile(self.specfile.name, specfilename)
+
+            buildozer = Buildozer(specfilename)
+            buildozer.config.set('app', 'source.dir', source_dir)
+            buildozer.config.set('app', 'copy_mode', 'hardlink')
+            buildozer.targetname = 'android'
+            buildozer.check_build_layout()
+            buildozer.build_application()
+
+            main_py = os.path.join(buildozer.app_dir, 'main.py')
+            assert os.path.samefile(main_py, os.path.join(source_dir, 'main.py'))
+            for fn, content in (('sitecustomize.py', 'custom'),
+                                (os.path.join('service', 'main.py'), 'service')):
+                with open(os.path.join(source_dir, fn)) as fd:
+                    assert fd.read() == content
+            with open(os.path.join(buildozer.app_dir, 'service', 'main.py')) as fd:
+                assert fd.read().endswith('service')
+
+    @unittest.skipIf(platform == "win32", "Hard links need privileges on Windows")
+    def test_build_application_assets(self):
+        """
+        The optimized assets are not copied again by the next builds, and
+        no two files of the app directory share an inode, even when their
+        optimized copy is the same file of the cache.
+        """
+        with tempfile.TemporaryDirectory() as base_dir, \
+                mock.patch.dict(os.environ, {'HOME': base_dir}):
+            source_dir = os.path.join(base_dir, 'src')
+            os.makedirs(source_dir)
+            for fn, content in (('main.py', 'main'),
+                                ('a.png', 'image   '),
+                                ('b.png', 'image   ')):
+                with open(os.path.join(source_dir, fn), 'w') as fd:
+                    fd.write(content)
+            specfilename = os.path.join(base_dir, 'buildozer.spec')
+            shutil.copyfile(self.specfile.name, specfilename)
+
+            buildozer = Buildozer(specfilename)
+            buildozer.config.set('app', 'source.dir', source_dir)
+            buildozer.config.set('app', 'source.include_exts', 'py,png')
+            buildozer.config.set('app', 'copy_mode', 'hardlink')
+            buildozer.config.set('assets', 'png', '{} -c "{}" {{}}'.format(
+                sys.executable,
+                "import sys; data = open(sys.argv[1]).read(); "
+                "open(sys.argv[1], 'w').write(data.strip())"))
+            buildozer.targetname = 'android'
+            buildozer.check_build_layout()
+            buildozer.build_application()
+
+            def app_files():
+                return {
+                    fn: os.stat(os.path.join(buildozer.app_dir, fn)).st_ino
+                    for fn in ('main.py', 'a.png', 'b.png')}
+
+            files = app_files()
+            for fn in ('a.png', 'b.png'):
+                with open(os.path.join(buildozer.app_dir, fn)) as fd:
+                    assert fd.read() == 'image'
+                assert os.stat(os.path.join(buildozer.app_dir, fn)).st_nlink == 1
+            assert os.path.samefile(
+                os.path.join(buildozer.app_dir, 'main.py'),
+                os.path.join(source_dir, 'main.py'))
+            with open(os.path.join(source_dir, 'a.png')) as fd:
+                assert fd.read() == 'image   '
+
+            results = []
+
+            def file_sync(*args, **kwargs):
+                results.append(sync(*args, **kwargs))
+                return results[-1]
+
+            sync = buildozer_module.buildops.file_sync
+            with mock.patch('buildozer.buildops.file_sync', file_sync):
+                buildozer.build_application()
+            assert app_files() == files
+            assert [result.copied for result in results] == [0, 0]
+
+    def test_build_hooks(self):
+        """
+        The hooks of the [hooks] section run around the stages of the build,
+        and the package is built once.
+        """
+        with tempfile.TemporaryDirectory() as base_dir:
+            specfilename = os.path.join(base_dir, 'buildozer.spec')
+            shutil.copyfile(self.specfile.name, specfilename)
+            buildozer = Buildozer(specfilename)
+            buildozer.config.set('hooks', 'pre_build_package', 'echo "pre hook"')
+            buildozer.config.set('hooks', 'post_build_package', 'echo post')
+            buildozer.targetname = 'android'
+            buildozer.target = mock.Mock(build_mode='release')
+            buildozer.check_build_layout()
+            buildozer._build_prepared = True
+
+            calls = []
+            buildozer.target.build_package.side_effect = (
+                lambda: calls.append('build_package'))
+            with mock.patch('buildozer.buildops.cmd') as m_cmd, \
+                    mock.patch.object(buildozer, 'build_application'):
+                m_cmd.side_effect = lambda command, **kwargs: calls.append(
+                    (command, kwargs['env']['BUILDOZER_HOOK'],
+                     kwargs['env']['BUILDOZER_BUILD_MODE']))
+                buildozer.build()
+
+            assert calls == [
+                (['echo', 'pre hook'], 'pre_build_package', 'release'),
+                'build_package',
+                (['echo', 'post'], 'post_build_package', 'release'),
+            ]
+
+    def test_hooks_unknown(self):
+        """
+        Unknown hook points are configuration errors.
+        """
+        with open(self.specfile.name, 'a') as fd:
+            fd.write('post_build_apk = echo\n')
+        with mock.patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            with self.assertRaises(SystemExit):
+                Buildozer(self.specfile.name)
+        assert '[hooks] "post_build_apk" is not a hook point' in mock_stdout.getvalue()
+
+    def test_install_application_requirements(self):
+        """
+        The requirements are installed from the wheel cache, in a single pip
+        run.
+        """
+        with tempfile.TemporaryDirectory() as base_dir:
+            specfilename = os.path.join(base_dir, 'buildozer.spec')
+            shutil.copyfile(self.specfile.name, specfilename)
+            buildozer = Buildozer(specfilename)
+            buildozer.config.set('app', 'requirements.lockfile', 'requirements.lock')
+            buildozer.check_build_layout()
+            buildozer.env_venv = {}
+            wheelhouse = buildozer.wheelhouse_dir
+
+            def fake_pip(command, **kwargs):
+                if command[1] == 'install':
+                    for name in ('six-1.16.0', 'Requests-2.31.0'):
+                        os.mkdir(os.path.join(
+                            buildozer.applibs_dir, name + '.dist-info'))
+
+            with mock.patch.object(buildozer, '_ensure_virtualenv'), \
+                    mock.patch('buildozer.buildops.cmd') as m_cmd:
+                m_cmd.side_effect = fake_pip
+                buildozer._install_application_requirements(['requests', 'six'])
+            assert [call.args[0] for call in m_cmd.call_args_list] == [
+                ['pip', 'wheel', '--wheel-dir', wheelhouse,
+                 '--find-links', wheelhouse, 'requests', 'six'],
+                ['pip', 'install', '--target={}'.format(buildozer.applibs_dir),
+                 '--no-index', '--find-links', wheelhouse, 'requests', 'six'],
+            ]
+            lockfile = os.path.join(base_dir, 'requirements.lock')
+            with open(lockfile) as fd:
+                assert fd.read() == 'Requests==2.31.0\nsix==1.16.0\n'
+
+            # Offline, and constrained by the lock file.
+            buildozer.config.set('buildozer', 'pip_offline', 'True')
+            with mock.patch.object(buildozer, '_ensure_virtualenv'), \
+                    mock.patch('buildozer.buildops.cmd') as m_cmd:
+                buildozer._install_application_requirements(['requests', 'six'])
+            assert [call.args[0] for call in m_cmd.call_args_list] == [
+                ['pip', 'install', '--target={}'.format(buildozer.applibs_dir),
+                 '--no-index', '--find-links', wheelhouse,
+                 '--constraint', lockfile, 'requests', 'six'],
+            ]
+
+    def test_ensure_virtualenv(self):
+        """
+        The environment of the venv is computed from its layout, the venv
+        can be shared by the projects, or not used.
+        """
+        with tempfile.TemporaryDirectory() as base_dir:
+            specfilename = os.path.join(base_dir, 'buildozer.spec')
+            shutil.copyfile(self.specfile.name, specfilename)
+            buildozer = Buildozer(specfilename)
+            buildozer.environ = {'PATH': '/usr/bin', 'PYTHONHOME': '/usr'}
+            buildozer.check_build_layout()
+            with mock.patch('venv.create') as m_create:
+                m_create.side_effect = os.makedirs
+                buildozer._ensure_virtualenv()
+            venv_dir = os.path.join(buildozer.buildozer_dir, 'venv')
+            assert os.path.isdir(venv_dir)
+            assert buildozer.env_venv == {
+                'PATH': os.pathsep.join(
+                    [os.path.join(venv_dir, 'bin'), '/usr/bin']),
+                'VIRTUAL_ENV': venv_dir, 'CC': '/bin/false', 'CXX': '/bin/false'}
+
+            buildozer._venv_created = False
+            buildozer.config.set('buildozer', 'venv', 'shared')
+            with mock.patch('venv.create') as m_create, \
+                    mock.patch.object(Buildozer, 'global_buildozer_dir', base_dir):
+                m_create.side_effect = os.makedirs
+                buildozer._ensure_virtualenv()
+            assert buildozer.env_venv['VIRTUAL_ENV'] == os.path.join(
+                base_dir, 'venv', 'python{}.{}'.format(*sys.version_info[:2]))
+
+            buildozer._venv_created = False
+            buildozer.config.set('buildozer', 'venv', 'none')
+            with mock.patch('venv.create') as m_create:
+                buildozer._ensure_virtualenv()
+            m_create.assert_not_called()
+            assert buildozer.pip_command == [sys.executable, '-m', 'pip']
+            assert buildozer.env_venv == {
+                'PATH': '/usr/bin', 'PYTHONHOME': '/usr',
+                'CC': '/bin/false', 'CXX': '/bin/false'}
+
+    def test_check_application_requirements_incremental(self):
+        """
+        Added requirements are installed constrained by the installed
+        distributions, or all the requirements are reinstalled on conflict.
+        """
+        with tempfile.TemporaryDirectory() as base_dir:
+            specfilename = os.path.join(base_dir, 'buildozer.spec')
+            shutil.copyfile(self.specfile.name, specfilename)
+            buildozer = Buildozer(specfilename)
+            buildozer.env_venv = {}
+            buildozer.target = mock.Mock()
+            buildozer.target.get_available_packages.return_value = ['python3']
+            buildozer.check_build_layout()
+            versions = {'six': '1.16.0', 'requests': '2.31.0'}
+            installs = []
+
+            def fake_pip(command, **kwargs):
+                if command[1] != 'install':
+                    return
+                target = command[2][len('--target='):]
+                constraints = [
+                    open(command[i + 1]).read()
+                    for i, arg in enumerate(command) if arg == '--constraint']
+                requirements = [arg for arg in command[6:]
+                                if arg in versions or '==' in arg]
+                installs.append((requirements, constraints))
+                if any('six==' in arg for arg in requirements) and constraints:
+                    raise BuildozerCommandException()
+                if 'broken' in command:
+                    raise BuildozerCommandException()
+                for requirement in requirements:
+                    name, _, version = requirement.partition('==')
+                    info_dir = os.path.join(target, '{}-{}.dist-info'.format(
+                        name, version or versions[name]))
+                    os.mkdir(info_dir)
+                    open(os.path.join(info_dir, 'METADATA'), 'w').close()
+
+            with mock.patch('buildozer.buildops.cmd') as m_cmd, \
+                    mock.patch.object(buildozer, '_ensure_virtualenv'), \
+                    mock.patch.object(sys, 'prefix', sys.base_prefix):
+                m_cmd.side_effect = fake_pip
+                for requirements in ('python3,six', 'python3,six,requests',
+                                     'python3,six==1.17.0,requests'):
+                    buildozer.config.set('app', 'requirements', requirements)
+                    buildozer.check_application_requirements()
+
+            assert installs == [
+                (['six'], []),
+                (['requests'], ['six==1.16.0\n']),
+                (['six==1.17.0'], ['requests==2.31.0\n']),
+                (['six==1.17.0', 'requests'], []),
+            ]
+            assert sorted(os.listdir(buildozer.applibs_dir)) == [
+                'requests-2.31.0.dist-info', 'six-1.17.0.dist-info']
+
+            # The installed requirements are kept when the reinstallation
+            # fails too.
+            buildozer.config.set(
+                'app', 'requirements', 'python3,six==1.17.0,requests,broken')
+            with mock.patch('buildozer.buildops.cmd') as m_cmd, \
+                    mock.patch.object(buildozer, '_ensure_virtualenv'), \
+                    mock.patch.object(sys, 'prefix', sys.base_prefix):
+                m_cmd.side_effect = fake_pip
+                with self.assertRaises(BuildozerCommandException):
+                    buildozer.check_application_requirements()
+            assert sorted(os.listdir(buildozer.applibs_dir)) == [
+                'requests-2.31.0.dist-info', 'six-1.17.0.dist-info']
+            assert buildozer._open_applibs().changes(
+                ['six==1.17.0', 'requests']) == ([], [])
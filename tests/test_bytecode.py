@@ -0,0 +1,62 @@
+import os
+import subprocess
+from os.path import exists, join
+import sys
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from buildozer.bytecode import precompile
+
+
+class TestPrecompile(TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.app_dir = join(self.temp_dir.name, "app")
+        self.manifest = join(self.temp_dir.name, "bytecode.manifest.json")
+        for path in ("main.py", join("_applibs", "six.py")):
+            self.write(path, "VALUE = 1\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, path, content):
+        path = join(self.app_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fd:
+            fd.write(content)
+
+    def pyc(self, path):
+        return join(self.app_dir, path + "c")
+
+    def precompile(self, optimize=2):
+        return precompile(
+            sys.executable, [self.app_dir], self.manifest, os.environ.copy(),
+            optimize=optimize, workers=2)
+
+    def test_precompile(self):
+        self.write("main.py", "assert False\nVALUE = 1\n")
+        assert self.precompile() == (2, 0)
+        with open(self.pyc("main.py"), "rb") as fd:
+            # unchecked hash-based pyc
+            assert fd.read(8)[4:] == b"\x01\x00\x00\x00"
+        # a sourceless module, compiled without its asserts (python -OO)
+        os.rename(join(self.app_dir, "main.py"), join(self.temp_dir.name, "main.py"))
+        assert subprocess.run(
+            [sys.executable, "-c", "import main"], cwd=self.app_dir).returncode == 0
+        os.rename(join(self.temp_dir.name, "main.py"), join(self.app_dir, "main.py"))
+
+        # Only the changed modules are compiled again.
+        assert self.precompile() == (0, 2)
+        self.write("main.py", "VALUE = 2\n")
+        os.remove(self.pyc(join("_applibs", "six.py")))
+        self.write("other.py", "")
+        assert self.precompile() == (3, 0)
+
+        # The pycs of removed modules are removed.
+        os.remove(join(self.app_dir, "other.py"))
+        assert self.precompile() == (0, 2)
+        assert not exists(self.pyc("other.py"))
+
+        # Everything is compiled again at another level.
+        assert self.precompile(optimize=0) == (2, 0)
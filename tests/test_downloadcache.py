@@ -0,0 +1,188 @@
+import hashlib
+import os
+from os.path import join
+import subprocess
+import sys
+import tarfile
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock, skipIf
+
+from buildozer.downloadcache import DownloadCache, parse_size, format_size
+from buildozer.exceptions import BuildozerException
+
+
+class TestDownloadCache(TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.cache_dir = join(self.temp_dir.name, "cache")
+        self.cwd = join(self.temp_dir.name, "work")
+        os.mkdir(self.cwd)
+        self.contents = {}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def fake_download(self, url, filename, cwd=None, sha256=None):
+        path = join(cwd, filename)
+        with open(path, "wb") as fileh:
+            fileh.write(self.contents[url + filename])
+        return path
+
+    def patch_download(self):
+        return mock.patch(
+            "buildozer.buildops.download", side_effect=self.fake_download)
+
+    def test_parse_size(self):
+        assert parse_size("1024") == 1024
+        assert parse_size("2K") == 2048
+        assert parse_size("1.5g") == 1536 * 1024 ** 2
+        assert parse_size("20GB") == 20 * 1024 ** 3
+        with self.assertRaises(BuildozerException):
+            parse_size("lots")
+        assert format_size(512) == "512B"
+        assert format_size(3 * 1024 ** 2) == "3.0M"
+
+    def test_fetch(self):
+        cache = DownloadCache(self.cache_dir)
+        self.contents["https://example.com/a.zip"] = b"a" * 10
+        self.contents["https://mirror.example.com/a.zip"] = b"a" * 10
+
+        with self.patch_download() as m_download:
+            path = cache.fetch("https://example.com/", "a.zip", cwd=self.cwd)
+            assert path == join(self.cwd, "a.zip")
+            # Served from the cache the second time, even if the file was
+            # removed in the meantime.
+            os.unlink(path)
+            cache.fetch("https://example.com/", "a.zip", cwd=self.cwd)
+            # Same bytes from another URL are stored once.
+            cache.fetch(
+                "https://mirror.example.com/", "a.zip",
+                cwd=self.temp_dir.name)
+        assert m_download.call_count == 2
+
+        with open(path, "rb") as fileh:
+            assert fileh.read() == b"a" * 10
+        digest = hashlib.sha256(b"a" * 10).hexdigest()
+        assert os.listdir(cache.blobs_dir) == [digest]
+        assert os.stat(path).st_ino == os.stat(cache.blob_path(digest)).st_ino
+        assert cache.total_size() == 10
+
+        # A mismatching checksum means the cached file can't be used.
+        self.contents["https://example.com/a.zip"] = b"b" * 10
+        with self.patch_download() as m_download:
+            cache.fetch(
+                "https://example.com/", "a.zip", cwd=self.cwd,
+                sha256=hashlib.sha256(b"b" * 10).hexdigest())
+        assert m_download.call_count == 1
+
+    @skipIf(sys.platform == "win32", "No file locking on Windows")
+    def test_fetch_locked(self):
+        cache = DownloadCache(self.cache_dir)
+        url = "https://example.com/a.zip"
+        self.contents[url] = b"a" * 10
+        locked = cache._locked
+
+        def download_meanwhile(url):
+            # Another process downloads the file, while this one waits for
+            # the lock.
+            path = join(self.temp_dir.name, "other.zip")
+            with open(path, "wb") as fileh:
+                fileh.write(b"a" * 10)
+            DownloadCache(self.cache_dir).store(url, path)
+            return locked(url)
+
+        with self.patch_download() as m_download, mock.patch.object(
+                cache, "_locked", side_effect=download_meanwhile):
+            path = cache.fetch("https://example.com/", "a.zip", cwd=self.cwd)
+        assert m_download.call_count == 0
+        with open(path, "rb") as fileh:
+            assert fileh.read() == b"a" * 10
+
+        # The lock is held against the other processes.
+        lock = join(cache.partial_dir, "{}.lock".format(
+            hashlib.sha1(url.encode("utf-8")).hexdigest()))
+        take_lock = (
+            "import fcntl, sys; "
+            "fcntl.lockf(open(sys.argv[1], 'a'), fcntl.LOCK_EX | fcntl.LOCK_NB)")
+        with cache._locked(url):
+            assert subprocess.run(
+                [sys.executable, "-c", take_lock, lock],
+                stderr=subprocess.DEVNULL).returncode != 0
+        assert subprocess.run(
+            [sys.executable, "-c", take_lock, lock]).returncode == 0
+
+    def test_fetch_extract(self):
+        cache = DownloadCache(self.cache_dir)
+        data_path = join(self.temp_dir.name, "data.txt")
+        with open(data_path, "w") as fileh:
+            fileh.write("data")
+        archive_path = join(self.temp_dir.name, "archive.tar.gz")
+        with tarfile.open(archive_path, "x:gz") as tar:
+            tar.add(data_path, arcname="data.txt")
+        with open(archive_path, "rb") as fileh:
+            content = fileh.read()
+
+        def fake_download_extract(url, filename, cwd, sha256, save_to):
+            with open(save_to, "wb") as fileh:
+                fileh.write(content)
+            with tarfile.open(save_to) as tar:
+                tar.extractall(cwd)
+            return hashlib.sha256(content).hexdigest()
+
+        # Tar archives are extracted while downloaded, then cached.
+        with mock.patch(
+                "buildozer.buildops.download_extract",
+                side_effect=fake_download_extract) as m_download_extract:
+            cache.fetch_extract(
+                "https://example.com/", "archive.tar.gz", self.cwd, {})
+            assert m_download_extract.call_count == 1
+            assert [url for url, _ in cache.entries()] == [
+                "https://example.com/archive.tar.gz"]
+
+            # Then extracted from the cache.
+            os.unlink(join(self.cwd, "data.txt"))
+            cache.fetch_extract(
+                "https://example.com/", "archive.tar.gz", self.cwd, {})
+            assert m_download_extract.call_count == 1
+        with open(join(self.cwd, "data.txt")) as fileh:
+            assert fileh.read() == "data"
+        assert os.listdir(self.cwd) == ["data.txt"]
+
+    def test_evict(self):
+        cache = DownloadCache(self.cache_dir, max_size=25)
+        for name in "abc":
+            self.contents["https://example.com/" + name] = name.encode() * 10
+        with self.patch_download():
+            cache.fetch("https://example.com/", "a", cwd=self.cwd)
+            cache.fetch("https://example.com/", "b", cwd=self.cwd)
+            cache.fetch("https://example.com/", "a", cwd=self.cwd)
+            # Over the budget: "b" is the least recently used.
+            cache.fetch("https://example.com/", "c", cwd=self.cwd)
+        assert [url for url, _ in cache.entries()] == [
+            "https://example.com/c", "https://example.com/a"]
+        assert len(os.listdir(cache.blobs_dir)) == 2
+
+        assert cache.evict(0) == 20
+        assert cache.entries() == []
+        assert os.listdir(cache.blobs_dir) == []
+
+    def test_verify(self):
+        cache = DownloadCache(self.cache_dir)
+        self.contents["https://example.com/a"] = b"a"
+        self.contents["https://example.com/b"] = b"b"
+        with self.patch_download():
+            cache.fetch("https://example.com/", "a", cwd=self.cwd)
+            cache.fetch("https://example.com/", "b", cwd=self.cwd)
+        digest = cache.index["https://example.com/b"]["sha256"]
+        blob = cache.blob_path(digest)
+        os.chmod(blob, 0o644)
+        with open(blob, "wb") as fileh:
+            fileh.write(b"corrupted")
+        with open(join(cache.blobs_dir, "unknown"), "wb") as fileh:
+            fileh.write(b"?")
+
+        assert cache.verify() == ["https://example.com/b"]
+        assert [url for url, _ in cache.entries()] == ["https://example.com/a"]
+        assert os.listdir(cache.blobs_dir) == [
+            cache.index["https://example.com/a"]["sha256"]]
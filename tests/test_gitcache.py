@@ -0,0 +1,146 @@
+import os
+from os.path import join
+from shutil import which
+import subprocess
+from tempfile import TemporaryDirectory
+import unittest
+
+from buildozer.gitcache import GitCache
+from buildozer.gitmeta import GitRepository
+from buildozer.scripts.git_cache import parse_clone
+
+
+@unittest.skipIf(which("git") is None, "git is not installed")
+class TestGitCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.env = dict(
+            os.environ,
+            GIT_AUTHOR_NAME="buildozer", GIT_AUTHOR_EMAIL="buildozer@localhost",
+            GIT_COMMITTER_NAME="buildozer",
+            GIT_COMMITTER_EMAIL="buildozer@localhost",
+            GIT_CEILING_DIRECTORIES=self.temp_dir.name)
+        self.upstream = join(self.temp_dir.name, "upstream")
+        self.git("init", "-q", "-b", "main", self.upstream)
+        self.commit("first")
+        self.cache = GitCache(join(self.temp_dir.name, "cache"), env=self.env)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def git(self, *args, cwd=None):
+        return subprocess.run(
+            ["git", *args], cwd=cwd, env=self.env, check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+
+    def commit(self, message):
+        self.git("commit", "-q", "--allow-empty", "-m", message, cwd=self.upstream)
+        return self.git("rev-parse", "HEAD", cwd=self.upstream)
+
+    def test_clone_update(self):
+        first = join(self.temp_dir.name, "first")
+        second = join(self.temp_dir.name, "second")
+        self.cache.clone(self.upstream, "main", first)
+        head = self.commit("second")
+        self.cache.clone(self.upstream, "main", second)
+
+        # One mirror, whose objects are shared with the clones.
+        assert os.listdir(self.cache.mirrors_dir) == [
+            os.path.basename(self.cache.mirror_path(self.upstream))]
+        with open(join(second, ".git", "objects", "info", "alternates")) as fd:
+            assert fd.read().strip() == join(
+                self.cache.mirror_path(self.upstream), "objects")
+        repository = GitRepository(second)
+        assert repository.remote_url() == self.upstream
+        assert repository.branch == "main"
+        assert repository.head_commit == head
+
+        # The first clone is left alone until updated.
+        assert GitRepository(first).head_commit != head
+        self.cache.update(first, "main")
+        assert GitRepository(first).head_commit == head
+
+    def test_update_tag(self):
+        clone = join(self.temp_dir.name, "clone")
+        self.git("tag", "1.0", cwd=self.upstream)
+        self.cache.clone(self.upstream, "1.0", clone)
+        self.commit("second")
+        self.git("tag", "-a", "-m", "1.1", "1.1", cwd=self.upstream)
+        tag = self.git("rev-parse", "1.1^{commit}", cwd=self.upstream)
+
+        self.cache.update(clone, "1.1")
+        repository = GitRepository(clone)
+        assert repository.branch is None
+        assert repository.head_commit == tag
+
+    def test_evict(self):
+        other = join(self.temp_dir.name, "other")
+        self.git("init", "-q", "-b", "main", other)
+        self.git("commit", "-q", "--allow-empty", "-m", "other", cwd=other)
+        first = join(self.temp_dir.name, "first")
+        self.cache.clone(self.upstream, "main", first)
+        self.cache.clone(other, "main", join(self.temp_dir.name, "second"))
+        assert [entry["url"] for _, entry in self.cache.entries()] == [
+            other, self.upstream]
+        assert self.cache.index[
+            os.path.basename(self.cache.mirror_path(self.upstream))
+        ]["clones"] == [os.path.realpath(first)]
+
+        # The least recently used mirror is removed, its clone still works.
+        self.cache.max_size = self.cache.total_size() - 1
+        self.cache.evict()
+        assert [entry["url"] for _, entry in self.cache.entries()] == [other]
+        assert not os.path.exists(self.cache.mirror_path(self.upstream))
+        assert not os.path.exists(
+            join(first, ".git", "objects", "info", "alternates"))
+        self.git("fsck", cwd=first)
+        self.git("log", cwd=first)
+
+    def test_evict_used(self):
+        self.cache.clone(self.upstream, "main", join(self.temp_dir.name, "first"))
+        name = os.path.basename(self.cache.mirror_path(self.upstream))
+        # a clone borrowing the objects of the mirror, that can't be repacked
+        broken = join(self.temp_dir.name, "broken")
+        os.makedirs(join(broken, ".git", "objects", "info"))
+        with open(join(broken, ".git", "objects", "info", "alternates"), "w") as fd:
+            fd.write(join(self.cache.mirror_path(self.upstream), "objects"))
+        entry = dict(self.cache.index[name])
+        entry["clones"] = entry["clones"] + [broken]
+        self.cache.index[name] = entry
+
+        assert self.cache.evict(0) == 0
+        assert os.path.isdir(self.cache.mirror_path(self.upstream))
+        assert name in self.cache.index
+
+    def test_verify(self):
+        self.cache.clone(self.upstream, "main", join(self.temp_dir.name, "first"))
+        mirror = self.cache.mirror_path(self.upstream)
+        os.mkdir(join(self.cache.mirrors_dir, "unknown"))
+
+        assert self.cache.verify() == []
+        assert os.listdir(self.cache.mirrors_dir) == [os.path.basename(mirror)]
+
+        # A mirror missing from the index is added back.
+        del self.cache.index[os.path.basename(mirror)]
+        assert self.cache.verify() == []
+        assert [entry["url"] for _, entry in self.cache.entries()] == [
+            self.upstream]
+
+        for root, _, files in os.walk(join(mirror, "objects")):
+            for fn in files:
+                if not fn.endswith(".idx"):
+                    os.unlink(join(root, fn))
+        assert self.cache.verify() == [self.upstream]
+        assert self.cache.entries() == []
+        assert os.listdir(self.cache.mirrors_dir) == []
+
+    def test_parse_clone(self):
+        assert parse_clone([
+            "--depth", "1", "-b", "develop", "--single-branch",
+            "https://github.com/kivy/python-for-android.git",
+        ]) == (
+            "https://github.com/kivy/python-for-android.git",
+            "python-for-android", "develop", "origin", ["--single-branch"])
+        assert parse_clone(["--origin=upstream", "-c", "a=b", "/repo/", "dest"]) == (
+            "/repo/", "dest", None, "upstream", ["-c", "a=b"])
@@ -0,0 +1,93 @@
+import os
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from buildozer.gitmeta import GitRepository, parse_git_config
+
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+OTHER_COMMIT = "89abcdef0123456789abcdef0123456789abcdef"
+TAG_OBJECT = "fedcba9876543210fedcba9876543210fedcba98"
+
+
+class TestGitRepository(TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, path, content):
+        path = join(self.path, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fd:
+            fd.write(content)
+
+    def test_parse_git_config(self):
+        config = parse_git_config(
+            '[core]\n'
+            '\tbare = false\n'
+            '\tfilemode\n'
+            '[remote "origin"]\n'
+            '\turl = https://github.com/kivy/python-for-android.git ; comment\n'
+            '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+            '[Branch "my \\"branch\\""] name = "a # b"\n'
+        )
+        assert config[("core", None)] == {"bare": "false", "filemode": "true"}
+        assert config[("remote", "origin")]["url"] == (
+            "https://github.com/kivy/python-for-android.git")
+        assert config[("branch", 'my "branch"')] == {"name": "a # b"}
+
+    def test_checkout(self):
+        self.write(".git/HEAD", "ref: refs/heads/develop\n")
+        self.write(
+            ".git/config",
+            '[remote "origin"]\n\turl = https://example.com/repo.git\n')
+        self.write(
+            ".git/packed-refs",
+            "# pack-refs with: peeled fully-peeled sorted\n"
+            "{} refs/heads/develop\n"
+            "{} refs/tags/v1.0\n"
+            "^{}\n".format(OTHER_COMMIT, TAG_OBJECT, OTHER_COMMIT))
+        repository = GitRepository(self.path)
+        assert repository.is_valid
+        assert repository.remote_url() == "https://example.com/repo.git"
+        assert repository.remote_url("upstream") is None
+        assert repository.branch == "develop"
+        assert repository.head_commit == OTHER_COMMIT
+        # Annotated tags are peeled.
+        assert repository.resolve("v1.0") == OTHER_COMMIT
+        assert repository.is_at("v1.0")
+
+        # Loose references have priority over the packed ones.
+        self.write(".git/refs/heads/develop", COMMIT + "\n")
+        assert repository.head_commit == COMMIT
+        assert repository.is_at(COMMIT[:7])
+        assert not repository.is_at("v1.0")
+        assert repository.resolve("unknown") is None
+
+        # Detached HEAD.
+        self.write(".git/HEAD", OTHER_COMMIT + "\n")
+        assert repository.branch is None
+        assert repository.is_at("HEAD")
+
+    def test_linked_worktree(self):
+        self.write("main/.git/config", '[remote "origin"]\n\turl = /repo\n')
+        self.write("main/.git/refs/heads/feature", COMMIT)
+        self.write("main/.git/worktrees/wt/HEAD", "ref: refs/heads/feature")
+        self.write("main/.git/worktrees/wt/commondir", "../..")
+        self.write("wt/.git", "gitdir: ../main/.git/worktrees/wt\n")
+        repository = GitRepository(join(self.path, "wt"))
+        assert repository.remote_url() == "/repo"
+        assert repository.branch == "feature"
+        assert repository.head_commit == COMMIT
+
+    def test_not_a_checkout(self):
+        repository = GitRepository(self.path)
+        assert not repository.is_valid
+        assert repository.remote_url() is None
+        assert repository.branch is None
+        assert repository.head_commit is None
+        assert not repository.is_at("master")
@@ -0,0 +1,139 @@
+import json
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import mock
+
+from buildozer.jsonstore import JsonStore, SqliteBackend
+
+
+class TestJsonStore(unittest.TestCase):
+    def test_store(self):
+        with TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "state.db")
+            store = JsonStore(filename)
+            store["key"] = "value"
+            assert JsonStore(filename)["key"] == "value"
+            del store["key"]
+            assert "key" not in JsonStore(filename)
+            assert "state.db.tmp" not in os.listdir(temp_dir)
+
+    def test_transaction(self):
+        with TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "state.db")
+            store = JsonStore(filename)
+            with mock.patch(
+                    "buildozer.jsonstore.os.replace",
+                    wraps=os.replace) as m_replace:
+                with store.transaction():
+                    store["a"] = 1
+                    with store.transaction():
+                        store["b"] = 2
+                    del store["a"]
+                    assert not os.path.exists(filename)
+                assert m_replace.call_count == 1
+                with open(filename) as fd:
+                    assert json.load(fd) == {"b": 2}
+
+                # Nothing changed, nothing written.
+                store.sync()
+                with store.transaction():
+                    pass
+                assert m_replace.call_count == 1
+
+    def test_atomic_write(self):
+        with TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "state.db")
+            store = JsonStore(filename)
+            store["key"] = "value"
+            # A failed write leaves the previous content.
+            with mock.patch("buildozer.jsonstore.dump",
+                            side_effect=OSError("No space left")):
+                with self.assertRaises(OSError):
+                    store["key"] = "new value"
+            assert JsonStore(filename)["key"] == "value"
+
+    def test_merge(self):
+        with TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "state.db")
+            first = JsonStore(filename)
+            second = JsonStore(filename)
+            first["a"] = 1
+            first["c"] = 3
+            second["b"] = 2
+            del second["c"]
+            # Each store keeps the changes of the other.
+            assert JsonStore(filename).data == {"a": 1, "b": 2}
+            assert second.data == {"a": 1, "b": 2}
+            first["a"] = 10
+            assert JsonStore(filename).data == {"a": 10, "b": 2}
+
+    def test_reload(self):
+        with TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "state.db")
+            first = JsonStore(filename)
+            second = JsonStore(filename)
+            first["a"] = 1
+            with second.transaction():
+                second["b"] = 2
+                # The pending changes are kept.
+                second.reload()
+                assert second.data == {"a": 1, "b": 2}
+            assert JsonStore(filename).data == {"a": 1, "b": 2}
+
+    @unittest.skipIf(sys.platform == "win32", "No file locking on Windows")
+    def test_increment(self):
+        with TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "state.db")
+            store = JsonStore(filename)
+            assert store.increment("count", default="0") == 1
+            assert store["count"] == "1"
+            assert store.increment("number") == 1
+            assert store["number"] == 1
+
+            # Concurrent increments are not lost.
+            script = (
+                "import sys\n"
+                "from buildozer.jsonstore import JsonStore\n"
+                "store = JsonStore(sys.argv[1])\n"
+                "for _ in range(20):\n"
+                "    store.increment('count')\n"
+                "    store['other'] = store.get('other', 0)\n"
+            )
+            processes = [
+                subprocess.Popen([sys.executable, "-c", script, filename])
+                for _ in range(4)
+            ]
+            for process in processes:
+                assert process.wait() == 0
+            assert JsonStore(filename)["count"] == "81"
+
+    def test_sqlite_backend(self):
+        with TemporaryDirectory() as temp_dir:
+            json_filename = os.path.join(temp_dir, "state.db")
+            sqlite_filename = os.path.join(temp_dir, "state.sqlite")
+            JsonStore(json_filename)["old"] = ["value"]
+
+            # The JSON store is imported when the database is created.
+            store = JsonStore(json_filename, backend=SqliteBackend(
+                sqlite_filename, migrate_from=json_filename))
+            assert store["old"] == ["value"]
+            with store.transaction():
+                store["a"] = {"x": 1}
+                store["a"] = {"x": 2}
+                del store["old"]
+            assert store.increment("count", default="0") == 1
+
+            other = JsonStore(json_filename, backend=SqliteBackend(
+                sqlite_filename, migrate_from=json_filename))
+            assert other.data == {"a": {"x": 2}, "count": "1"}
+            other["b"] = 2
+            store["c"] = 3
+            assert store.data == {"a": {"x": 2}, "count": "1", "b": 2, "c": 3}
+
+            assert [value for _, value in store.history("old")] == [
+                ["value"], None]
+            assert [value for _, value in store.history("a")] == [{"x": 2}]
+            assert JsonStore(json_filename).history("old") == []
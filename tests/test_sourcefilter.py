@@ -0,0 +1,102 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import mock
+
+from buildozer.sourcefilter import SourceFilter
+
+
+class TestSourceFilter(unittest.TestCase):
+    def make_tree(self, base_dir, paths):
+        for path in paths:
+            path = Path(base_dir, path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+
+    def walk(self, source_dir, **kwargs):
+        return sorted(
+            relative.replace(os.sep, "/")
+            for relative, _ in SourceFilter(**kwargs).walk(source_dir))
+
+    def test_walk(self):
+        with TemporaryDirectory() as source_dir:
+            self.make_tree(source_dir, [
+                "main.py",
+                "LICENSE",
+                "Icon.PNG",
+                ".hidden.py",
+                ".git/config.py",
+                "data/.cache/a.py",
+                "images/a.png",
+                "images/sub/b.png",
+                "images2/c.png",
+                "tests/test_main.py",
+                "docs/index.py",
+                "docs/sub/page.py",
+            ])
+
+            assert self.walk(source_dir) == [
+                "Icon.PNG",
+                "LICENSE",
+                "docs/index.py",
+                "docs/sub/page.py",
+                "images/a.png",
+                "images/sub/b.png",
+                "images2/c.png",
+                "main.py",
+                "tests/test_main.py",
+            ]
+
+            assert self.walk(
+                source_dir,
+                include_exts=["py", "png"],
+                exclude_dirs=["images", "tests"],
+                exclude_patterns=["license", "*.png", "docs/"],
+                include_patterns=["images/sub/*", "images2/*.png"],
+            ) == [
+                # Subdirectories of a directory excluded by a pattern not
+                # ending with "*" are kept.
+                "docs/sub/page.py",
+                "images/sub/b.png",
+                "images2/c.png",
+                "main.py",
+            ]
+
+    def test_pruning(self):
+        source_filter = SourceFilter(
+            exclude_dirs=["node_modules", "build/cache"],
+            exclude_patterns=["venv*", "docs/", "*.png"],
+            include_patterns=["venv/keep/*", "*.txt"],
+        )
+        assert source_filter.is_tree_excluded("node_modules/")
+        assert source_filter.is_tree_excluded("node_modules/sub/")
+        assert source_filter.is_tree_excluded("build/cache/")
+        assert not source_filter.is_tree_excluded("build/")
+        assert source_filter.is_tree_excluded("venv2/")
+        # Could contain files matching the include patterns.
+        assert not source_filter.is_tree_excluded("venv/")
+        assert source_filter.is_dir_excluded("venv/")
+        # Subdirectories may not be excluded.
+        assert not source_filter.is_tree_excluded("docs/")
+        assert source_filter.is_dir_excluded("docs/")
+
+        with TemporaryDirectory() as source_dir:
+            self.make_tree(source_dir, [
+                "main.py",
+                "node_modules/lib/index.py",
+                "venv2/lib/site.py",
+            ])
+            # The excluded trees are not even traversed.
+            visited = []
+            real_walk = os.walk
+
+            def recording_walk(*args, **kwargs):
+                for root, dirs, files in real_walk(*args, **kwargs):
+                    visited.append(root)
+                    yield root, dirs, files
+
+            with mock.patch("buildozer.sourcefilter.os.walk", recording_walk):
+                files = [relative for relative, _ in source_filter.walk(source_dir)]
+            assert files == ["main.py"]
+            assert visited == [source_dir]